@@ -4,64 +4,438 @@ Chương trình chính để xử lý PDF, tạo embeddings và trả lời câu
 """
 
 import os
+import sys
+import json
 import argparse
+import shutil
+import time
+from typing import Any, Dict, List, Optional
 from dotenv import load_dotenv
 
 from src import splitter
 from src import embedder
+from src import embed_scheduler
 from src import retriever
 from src import generator
+from src import bulk
+from src import bench
+from src import index_versions
 
 
-def cmd_split(pdf_path: str, output_dir: str) -> None:
-    """Tách PDF thành các file điều luật riêng biệt"""
-    text = splitter.extract_text_from_pdf(pdf_path)
-    lines = text.splitlines()
+def cmd_split(pdf_path: str, output_dir: str, workers: Optional[int] = None) -> None:
+    """
+    Tách PDF thành các file điều luật riêng biệt (trích xuất song song, xử lý dạng streaming)
+    Nếu pdf_path là thư mục, mỗi PDF (một luật) được tách vào thư mục con output_dir/<mã luật>
+    """
+    if os.path.isdir(pdf_path):
+        pdfs = splitter.list_pdfs(pdf_path)
+        if not pdfs:
+            raise FileNotFoundError(f"Không tìm thấy file PDF nào trong: {pdf_path}")
+        for path in pdfs:
+            law = splitter.law_id_from_path(path)
+            print(f"[{law}] Đọc PDF: {path}")
+            cmd_split(path, os.path.join(output_dir, law), workers)
+        return
+
     print("Tiến hành tách theo điều luật...")
-    articles = splitter.split_articles(lines)
-    print(f"Phát hiện {len(articles)} điều luật")
-    splitter.write_articles(articles, output_dir)
-    print(f"Đã ghi {len(articles)} file vào: {output_dir}")
+    pages = splitter.iter_page_texts(pdf_path, workers=workers)
+    articles = splitter.iter_articles(splitter.iter_text_lines(pages))
+    count = splitter.write_articles(articles, output_dir)
+    print(f"Phát hiện {count} điều luật")
+    print(f"Đã ghi {count} file vào: {output_dir}")
+
+
+def cmd_embed(
+    split_dir: str,
+    index_dir: str,
+    provider: str,
+    model: str,
+    batch_size: int,
+    local_model: str,
+    rebuild: bool = False,
+    index_options: Optional[Dict[str, Any]] = None,
+    chunking: str = "article",
+    keep_versions: int = index_versions.KEEP_VERSIONS,
+) -> None:
+    """
+    Tạo embeddings và lưu vào FAISS index
+    Mỗi lần chạy ghi một phiên bản mới index_dir/versions/<phiên bản> (cập nhật tăng dần từ bản đang công bố),
+    xong mới công bố bằng cách đổi con trỏ CURRENT; API đang phục vụ không bao giờ đọc phải index ghi dở
+    Nếu split_dir gồm các thư mục con theo luật, mỗi luật được lưu thành một shard <phiên bản>/<mã luật>
+    Cache embedding nằm ngoài các phiên bản (index_dir/embed_cache, index_dir/<mã luật>/embed_cache)
+    """
+    base_dir = index_versions.version_dir(index_dir, index_versions.read_current(index_dir))
+    version, version_dir = index_versions.create_version(index_dir)
+    print(f"Phiên bản index mới: {version}")
+    try:
+        laws = embedder.list_law_dirs(split_dir)
+        if not laws:
+            embed_split_dir(
+                split_dir, version_dir, provider, model, batch_size, local_model, rebuild, index_options,
+                chunking=chunking, base_dir=base_dir, cache_dir=os.path.join(index_dir, "embed_cache"),
+            )
+        else:
+            shards = []
+            for law in laws:
+                print(f"[{law}] Shard: {os.path.join(version_dir, law)}")
+                count = embed_split_dir(
+                    os.path.join(split_dir, law), os.path.join(version_dir, law),
+                    provider, model, batch_size, local_model, rebuild, index_options, law=law, chunking=chunking,
+                    base_dir=os.path.join(base_dir, law), cache_dir=os.path.join(index_dir, law, "embed_cache"),
+                )
+                shards.append({"law": law, "dir": law, "count": count})
+            embedder.save_shards_manifest(version_dir, shards)
+            print(f"Đã lưu {len(shards)} shard vào: {version_dir}")
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)  # Không để lại phiên bản dựng dở
+        raise
+    index_versions.publish(index_dir, version)
+    removed = index_versions.prune(index_dir, keep_versions)
+    print(f"Đã công bố phiên bản {version} tại: {index_dir}")
+    if removed:
+        print(f"Đã xóa {len(removed)} phiên bản cũ: {', '.join(removed)}")
+
+
+def cmd_versions(index_dir: str) -> None:
+    """Liệt kê các phiên bản index, đánh dấu phiên bản đang công bố"""
+    current = index_versions.read_current(index_dir)
+    versions = index_versions.list_versions(index_dir)
+    if not versions:
+        print(f"Chưa có phiên bản index nào trong: {index_dir}")
+        return
+    for version in versions:
+        print(f"{'*' if version == current else ' '} {version}")
+
+
+def cmd_rollback(index_dir: str, version: Optional[str] = None) -> None:
+    """Công bố lại phiên bản cũ (mặc định: bản liền trước); API đang chạy tự chuyển sang qua watcher hoặc /index/reload"""
+    previous = index_versions.read_current(index_dir)
+    target = index_versions.rollback(index_dir, version)
+    print(f"Đã rollback {previous or '(chưa có)'} -> {target}")
 
 
-def cmd_embed(split_dir: str, index_dir: str, provider: str, model: str, batch_size: int, local_model: str) -> None:
-    """Tạo embeddings và lưu vào FAISS index"""
+def embed_split_dir(
+    split_dir: str,
+    index_dir: str,
+    provider: str,
+    model: str,
+    batch_size: int,
+    local_model: str,
+    rebuild: bool = False,
+    index_options: Optional[Dict[str, Any]] = None,
+    law: str = "",
+    chunking: str = "article",
+    base_dir: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+) -> int:
+    """
+    Tạo embeddings (tăng dần, chỉ cho tài liệu mới/đã sửa) cho một thư mục điều luật và lưu vào FAISS index
+    ID tài liệu được gắn tiền tố mã luật (nếu có) để không trùng giữa các luật; trả về số tài liệu
+    index_options: {"type": loại index, "params": tham số index, "recall_k": k để đo recall (0 = bỏ qua)}
+    chunking: "article" (mỗi điều một tài liệu) hoặc "clause" (tách theo khoản/điểm, giữ liên kết tới điều gốc)
+    base_dir: index cũ để cập nhật tăng dần (mặc định chính index_dir); cache_dir: cache embedding
+    (mặc định index_dir/embed_cache)
+    """
+    index_options = index_options or {}
+    index_type = index_options.get("type", "flat")
     # Khởi tạo client OpenAI nếu cần
-    if provider == "openai":
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise EnvironmentError("OPENAI_API_KEY chưa được thiết lập trong biến môi trường")
-        client = embedder.OpenAI(api_key=api_key)
-    else:
-        client = None
+    embedder.check_provider(provider)
+    client = embedder.create_openai_client() if provider == "openai" else None
 
     # Đọc tài liệu từ thư mục đã tách
     documents = embedder.read_documents(split_dir)
     if not documents:
         raise FileNotFoundError("Không tìm thấy tài liệu .txt nào để embed. Hãy chạy split trước.")
 
-    doc_ids = [doc_id for doc_id, _ in documents]
+    doc_ids = [f"{law}/{doc_id}" if law else doc_id for doc_id, _ in documents]
     texts = [content for _, content in documents]
-    print(f"Tạo embeddings cho {len(texts)} tài liệu bằng provider: {provider}")
+    names = [name for name, _ in documents]
+    parents: Optional[List[str]] = None
+    parent_ids = doc_ids
+    parent_of: List[int] = []
+    if chunking == "clause":
+        # Mỗi khoản/điểm là một tài liệu có ID "<điều>#<nhãn>", trường parent trỏ tới điều gốc
+        parents = texts
+        doc_ids, texts, names = [], [], []
+        for p, (name, content) in enumerate(documents):
+            for label, chunk in splitter.split_clauses(content):
+                doc_ids.append(f"{parent_ids[p]}#{label}" if label else parent_ids[p])
+                texts.append(chunk)
+                names.append(name)
+                parent_of.append(p)
+        print(f"Tách {len(parents)} điều thành {len(texts)} khoản/điểm")
+    elif chunking != "article":
+        raise ValueError("chunking phải là 'article' hoặc 'clause'")
+    hashes = [embedder.content_hash(t) for t in texts]
 
     # Cấu hình tham số runtime
     embedder.EMBED_MODEL = model
     embedder.BATCH_SIZE = batch_size
+    model_name = model if provider == "openai" else embedder.model_id(provider, local_model)
+
+    # Chỉ embed các nội dung chưa có trong cache (khóa theo hash nội dung + model)
+    cache = embedder.EmbeddingCache(cache_dir or os.path.join(index_dir, "embed_cache"), model_name)
+    first_pos: dict = {}
+    for i, h in enumerate(hashes):
+        if h not in cache:
+            first_pos.setdefault(h, i)  # Nội dung trùng nhau chỉ embed một lần
+    missing = list(first_pos.values())
+    print(f"Tạo embeddings cho {len(missing)}/{len(texts)} tài liệu bằng provider: {provider}")
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        # Tạo embeddings theo provider
+        if provider == "openai":
+            last_saved = [time.monotonic()]
+
+            def checkpoint(start: int, batch_vectors) -> None:
+                # Ghi cache định kỳ để lần chạy sau (nếu bị dừng giữa chừng) chỉ embed phần còn thiếu
+                for i, vec in zip(missing[start : start + len(batch_vectors)], batch_vectors):
+                    cache.put(hashes[i], vec)
+                if time.monotonic() - last_saved[0] >= embed_scheduler.EMBED_CHECKPOINT_SECONDS:
+                    cache.save()
+                    last_saved[0] = time.monotonic()
 
-    # Tạo embeddings theo provider
-    if provider == "openai":
-        vectors = embedder.get_embeddings_openai(client, texts)  # type: ignore[arg-type]
-    elif provider == "local":
-        vectors = embedder.get_embeddings_local(local_model, texts)
+            try:
+                embedder.get_embeddings_openai(client, missing_texts, on_batch=checkpoint)  # type: ignore[arg-type]
+            finally:
+                cache.save()  # Giữ các batch đã xong kể cả khi lần chạy bị lỗi
+        else:
+            new_vectors = embedder.get_embeddings_local(local_model, missing_texts, provider)
+            for i, vec in zip(missing, new_vectors):
+                cache.put(hashes[i], vec)
+    vectors = cache.matrix(hashes)
+    cache.prune(hashes)
+    cache.save()
+
+    metadata: List[Dict[str, Any]] = [
+        {"id": d, "path": os.path.join(split_dir, name), "vid": embedder.doc_vector_id(d), "hash": h}
+        for d, name, h in zip(doc_ids, names, hashes)
+    ]
+    for item, p in zip(metadata, parent_of):
+        item["parent"] = p
+        item["parent_id"] = parent_ids[p]
+    ids = [item["vid"] for item in metadata]
+    index_params = embedder.default_index_params(
+        index_type, len(metadata), int(vectors.shape[1]), index_options.get("params")
+    )
+    manifest = {
+        "provider": provider,
+        "model": model_name,
+        "dim": int(vectors.shape[1]),
+        "count": len(metadata),
+        "chunking": chunking,
+        "index": {"type": index_type, "params": index_params},
+    }
+
+    # Cập nhật index cũ theo ID nếu cùng model và cấu hình, ngược lại dựng lại từ đầu
+    existing = None if rebuild else embedder.load_existing_index(base_dir or index_dir)
+    counts: Optional[Dict[str, int]] = None  # None = dựng lại từ đầu
+    if existing is not None and embedder.can_update_index(existing[0], existing[2], manifest):
+        index, old_metadata, _ = existing
+        print(f"Cập nhật FAISS index {index_type} theo ID (cosine similarity)...")
+        counts = embedder.update_faiss_index(index, old_metadata, metadata, vectors)
     else:
-        raise ValueError("provider phải là 'openai' hoặc 'local'")
+        # Xây dựng FAISS index với cosine similarity
+        print(f"Xây dựng FAISS index {index_type} {index_params} (cosine similarity)...")
+        index = embedder.build_faiss_index(vectors.copy(), ids=ids, index_type=index_type, params=index_params)
+    embedder.apply_search_params(index, index_params)
+
+    # Index nén: báo cáo bộ nhớ so với flat float32 và luôn đo recall
+    recall_k = int(index_options.get("recall_k") or 0)
+    if index_type in embedder.COMPRESSED_INDEX_TYPES:
+        flat_bytes = len(metadata) * int(vectors.shape[1]) * 4
+        used_bytes = embedder.index_memory_bytes(index)
+        manifest["index"]["memory"] = {"bytes": used_bytes, "flat_bytes": flat_bytes}
+        print(
+            f"Bộ nhớ index {index_type}: {used_bytes / 1024 ** 2:.2f} MB so với flat {flat_bytes / 1024 ** 2:.2f} MB "
+            f"(tiết kiệm {1 - used_bytes / max(flat_bytes, 1):.0%})"
+        )
+        recall_k = recall_k or 10
+
+    # Đo recall@k so với flat index (tìm kiếm chính xác, recall = 1)
+    if recall_k > 0:
+        recall = embedder.evaluate_recall(index, vectors, ids, k=recall_k)
+        manifest["index"]["recall_at_k"] = {"k": recall_k, "recall": round(recall, 4)}
+        print(f"Recall@{recall_k} so với flat index: {recall:.4f} ({recall - 1:+.4f})")
 
-    # Xây dựng FAISS index với cosine similarity
-    print("Xây dựng FAISS index (cosine similarity)...")
-    index = embedder.build_faiss_index(vectors)
-    metadata = [{"id": d, "path": os.path.join(split_dir, d)} for d in doc_ids]
-    embedder.save_index(index, metadata, index_dir)
+    embedder.save_index(index, metadata, index_dir, texts=texts, manifest=manifest, parents=parents)
+    if counts is None:
+        cached = sum(1 for h in hashes if h not in first_pos)
+        print(f"Dựng lại index: {len(metadata)} vector, {cached} embedding lấy từ cache (embed mới {len(missing)})")
+    else:
+        print(
+            f"Giữ nguyên {counts['reused']}, thêm {counts['added']}, xóa {counts['removed']} tài liệu "
+            f"(embed mới {len(missing)})"
+        )
     print(f"Đã lưu index và metadata vào: {index_dir}")
+    return len(metadata)
+
+
+def cmd_ask_batch(args: argparse.Namespace) -> None:
+    """Trả lời hàng loạt câu hỏi từ file JSONL, ghi kết quả JSONL theo thứ tự đầu vào (có thể chạy tiếp sau lỗi)"""
+    items = bulk.read_queries_file(args.queries_file)
+    out = sys.stdout
+    if args.output:
+        done = bulk.compact_results(args.output)
+        if done:
+            print(f"Bỏ qua {len(done)} câu hỏi đã có kết quả trong {args.output}", file=sys.stderr)
+        items = [item for item in items if item["id"] not in done]
+        out = open(args.output, "a", encoding="utf-8")
+
+    failed = 0
+    try:
+        for record in bulk.answer_stream(
+            items,
+            index_dir=args.index_dir,
+            top_k=args.top_k,
+            provider=args.provider,
+            local_model=args.local_model,
+            groq_model=args.groq_model,
+            laws=args.laws,
+            concurrency=args.concurrency,
+            mode=args.mode,
+            expand=args.expand,
+        ):
+            failed += bool(record.get("error"))
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()  # Ghi ngay từng dòng để có thể chạy tiếp nếu bị dừng giữa chừng
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Đã xử lý {len(items)} câu hỏi, lỗi {failed}", file=sys.stderr)
+
+
+def cmd_bench(args: argparse.Namespace) -> None:
+    """
+    Đo hiệu năng từng bước của pipeline và ghi kết quả JSON
+    Nếu có --baseline, so sánh và trả mã lỗi 1 khi có chỉ số kém đi quá --tolerance
+    """
+    queries = [item["query"] for item in bulk.read_queries_file(args.queries_file)] if args.queries_file \
+        else bench.DEFAULT_QUERIES
+    stages: Dict[str, Any] = {}
+
+    def run_stage(name: str, fn, *fn_args, **fn_kwargs) -> Any:
+        if name not in args.stages:
+            return None
+        print(f"[bench] {name}...", file=sys.stderr)
+        try:
+            stages[name] = fn(*fn_args, **fn_kwargs)
+        except Exception as e:
+            stages[name] = {"error": f"{type(e).__name__}: {e}"}
+        return stages[name]
+
+    if os.path.isfile(args.pdf_path):
+        run_stage("split", bench.bench_split, args.pdf_path, args.workers)
+
+    # Embedding: đo trên mẫu tài liệu đã tách; vector local dùng lại cho bài đo dựng index
+    texts = [content for _, content in embedder.read_documents(args.split_dir)][: bench.BENCH_EMBED_SAMPLE] \
+        if os.path.isdir(args.split_dir) else []
+    vectors = None
+    if texts and "embed" in args.stages:
+        stages["embed"] = {}
+        for provider in args.providers:
+            print(f"[bench] embed ({provider})...", file=sys.stderr)
+            try:
+                stages["embed"][provider], provider_vectors = bench.bench_embedding(texts, provider, args.local_model)
+                vectors = provider_vectors if vectors is None else vectors
+            except Exception as e:
+                stages["embed"][provider] = {"error": f"{type(e).__name__}: {e}"}
+    if vectors is not None:
+        run_stage("index", bench.bench_index_build, vectors, args.index_types)
+    if texts:
+        run_stage("onnx", bench.bench_onnx, texts, queries, args.local_model)
+
+    if os.path.isdir(args.index_dir):
+        run_stage(
+            "retrieval", bench.bench_retrieval, args.index_dir, queries, args.provider, args.local_model,
+            args.top_k, args.concurrency, args.iterations, args.mode,
+        )
+        run_stage(
+            "ask", bench.bench_ask, args.index_dir, queries, args.provider, args.local_model,
+            max(args.top_k), args.concurrency, args.iterations, args.mode,
+        )
+
+    results = {
+        "environment": bench.environment_info(),
+        "config": {
+            "queries": len(queries),
+            "iterations": args.iterations,
+            "top_k": args.top_k,
+            "concurrency": args.concurrency,
+            "provider": args.provider,
+            "local_model": args.local_model,
+            "mode": args.mode,
+        },
+        "stages": stages,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(stages, ensure_ascii=False, indent=2))
+    print(f"Đã ghi kết quả benchmark vào: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = bench.compare_with_baseline(results, baseline, args.tolerance)
+        if not regressions:
+            print(f"Không có chỉ số nào kém hơn baseline quá {args.tolerance:.0%}")
+            return
+        print(f"{len(regressions)} chỉ số kém hơn baseline quá {args.tolerance:.0%}:")
+        for r in regressions:
+            print(f"  {r['metric']}: {r['baseline']:g} -> {r['current']:g} ({r['change']:+.1%})")
+        sys.exit(1)
+
+
+def add_index_arguments(p: argparse.ArgumentParser) -> None:
+    """Thêm các tùy chọn loại FAISS index và tham số cho lệnh embed/all"""
+    p.add_argument("--index-type", choices=embedder.INDEX_TYPES, default="flat",
+                   help="flat (chính xác), ivf, hnsw, ivfpq (xấp xỉ), fp16, sq8, binary (nén vector)")
+    p.add_argument("--nlist", type=int, default=None, help="Số cụm IVF (mặc định ~4*sqrt(N))")
+    p.add_argument("--nprobe", type=int, default=None, help="Số cụm IVF duyệt khi truy vấn")
+    p.add_argument("--pq-m", type=int, default=None, help="Số sub-vector PQ (phải là ước của số chiều)")
+    p.add_argument("--pq-nbits", type=int, default=None, help="Số bit mỗi mã PQ")
+    p.add_argument("--hnsw-m", type=int, default=None, help="Số láng giềng mỗi nút HNSW")
+    p.add_argument("--ef-construction", type=int, default=None, help="efConstruction khi dựng HNSW")
+    p.add_argument("--ef-search", type=int, default=None, help="efSearch khi truy vấn HNSW")
+    p.add_argument("--rescore", type=int, default=None,
+                   help="Index binary: lấy top_k * rescore ứng viên Hamming để chấm điểm lại")
+    p.add_argument("--check-recall", type=int, default=0, metavar="K",
+                   help="Đo recall@K so với flat index sau khi dựng (0 = bỏ qua)")
+    p.add_argument("--chunking", choices=["article", "clause"], default="article",
+                   help="Mỗi điều một tài liệu (article) hoặc tách theo khoản/điểm (clause)")
+
+
+def add_openai_arguments(p: argparse.ArgumentParser) -> None:
+    """Thêm các tùy chọn gọi OpenAI embeddings (song song, rate limit, thử lại) cho lệnh embed/all"""
+    p.add_argument("--embed-concurrency", type=int, default=embed_scheduler.EMBED_CONCURRENCY,
+                   help="Số batch OpenAI gửi đồng thời")
+    p.add_argument("--rpm", type=int, default=embed_scheduler.EMBED_RPM,
+                   help="Giới hạn request mỗi phút (0 = không giới hạn)")
+    p.add_argument("--tpm", type=int, default=embed_scheduler.EMBED_TPM,
+                   help="Giới hạn token mỗi phút (0 = không giới hạn)")
+    p.add_argument("--max-retries", type=int, default=embed_scheduler.EMBED_MAX_RETRIES,
+                   help="Số lần thử lại mỗi batch khi gặp 429/timeout/lỗi server")
+    p.add_argument("--base-url", default=embedder.OPENAI_BASE_URL or None,
+                   help="Địa chỉ API tương thích OpenAI (ví dụ server giả lập)")
+
+
+def apply_openai_args(args: argparse.Namespace) -> None:
+    """Cấu hình tham số runtime cho scheduler embedding từ tham số dòng lệnh"""
+    embed_scheduler.EMBED_CONCURRENCY = args.embed_concurrency
+    embed_scheduler.EMBED_RPM = args.rpm
+    embed_scheduler.EMBED_TPM = args.tpm
+    embed_scheduler.EMBED_MAX_RETRIES = args.max_retries
+    embedder.OPENAI_BASE_URL = args.base_url or ""
+
+
+def index_options_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    """Gom các tùy chọn index từ CLI thành dict truyền cho cmd_embed"""
+    keys = ["nlist", "nprobe", "pq_m", "pq_nbits", "hnsw_m", "ef_construction", "ef_search", "rescore"]
+    return {
+        "type": args.index_type,
+        "params": {k: getattr(args, k) for k in keys},
+        "recall_k": args.check_recall,
+    }
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -72,35 +446,88 @@ def build_parser() -> argparse.ArgumentParser:
     # Lệnh split: Tách PDF thành các file điều luật
     p_split = sub.add_parser("split", help="Tách PDF thành các file Điều luật .txt")
     p_split.add_argument("--pdf-path", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/luat_lao_dong.pdf")
+    p_split.add_argument("--workers", type=int, default=None, help="Số tiến trình trích xuất PDF (mặc định: số CPU)")
     p_split.add_argument("--output-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/output_dieu_luat")
 
     # Lệnh embed: Tạo embeddings và lưu FAISS index
     p_embed = sub.add_parser("embed", help="Tạo embeddings và lưu FAISS index")
     p_embed.add_argument("--split-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/output_dieu_luat")
     p_embed.add_argument("--index-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index")
-    p_embed.add_argument("--provider", choices=["openai", "local"], default="openai")
+    p_embed.add_argument("--provider", choices=embedder.PROVIDERS, default="openai")
     p_embed.add_argument("--model", default="text-embedding-3-small")
     p_embed.add_argument("--batch-size", type=int, default=64)
     p_embed.add_argument("--local-model", default="sentence-transformers/all-MiniLM-L6-v2")
+    p_embed.add_argument("--rebuild", action="store_true", help="Bỏ qua index cũ, dựng lại toàn bộ")
+    p_embed.add_argument("--keep-versions", type=int, default=index_versions.KEEP_VERSIONS,
+                         help="Số phiên bản index giữ lại để rollback (tính cả bản mới)")
+    add_index_arguments(p_embed)
+    add_openai_arguments(p_embed)
 
     # Lệnh all: Chạy cả split và embed
     p_all = sub.add_parser("all", help="Chạy split rồi embed trong một lệnh")
     p_all.add_argument("--pdf-path", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/luat_lao_dong.pdf")
+    p_all.add_argument("--workers", type=int, default=None, help="Số tiến trình trích xuất PDF (mặc định: số CPU)")
     p_all.add_argument("--split-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/output_dieu_luat")
     p_all.add_argument("--index-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index")
-    p_all.add_argument("--provider", choices=["openai", "local"], default="openai")
+    p_all.add_argument("--provider", choices=embedder.PROVIDERS, default="openai")
     p_all.add_argument("--model", default="text-embedding-3-small")
     p_all.add_argument("--batch-size", type=int, default=64)
     p_all.add_argument("--local-model", default="sentence-transformers/all-MiniLM-L6-v2")
+    p_all.add_argument("--rebuild", action="store_true", help="Bỏ qua index cũ, dựng lại toàn bộ")
+    p_all.add_argument("--keep-versions", type=int, default=index_versions.KEEP_VERSIONS,
+                       help="Số phiên bản index giữ lại để rollback (tính cả bản mới)")
+    add_index_arguments(p_all)
+    add_openai_arguments(p_all)
+
+    # Lệnh versions/rollback: Quản lý các phiên bản index đã công bố
+    p_versions = sub.add_parser("versions", help="Liệt kê các phiên bản index (* = đang công bố)")
+    p_versions.add_argument("--index-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index")
+    p_rollback = sub.add_parser("rollback", help="Công bố lại một phiên bản index cũ")
+    p_rollback.add_argument("--index-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index")
+    p_rollback.add_argument("--version", default=None, help="Phiên bản cần công bố (mặc định: bản liền trước)")
 
     # Lệnh ask: Đặt câu hỏi sử dụng RAG
     p_ask = sub.add_parser("ask", help="Đặt câu hỏi (RAG)")
-    p_ask.add_argument("--query", required=True)
+    ask_input = p_ask.add_mutually_exclusive_group(required=True)
+    ask_input.add_argument("--query")
+    ask_input.add_argument("--queries-file", help="File JSONL các câu hỏi ({\"id\": ..., \"query\": ...} mỗi dòng)")
     p_ask.add_argument("--index-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index")
-    p_ask.add_argument("--provider", choices=["openai", "local"], default="local")
+    p_ask.add_argument("--provider", choices=embedder.PROVIDERS, default="local")
     p_ask.add_argument("--local-model", default="sentence-transformers/all-MiniLM-L6-v2")
     p_ask.add_argument("--top-k", type=int, default=5)
     p_ask.add_argument("--groq-model", default="llama-3.3-70b-versatile")
+    p_ask.add_argument("--laws", nargs="*", default=None, help="Chỉ tìm trong các luật (shard) này")
+    p_ask.add_argument("--mode", choices=retriever.RETRIEVAL_MODES, default=retriever.RETRIEVAL_MODE,
+                       help="Truy xuất bằng vector, BM25 (lexical) hoặc gộp cả hai bằng RRF (hybrid)")
+    p_ask.add_argument("--expand", choices=retriever.EXPAND_MODES, default=retriever.CLAUSE_EXPAND,
+                       help="Với index chia theo khoản: chỉ lấy khoản khớp (clause) hoặc cả điều (article)")
+    p_ask.add_argument("--output", default=None,
+                       help="File JSONL kết quả cho --queries-file (chạy lại sẽ bỏ qua câu đã trả lời)")
+    p_ask.add_argument("--concurrency", type=int, default=4, help="Số lời gọi LLM đồng thời khi chạy hàng loạt")
+
+    # Lệnh bench: Đo hiệu năng pipeline
+    p_bench = sub.add_parser("bench", help="Đo hiệu năng từng bước của pipeline, ghi JSON và so sánh baseline")
+    p_bench.add_argument("--stages", nargs="*", default=["split", "embed", "index", "retrieval", "ask"],
+                         choices=["split", "embed", "index", "retrieval", "ask", "onnx"],
+                         help="onnx: so sánh backend ONNX Runtime với PyTorch (độ lệch vector, tốc độ)")
+    p_bench.add_argument("--pdf-path", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/luat_lao_dong.pdf")
+    p_bench.add_argument("--workers", type=int, default=None, help="Số tiến trình trích xuất PDF (mặc định: số CPU)")
+    p_bench.add_argument("--split-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/output_dieu_luat")
+    p_bench.add_argument("--index-dir", default="/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index")
+    p_bench.add_argument("--provider", choices=embedder.PROVIDERS, default="local",
+                         help="Provider embedding câu hỏi khi đo truy xuất (phải khớp với index)")
+    p_bench.add_argument("--providers", nargs="*", choices=embedder.PROVIDERS, default=["local"],
+                         help="Các provider cần đo tốc độ embedding")
+    p_bench.add_argument("--local-model", default="sentence-transformers/all-MiniLM-L6-v2")
+    p_bench.add_argument("--index-types", nargs="*", choices=embedder.INDEX_TYPES, default=embedder.INDEX_TYPES)
+    p_bench.add_argument("--mode", choices=retriever.RETRIEVAL_MODES, default=retriever.RETRIEVAL_MODE)
+    p_bench.add_argument("--queries-file", default=None, help="File JSONL câu hỏi (mặc định: bộ câu hỏi có sẵn)")
+    p_bench.add_argument("--top-k", type=int, nargs="*", default=[1, 5, 10])
+    p_bench.add_argument("--concurrency", type=int, nargs="*", default=[1, 4, 16])
+    p_bench.add_argument("--iterations", type=int, default=100, help="Số lần gọi cho mỗi cấu hình truy xuất/ask")
+    p_bench.add_argument("--output", default="bench.json")
+    p_bench.add_argument("--baseline", default=None, help="File JSON kết quả trước đó để so sánh")
+    p_bench.add_argument("--tolerance", type=float, default=0.2, help="Tỉ lệ kém đi tối đa cho phép so với baseline")
 
     return parser
 
@@ -112,35 +539,51 @@ def main() -> None:
     args = parser.parse_args()
 
     if args.command == "split":
-        # Kiểm tra file PDF tồn tại
-        if not os.path.isfile(args.pdf_path):
+        # Kiểm tra file PDF (hoặc thư mục PDF) tồn tại
+        if not os.path.exists(args.pdf_path):
             raise FileNotFoundError(f"Không tìm thấy file PDF: {args.pdf_path}")
         print(f"Đọc PDF: {args.pdf_path}")
-        cmd_split(args.pdf_path, args.output_dir)
+        cmd_split(args.pdf_path, args.output_dir, args.workers)
         
     elif args.command == "embed":
-        cmd_embed(args.split_dir, args.index_dir, args.provider, args.model, args.batch_size, args.local_model)
+        apply_openai_args(args)
+        cmd_embed(
+            args.split_dir, args.index_dir, args.provider, args.model, args.batch_size, args.local_model,
+            args.rebuild, index_options_from_args(args), args.chunking, args.keep_versions,
+        )
         
     elif args.command == "all":
         # Chạy cả split và embed
-        if not os.path.isfile(args.pdf_path):
+        if not os.path.exists(args.pdf_path):
             raise FileNotFoundError(f"Không tìm thấy file PDF: {args.pdf_path}")
         print(f"Đọc PDF: {args.pdf_path}")
-        cmd_split(args.pdf_path, args.split_dir)
-        cmd_embed(args.split_dir, args.index_dir, args.provider, args.model, args.batch_size, args.local_model)
+        cmd_split(args.pdf_path, args.split_dir, args.workers)
+        apply_openai_args(args)
+        cmd_embed(
+            args.split_dir, args.index_dir, args.provider, args.model, args.batch_size, args.local_model,
+            args.rebuild, index_options_from_args(args), args.chunking, args.keep_versions,
+        )
         
+    elif args.command == "bench":
+        cmd_bench(args)
+
+    elif args.command == "versions":
+        cmd_versions(args.index_dir)
+
+    elif args.command == "rollback":
+        cmd_rollback(args.index_dir, args.version)
+
+    elif args.command == "ask" and args.queries_file:
+        # RAG hàng loạt: đọc câu hỏi từ file JSONL
+        cmd_ask_batch(args)
+
     elif args.command == "ask":
         # RAG: Truy xuất thông tin và tạo câu trả lời
-        import re
         contexts = []
-        
-        # Heuristic: Nếu query chứa "Điều <số>", chèn trực tiếp nội dung điều đó
-        m = re.search(r"(?i)(điều)\s+(\d+)", args.query)
-        if m:
-            article_num = m.group(2)
-            direct_text = retriever.try_get_article_by_number(args.index_dir, article_num)
-            if direct_text:
-                contexts.append(direct_text)
+
+        # Heuristic: Nếu query nhắc tới "Điều <số>", chèn trực tiếp nội dung các điều đó
+        for article in retriever.get_articles_in_query(args.index_dir, args.query, args.laws):
+            contexts.append(article)
 
         # Truy xuất tài liệu liên quan
         results = retriever.retrieve(
@@ -149,8 +592,11 @@ def main() -> None:
             top_k=args.top_k,
             provider=args.provider,
             local_model=args.local_model,
+            laws=args.laws,
+            mode=args.mode,
+            expand=args.expand,
         )
-        contexts.extend([r["text"] for r in results])
+        contexts.extend(results)
         
         # Tạo câu trả lời bằng LLM
         answer = generator.generate_answer(
@@ -62,6 +62,7 @@ function appendMsg(text, who = 'bot') {
   div.textContent = text;
   chat.appendChild(div);
   chat.scrollTop = chat.scrollHeight;
+  return div;
 }
 
 /**
@@ -77,6 +78,33 @@ function appendSources(sources) {
   chat.scrollTop = chat.scrollHeight;
 }
 
+/**
+ * Đọc luồng Server-Sent Events từ response fetch, gọi onEvent(event, data) cho mỗi sự kiện
+ */
+async function readSSE(res, onEvent) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder('utf-8');
+  let buffer = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    // Các sự kiện cách nhau bởi một dòng trống
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = 'message';
+      const dataLines = [];
+      for (const line of block.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+      }
+      if (dataLines.length) onEvent(event, JSON.parse(dataLines.join('\n')));
+    }
+  }
+}
+
 // Xử lý submit form chat
 form.addEventListener('submit', async (e) => {
   e.preventDefault();
@@ -90,21 +118,36 @@ form.addEventListener('submit', async (e) => {
   statusEl.hidden = false;
 
   try {
-    // Gọi API RAG
-    const res = await fetch(`${API_BASE}/ask`, {
+    // Gọi API RAG dạng streaming: nhận nguồn trước, sau đó từng token câu trả lời
+    const res = await fetch(`${API_BASE}/ask/stream`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
+      headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
       body: JSON.stringify({
         query: q,
         // Sử dụng defaults từ server cho index_dir, provider, etc.
       })
     });
-    const data = await res.json();
-    if (!res.ok) throw new Error(data.detail || 'Request failed');
-    
-    // Hiển thị câu trả lời và nguồn
-    appendMsg(data.answer || '(không có trả lời)');
-    appendSources(data.sources);
+    if (!res.ok) {
+      const data = await res.json().catch(() => ({}));
+      throw new Error(data.detail || 'Request failed');
+    }
+
+    // Tạo khung câu trả lời rỗng, cập nhật dần khi có token
+    const answerEl = appendMsg('', 'bot');
+    let answer = '';
+    await readSSE(res, (event, data) => {
+      if (event === 'sources') {
+        appendSources(data);
+        statusEl.hidden = true;
+      } else if (event === 'token') {
+        answer += data.text;
+        answerEl.textContent = answer;
+        chat.scrollTop = chat.scrollHeight;
+      } else if (event === 'error') {
+        throw new Error(data.detail || 'Stream failed');
+      }
+    });
+    if (!answer) answerEl.textContent = '(không có trả lời)';
   } catch (err) {
     appendMsg('Lỗi: ' + (err?.message || err), 'bot');
   } finally {
@@ -113,5 +156,3 @@ form.addEventListener('submit', async (e) => {
     statusEl.hidden = true;
   }
 });
-
-
@@ -0,0 +1,144 @@
+"""
+Module cache câu trả lời của LLM
+Khóa theo câu hỏi đã chuẩn hóa, các điều luật đã truy xuất, model và phiên bản index
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .retriever import normalize_query
+
+# Số câu trả lời tối đa giữ trong bộ nhớ (LRU) và trong file SQLite
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "512"))
+# Thời gian sống của một câu trả lời (giây)
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(24 * 3600)))
+# Đường dẫn file SQLite để giữ cache qua các lần khởi động lại (rỗng = chỉ dùng bộ nhớ)
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", "")
+
+
+def make_key(query: str, context_ids: List[str], model: str, index_version: str) -> str:
+    """
+    Tạo khóa cache từ câu hỏi đã chuẩn hóa, danh sách ID điều luật trong ngữ cảnh (giữ thứ tự),
+    model LLM và phiên bản index; index thay đổi thì khóa cũ không còn được dùng
+    """
+    payload = json.dumps(
+        [normalize_query(query), list(context_ids), model, index_version],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """Cache câu trả lời có TTL, loại bỏ theo LRU, tùy chọn lưu xuống SQLite"""
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL, path: str = ANSWER_CACHE_PATH) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._items: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._load()
+
+    def _load(self) -> None:
+        """Nạp lại vào bộ nhớ max_size câu trả lời mới nhất còn hạn (cũ trước mới sau để giữ thứ tự LRU)"""
+        if self.max_size <= 0:
+            return
+        now = time.time()
+        rows = self._db.execute(
+            "SELECT key, created, answer FROM answers ORDER BY created DESC LIMIT ?", (self.max_size,)
+        ).fetchall()
+        for key, created, answer in reversed(rows):
+            if not self._expired(created, now):
+                self._items[key] = (float(created), str(answer))
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl > 0 and now - created > self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        """Lấy câu trả lời còn hạn, None nếu chưa có hoặc đã hết hạn"""
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self._expired(item[0], now):
+                del self._items[key]
+                item = None
+            if item is None and self._db is not None:
+                row = self._db.execute("SELECT created, answer FROM answers WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[0], now):
+                    item = (float(row[0]), str(row[1]))
+                    self._store_locked(key, item)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, answer: str) -> None:
+        """Lưu câu trả lời vào cache (bộ nhớ và SQLite nếu bật)"""
+        if self.max_size <= 0 or not answer:
+            return
+        item = (time.time(), answer)
+        with self._lock:
+            self._store_locked(key, item)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO answers (key, answer, created) VALUES (?, ?, ?)", (key, answer, item[0])
+                )
+                if self.ttl > 0:
+                    self._db.execute("DELETE FROM answers WHERE created < ?", (item[0] - self.ttl,))
+                # Giới hạn cả bảng SQLite theo max_size, không chỉ phần trong bộ nhớ
+                self._db.execute(
+                    "DELETE FROM answers WHERE key NOT IN (SELECT key FROM answers ORDER BY created DESC LIMIT ?)",
+                    (self.max_size,),
+                )
+                self._db.commit()
+
+    def _store_locked(self, key: str, item: Tuple[float, str]) -> None:
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        """Xóa toàn bộ cache"""
+        with self._lock:
+            self._items.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Thống kê cache câu trả lời"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "disk": bool(self._db is not None),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+# Cache dùng chung cho toàn tiến trình
+answer_cache = AnswerCache()
@@ -3,20 +3,115 @@ FastAPI REST API cho RAG System
 Cung cấp endpoint để chat và truy xuất thông tin pháp luật
 """
 
-from typing import List, Optional
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
-from . import retriever, generator
-import re
+from . import bulk, retriever, generator, index_cache, index_versions, lazy, metrics
+from .answer_cache import answer_cache, make_key
+from .batcher import batcher
 
 
 load_dotenv()
-app = FastAPI(title="RAG API - Hệ thống truy xuất pháp luật", version="1.0.0")
+
+# Executor giới hạn cho phần việc truy xuất (tra cứu điều luật, encode và tìm kiếm của các lô trong batcher), không chặn event loop
+RETRIEVAL_WORKERS = int(os.environ.get("RETRIEVAL_WORKERS", str(min(8, os.cpu_count() or 1))))
+retrieval_executor = ThreadPoolExecutor(max_workers=max(1, RETRIEVAL_WORKERS), thread_name_prefix="retrieval")
+batcher.executor = retrieval_executor
+
+# Thư mục FAISS index mặc định
+DEFAULT_INDEX_DIR = "/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index"
+
+# Tải trước khi khởi động: index, provider và model embedding sẽ dùng cho request
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "0").lower() in ("1", "true", "yes")
+WARMUP_INDEX_DIR = os.environ.get("WARMUP_INDEX_DIR", DEFAULT_INDEX_DIR)
+WARMUP_PROVIDER = os.environ.get("WARMUP_PROVIDER", "local")
+WARMUP_LOCAL_MODEL = os.environ.get("WARMUP_LOCAL_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+
+# Trạng thái sẵn sàng cho /ready: "warming" trong lúc tải trước (ngay từ khi khởi động), "ready" khi xong, "failed" nếu lỗi
+# reload_errors: index_dir -> lỗi lần reload tự động gần nhất (vẫn phục vụ phiên bản cũ)
+readiness: Dict[str, Any] = {
+    "status": "warming" if WARMUP_ON_STARTUP else "ready", "error": "", "timings": {}, "reload_errors": {},
+}
+# Số tài liệu tối đa một request được lấy (top_k)
+MAX_TOP_K = int(os.environ.get("MAX_TOP_K", "50"))
+# Chu kỳ (giây) kiểm tra phiên bản index mới được công bố để tự reload; 0 = chỉ reload qua /index/reload
+INDEX_WATCH_INTERVAL = float(os.environ.get("INDEX_WATCH_INTERVAL", "5"))
+
+
+def warm_up() -> Dict[str, float]:
+    """Tải trước index, model embedding và SDK của LLM theo cấu hình WARMUP_*"""
+    timings = retriever.warm_up(WARMUP_INDEX_DIR, WARMUP_PROVIDER, WARMUP_LOCAL_MODEL)
+    start = time.perf_counter()
+    lazy.load(generator.groq)
+    timings["llm_import"] = time.perf_counter() - start
+    return {name: round(seconds, 4) for name, seconds in timings.items()}
+
+
+async def run_warm_up() -> None:
+    readiness.update(status="warming", error="", timings={})
+    try:
+        timings = await asyncio.get_running_loop().run_in_executor(retrieval_executor, warm_up)
+    except Exception as e:
+        readiness.update(status="failed", error=str(e))
+        return
+    readiness.update(status="ready", timings=timings)
+
+
+async def reload_index(index_dir: str) -> Dict[str, Any]:
+    """Tải phiên bản index vừa công bố trong executor rồi mới chuyển sang, request không phải chờ tải"""
+    result = await asyncio.get_running_loop().run_in_executor(retrieval_executor, retriever.reload_index, index_dir)
+    readiness["reload_errors"].pop(index_dir, None)
+    return result
+
+
+async def watch_index_versions() -> None:
+    """Định kỳ kiểm tra CURRENT của các index đang phục vụ, có phiên bản mới thì reload ở nền"""
+    while True:
+        await asyncio.sleep(INDEX_WATCH_INTERVAL)
+        for index_dir, version in index_versions.pinned().items():
+            try:
+                if index_versions.read_current(index_dir) != version:
+                    await reload_index(index_dir)
+                else:
+                    readiness["reload_errors"].pop(index_dir, None)  # Bản lỗi đã bị thay (rollback/công bố lại)
+            except Exception as e:
+                # Bản mới lỗi thì tiếp tục phục vụ bản cũ (vẫn ready), báo lỗi qua /ready; lần kiểm tra sau thử lại
+                readiness["reload_errors"][index_dir] = str(e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Vòng đời ứng dụng: tải trước index/model ở nền khi bật WARMUP_ON_STARTUP (server nhận request ngay,
+    /ready báo 503 tới khi xong), theo dõi phiên bản index mới (INDEX_WATCH_INTERVAL),
+    đóng LLM client dùng chung và executor khi tắt
+    """
+    tasks = []
+    if WARMUP_ON_STARTUP:
+        tasks.append(asyncio.create_task(run_warm_up()))
+    if INDEX_WATCH_INTERVAL > 0:
+        tasks.append(asyncio.create_task(watch_index_versions()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await generator.aclose_clients()
+    retrieval_executor.shutdown(wait=False)
+
+
+app = FastAPI(title="RAG API - Hệ thống truy xuất pháp luật", version="1.0.0", lifespan=lifespan)
 
 # CORS: Cho phép truy cập từ trình duyệt web
 app.add_middleware(
@@ -34,11 +129,41 @@ app.mount("/app", StaticFiles(directory="/Users/coinhat/Documents/PROJECT/AI/RAG
 class AskRequest(BaseModel):
     """Request model cho endpoint /ask"""
     query: str = Field(..., description="Câu hỏi người dùng")
-    index_dir: str = "/Users/coinhat/Documents/PROJECT/AI/RAG/bai6/faiss_index"
-    provider: str = Field("local", description="'openai' hoặc 'local'")
+    index_dir: str = DEFAULT_INDEX_DIR
+    provider: str = Field("local", description="'openai', 'local' (PyTorch) hoặc 'onnx' (ONNX Runtime)")
     local_model: str = "sentence-transformers/all-MiniLM-L6-v2"
-    top_k: int = 5
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K, description="Số tài liệu truy xuất")
     groq_model: str = "llama-3.3-70b-versatile"
+    laws: Optional[List[str]] = Field(None, description="Chỉ tìm trong các luật (shard) này, mặc định tất cả")
+    mode: str = Field(retriever.RETRIEVAL_MODE, description="'vector', 'lexical' (BM25) hoặc 'hybrid' (RRF)")
+    expand: str = Field(retriever.CLAUSE_EXPAND, description="Index chia theo khoản: 'clause' (chỉ khoản khớp) hoặc 'article' (cả điều)")
+    debug: bool = Field(False, description="Trả kèm thời gian từng bước xử lý (trace) trong response")
+
+
+class BatchQuery(BaseModel):
+    """Một câu hỏi trong request /ask/batch"""
+    id: Optional[str] = None
+    query: str
+
+
+class AskBatchRequest(BaseModel):
+    """Request model cho endpoint /ask/batch"""
+    queries: List[BatchQuery] = Field(..., description="Danh sách câu hỏi, kết quả trả về theo đúng thứ tự")
+    index_dir: str = DEFAULT_INDEX_DIR
+    provider: str = Field("local", description="'openai', 'local' (PyTorch) hoặc 'onnx' (ONNX Runtime)")
+    local_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K, description="Số tài liệu truy xuất")
+    groq_model: str = "llama-3.3-70b-versatile"
+    laws: Optional[List[str]] = None
+    mode: str = Field(retriever.RETRIEVAL_MODE, description="'vector', 'lexical' (BM25) hoặc 'hybrid' (RRF)")
+    expand: str = Field(retriever.CLAUSE_EXPAND, description="Index chia theo khoản: 'clause' (chỉ khoản khớp) hoặc 'article' (cả điều)")
+    concurrency: int = Field(4, ge=1, le=64, description="Số lời gọi LLM đồng thời tối đa")
+
+
+class IndexVersionRequest(BaseModel):
+    """Request model cho endpoint /index/reload và /index/rollback"""
+    index_dir: str = DEFAULT_INDEX_DIR
+    version: Optional[str] = Field(None, description="Phiên bản cần rollback tới, mặc định bản liền trước")
 
 
 class Source(BaseModel):
@@ -46,6 +171,7 @@ class Source(BaseModel):
     rank: int
     score: float
     id: str
+    law: str = ""
     path: str
 
 
@@ -53,53 +179,253 @@ class AskResponse(BaseModel):
     """Response model cho endpoint /ask"""
     answer: str
     sources: List[Source]
+    cached: bool = Field(False, description="True nếu câu trả lời lấy từ cache")
+    trace: Optional[Dict[str, Any]] = Field(None, description="Thời gian từng bước (chỉ khi debug=true)")
+
+
+def direct_articles(req: AskRequest) -> Tuple[List[Dict[str, str]], str]:
+    """Các điều luật được nhắc tới bằng số trong câu hỏi, kèm phiên bản index hiện tại"""
+    # Heuristic: Nếu query nhắc tới "Điều <số>", chèn trực tiếp nội dung các điều đó
+    articles = retriever.get_articles_in_query(req.index_dir, req.query or "", req.laws)
+    return articles, retriever.index_version(req.index_dir, req.laws)
 
 
-@app.post("/ask", response_model=AskResponse)
-def ask(req: AskRequest):
+async def retrieve_contexts(req: AskRequest) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], str]:
+    """
+    Lấy ngữ cảnh cho câu hỏi: điều luật nhắc tới trực tiếp + kết quả tìm kiếm (vector, BM25 hoặc hybrid)
+    Tìm kiếm đi qua batcher (gom lô với các request đồng thời) hoặc executor giới hạn, không chặn event loop
+    Trả về (contexts, results, khóa cache câu trả lời)
+    """
+    loop = asyncio.get_running_loop()
+    search_args = (req.query, req.index_dir, req.top_k, req.provider, req.local_model, req.laws, req.mode, req.expand)
+    if batcher.enabled:
+        search = asyncio.wrap_future(batcher.submit(*search_args))
+    else:
+        search = loop.run_in_executor(retrieval_executor, metrics.bind(retriever.retrieve), *search_args)
+    (articles, version), results = await asyncio.gather(
+        loop.run_in_executor(retrieval_executor, metrics.bind(direct_articles), req), search
+    )
+
+    # Generator khử trùng lặp theo ID và xếp ngữ cảnh trong ngân sách token
+    contexts = articles + results
+    context_ids = [a["id"] for a in articles] + [r.get("id", "") for r in results]
+    cache_key = make_key(req.query, context_ids, req.groq_model, version)
+    return contexts, results, cache_key
+
+
+def to_sources(results: List[Dict[str, str]]) -> List[Source]:
+    """Chuẩn bị thông tin nguồn cho response"""
+    return [
+        Source(
+            rank=int(r.get("rank", 0)),
+            score=float(r.get("score", 0.0)),
+            id=str(r.get("id", "")),
+            law=str(r.get("law", "")),
+            path=str(r.get("path", "")),
+        )
+        for r in results
+    ]
+
+
+@app.post("/ask", response_model=AskResponse, response_model_exclude_none=True)
+async def ask(req: AskRequest, response: Response):
     """
     Endpoint chính cho RAG chat
     Nhận câu hỏi, truy xuất thông tin liên quan và tạo câu trả lời
+    Truy xuất chạy trong executor giới hạn, lời gọi LLM là async nên một worker phục vụ được nhiều request
+    Thời gian từng bước trả về trong header Server-Timing (và trong trường trace khi debug=true)
     """
+    started = time.perf_counter()
+    status = "error"
+    trace, token = metrics.start_trace(force=req.debug)
     try:
-        contexts: list[str] = []
-        
-        # Heuristic: Nếu query chứa "Điều <số>", chèn trực tiếp nội dung điều đó
-        m = re.search(r"(?i)(điều)\s+(\d+)", req.query or "")
-        if m:
-            direct_text = retriever.try_get_article_by_number(req.index_dir, m.group(2))
-            if direct_text:
-                contexts.append(direct_text)
-
-        # Truy xuất tài liệu liên quan từ FAISS index
-        results = retriever.retrieve(
-            query=req.query,
-            index_dir=req.index_dir,
-            top_k=req.top_k,
-            provider=req.provider,
-            local_model=req.local_model,
-        )
-        contexts.extend([r.get("text", "") for r in results])
-        
-        # Tạo câu trả lời bằng LLM
-        answer = generator.generate_answer(
-            query=req.query,
-            contexts=contexts,
-            model=req.groq_model,
-        )
-        
-        # Chuẩn bị thông tin nguồn cho response
-        sources: List[Source] = [
-            Source(
-                rank=int(r.get("rank", 0)),
-                score=float(r.get("score", 0.0)),
-                id=str(r.get("id", "")),
-                path=str(r.get("path", "")),
+        contexts, results, cache_key = await retrieve_contexts(req)
+
+        # Câu hỏi và ngữ cảnh đã gặp: trả lời từ cache, không gọi LLM
+        with metrics.stage("answer_cache"):
+            cached_answer = answer_cache.get(cache_key)
+        if cached_answer is not None:
+            out = AskResponse(answer=cached_answer, sources=to_sources(results), cached=True)
+        else:
+            # Tạo câu trả lời bằng LLM
+            answer = await generator.generate_answer_async(
+                query=req.query,
+                contexts=contexts,
+                model=req.groq_model,
             )
-            for r in results
-        ]
-        return AskResponse(answer=answer or "", sources=sources)
+            answer_cache.put(cache_key, answer or "")
+            out = AskResponse(answer=answer or "", sources=to_sources(results))
+        if trace is not None:
+            response.headers["Server-Timing"] = trace.server_timing()
+            if req.debug:
+                out.trace = trace.to_dict()
+        status = "ok"
+        return out
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        metrics.observe_request("/ask", started, status)
+        metrics.end_trace(token)
+
+
+def sse_event(event: str, data) -> str:
+    """Định dạng một sự kiện Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest):
+    """
+    Phiên bản streaming (SSE) của /ask
+    Gửi sự kiện "sources" ngay sau khi truy xuất xong, sau đó các sự kiện "token" khi LLM sinh ra, cuối cùng là "done"
+    Header Server-Timing chỉ gồm phần truy xuất; với debug=true sự kiện "done" (hoặc "error") kèm trace đầy đủ
+    Thời gian request được ghi vào /metrics khi stream kết thúc, kể cả khi LLM lỗi hoặc client ngắt kết nối
+    """
+    started = time.perf_counter()
+    trace, token = metrics.start_trace(force=req.debug)
+    try:
+        contexts, results, cache_key = await retrieve_contexts(req)
     except Exception as e:
+        metrics.observe_request("/ask/stream", started, "error")
         raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        metrics.end_trace(token)
+
+    def final_event(event: str, data: Dict[str, Any]) -> str:
+        if req.debug and trace is not None:
+            data["trace"] = trace.to_dict()
+        return sse_event(event, data)
+
+    async def events() -> AsyncIterator[str]:
+        # Stream chạy trong task riêng sau khi endpoint trả về: gắn lại trace để đo các bước của LLM
+        metrics.use_trace(trace)
+        status = "error"
+        try:
+            yield sse_event("sources", jsonable_encoder(to_sources(results)))
+            with metrics.stage("answer_cache"):
+                cached_answer = answer_cache.get(cache_key)
+            if cached_answer is not None:
+                yield sse_event("token", {"text": cached_answer})
+                status = "ok"
+                yield final_event("done", {"cached": True})
+                return
+
+            parts: List[str] = []
+            try:
+                async for delta in generator.stream_answer_async(
+                    query=req.query,
+                    contexts=contexts,
+                    model=req.groq_model,
+                ):
+                    parts.append(delta)
+                    yield sse_event("token", {"text": delta})
+            except Exception as e:
+                yield final_event("error", {"detail": str(e)})
+                return
+            answer_cache.put(cache_key, "".join(parts))
+            status = "ok"
+            yield final_event("done", {"cached": False})
+        except (GeneratorExit, asyncio.CancelledError):
+            if status != "ok":
+                status = "cancelled"
+            raise
+        finally:
+            metrics.observe_request("/ask/stream", started, status)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if trace is not None:
+        headers["Server-Timing"] = trace.server_timing()
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+
+@app.post("/ask/batch")
+async def ask_batch(req: AskBatchRequest):
+    """
+    Trả lời hàng loạt câu hỏi: embed cả lô thành ma trận, tìm kiếm FAISS một lần,
+    sinh câu trả lời song song có giới hạn và stream kết quả dạng JSONL theo thứ tự đầu vào
+    Câu hỏi lỗi có trường "error" để client gửi lại
+    """
+    items = [{"id": q.id if q.id is not None else str(i), "query": q.query} for i, q in enumerate(req.queries)]
+    started = time.perf_counter()
+
+    async def lines() -> AsyncIterator[str]:
+        status = "error"
+        try:
+            async for record in bulk.answer_stream_async(
+                items,
+                index_dir=req.index_dir,
+                top_k=req.top_k,
+                provider=req.provider,
+                local_model=req.local_model,
+                groq_model=req.groq_model,
+                laws=req.laws,
+                concurrency=req.concurrency,
+                executor=retrieval_executor,
+                mode=req.mode,
+                expand=req.expand,
+            ):
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+            status = "ok"
+        except (GeneratorExit, asyncio.CancelledError):
+            status = "cancelled"
+            raise
+        finally:
+            metrics.observe_request("/ask/batch", started, status)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/laws")
+def list_laws(index_dir: str = DEFAULT_INDEX_DIR):
+    """Liệt kê các luật (shard) có trong (phiên bản đang phục vụ của) index"""
+    return {"laws": index_cache.load_shards(index_versions.active_dir(index_dir))}
+
+
+@app.get("/index/versions")
+def list_index_versions(index_dir: str = DEFAULT_INDEX_DIR):
+    """Các phiên bản index: bản đã công bố (current), bản đang phục vụ (active) và các bản giữ để rollback"""
+    return index_versions.describe(index_dir)
+
+
+@app.post("/index/reload")
+async def reload(req: IndexVersionRequest):
+    """Chuyển sang phiên bản index vừa công bố: tải xong ở nền rồi mới đổi, không gián đoạn request đang chạy"""
+    try:
+        return await reload_index(req.index_dir)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/index/rollback")
+async def rollback(req: IndexVersionRequest):
+    """Công bố lại phiên bản cũ (mặc định bản liền trước) và chuyển sang ngay"""
+    try:
+        index_versions.rollback(req.index_dir, req.version)
+        return await reload_index(req.index_dir)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/stats")
+def stats():
+    """Thống kê cache index và cache embedding câu hỏi"""
+    return {
+        "index_cache": index_cache.registry.stats(),
+        "query_cache": retriever.query_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "batcher": batcher.stats(),
+        "metrics": metrics.snapshot(),
+    }
+
+
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 khi đã tải xong (hoặc không bật warm-up), 503 khi đang tải trước hoặc tải lỗi"""
+    status_code = 200 if readiness["status"] == "ready" else 503
+    return JSONResponse(readiness, status_code=status_code)
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    """Histogram thời gian từng bước và từng endpoint ở định dạng Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,270 @@
+"""
+Module gom lô (micro-batching) câu hỏi giữa các request đồng thời
+Các câu hỏi đến trong vài mili-giây được encode một lần và tìm kiếm bằng một lời gọi index.search
+Luồng batcher chỉ gom lô, phần encode/tìm kiếm của từng nhóm chạy trong executor nên nhóm chậm không chặn nhóm khác
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import metrics, retriever
+
+# Số câu hỏi tối đa trong một lô
+BATCH_MAX_SIZE = int(os.environ.get("QUERY_BATCH_MAX_SIZE", "32"))
+# Thời gian chờ tối đa (ms) để gom thêm câu hỏi sau câu đầu tiên của lô; 0 = tắt gom lô
+# Chỉ chờ khi đã có câu hỏi khác trong hàng đợi, request đến một mình được xử lý ngay
+BATCH_MAX_WAIT_MS = float(os.environ.get("QUERY_BATCH_WAIT_MS", "3"))
+# Số luồng xử lý lô khi không được giao executor dùng chung (API dùng retrieval_executor)
+BATCH_WORKERS = int(os.environ.get("QUERY_BATCH_WORKERS", "4"))
+# Số mẫu gần nhất dùng để tính thống kê độ trễ
+STATS_WINDOW = 1024
+
+
+class _Request:
+    """Một câu hỏi đang chờ trong hàng đợi của batcher"""
+
+    __slots__ = ("query", "index_dir", "top_k", "provider", "local_model", "laws", "mode", "expand", "future", "enqueued_at", "trace")
+
+    def __init__(self, query: str, index_dir: str, top_k: int, provider: str, local_model: str,
+                 laws: Optional[List[str]], mode: str, expand: str) -> None:
+        self.query = query
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.provider = provider
+        self.local_model = local_model
+        self.laws = laws
+        self.mode = mode
+        self.expand = expand
+        self.future: "Future[List[Dict[str, str]]]" = Future()
+        self.enqueued_at = time.perf_counter()
+        # Trace của request gửi câu hỏi (nếu có), nhận lại thời gian các bước đã chạy cho cả lô
+        self.trace = metrics.current_trace()
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    return float(np.percentile(values, pct)) if values else 0.0
+
+
+class QueryBatcher:
+    """
+    Gom các câu hỏi đến gần nhau thành lô: encode một lần cho mỗi (provider, model),
+    tìm kiếm một lần cho mỗi (index_dir, laws), rồi trả kết quả về đúng request gọi
+    Câu hỏi lexical không qua hàng đợi mà tìm kiếm thẳng trong executor
+    """
+
+    def __init__(self, max_batch: int = BATCH_MAX_SIZE, max_wait_ms: float = BATCH_MAX_WAIT_MS,
+                 executor: Optional[Executor] = None) -> None:
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        # Executor chạy encode/tìm kiếm của các lô; None = tự tạo pool BATCH_WORKERS luồng khi cần
+        # Không gọi retrieve (chặn chờ kết quả) từ chính các luồng của executor này
+        self.executor = executor
+        self._own_executor: Optional[ThreadPoolExecutor] = None
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes: Deque[int] = deque(maxlen=STATS_WINDOW)
+        self._wait_ms: Deque[float] = deque(maxlen=STATS_WINDOW)
+        self._latency_ms: Deque[float] = deque(maxlen=STATS_WINDOW)
+        self.batches = 0
+        self.queries = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch > 1 and self.max_wait > 0
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+                self._thread.start()
+
+    def _executor(self) -> Executor:
+        if self.executor is not None:
+            return self.executor
+        with self._start_lock:
+            if self._own_executor is None:
+                self._own_executor = ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS), thread_name_prefix="query-batch")
+            return self._own_executor
+
+    def submit(self, query: str, index_dir: str, top_k: int, provider: str, local_model: str,
+               laws: Optional[List[str]] = None,
+               mode: str = retriever.RETRIEVAL_MODE,
+               expand: str = retriever.CLAUSE_EXPAND) -> "Future[List[Dict[str, str]]]":
+        """Đưa câu hỏi vào hàng đợi, trả về Future chứa kết quả retrieve"""
+        if mode == "lexical":
+            # Không có bước encode để dùng chung: tìm kiếm BM25 thẳng trong executor
+            return self._executor().submit(
+                metrics.bind(retriever.retrieve), query, index_dir, top_k, provider, local_model, laws, mode, expand
+            )
+        self._ensure_started()
+        req = _Request(query, index_dir, top_k, provider, local_model, laws, mode, expand)
+        self._queue.put(req)
+        return req.future
+
+    def retrieve(self, query: str, index_dir: str, top_k: int, provider: str, local_model: str,
+                 laws: Optional[List[str]] = None,
+                 mode: str = retriever.RETRIEVAL_MODE,
+                 expand: str = retriever.CLAUSE_EXPAND) -> List[Dict[str, str]]:
+        """Tương đương retriever.retrieve nhưng đi qua batcher (chặn tới khi có kết quả)"""
+        if not self.enabled:
+            return retriever.retrieve(query, index_dir, top_k, provider, local_model, laws, mode, expand)
+        return self.submit(query, index_dir, top_k, provider, local_model, laws, mode, expand).result()
+
+    def _collect(self) -> List[_Request]:
+        """
+        Chờ câu hỏi đầu tiên, sau đó gom thêm trong max_wait hoặc tới khi đủ max_batch
+        Hàng đợi trống thì xử lý ngay; câu hỏi đến trong lúc xử lý sẽ tự dồn thành lô sau
+        """
+        batch = [self._queue.get()]
+        if self._queue.empty():
+            return batch
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            for req in batch:
+                metrics.record("queue_wait", started - req.enqueued_at)
+                if req.trace is not None:
+                    req.trace.add("queue_wait", started - req.enqueued_at, req.enqueued_at)
+            with self._stats_lock:
+                self.batches += 1
+                self.queries += len(batch)
+                self._batch_sizes.append(len(batch))
+                for req in batch:
+                    self._wait_ms.append((started - req.enqueued_at) * 1000.0)
+            # Encode một lần cho mỗi nhóm (provider, model), mỗi nhóm chạy trong executor riêng rẽ
+            by_model: Dict[Tuple[str, str], List[_Request]] = {}
+            for req in batch:
+                by_model.setdefault((req.provider, req.local_model), []).append(req)
+            for reqs in by_model.values():
+                self._dispatch(self._encode, reqs)
+
+    def _dispatch(self, fn: Callable[..., None], reqs: List[_Request], *args: Any) -> None:
+        try:
+            self._executor().submit(self._traced, fn, reqs, *args)
+        except Exception as exc:  # Executor đã tắt
+            self._fail(reqs, exc)
+
+    def _traced(self, fn: Callable[..., None], reqs: List[_Request], *args: Any) -> None:
+        """
+        Chạy một phần việc của lô: các bước được ghi vào histogram một lần và vào trace riêng của phần việc,
+        trace này được chép sang trace của từng request trước khi trả kết quả
+        """
+        batch_trace = metrics.Trace() if any(req.trace is not None for req in reqs) else None
+        token = metrics.use_trace(batch_trace)
+        try:
+            fn(reqs, *args)
+        except Exception as exc:  # Lỗi không mong đợi: trả lỗi cho mọi request chưa có kết quả
+            self._fail(reqs, exc)
+        finally:
+            metrics.end_trace(token)
+
+    def _merge_trace(self, reqs: List[_Request]) -> None:
+        batch_trace = metrics.current_trace()
+        if batch_trace is None:
+            return
+        for r in reqs:
+            if r.trace is not None:
+                r.trace.merge(batch_trace)
+
+    def _finish(self, req: _Request, results: Optional[List[Dict[str, str]]] = None,
+                exc: Optional[BaseException] = None) -> None:
+        if req.future.done():
+            return
+        if exc is not None:
+            req.future.set_exception(exc)
+        else:
+            req.future.set_result(results)
+        with self._stats_lock:
+            self._latency_ms.append((time.perf_counter() - req.enqueued_at) * 1000.0)
+
+    def _fail(self, reqs: List[_Request], exc: BaseException) -> None:
+        for r in reqs:
+            self._finish(r, exc=exc)
+
+    def _encode(self, reqs: List[_Request]) -> None:
+        """Encode các câu hỏi cùng (provider, model) một lần rồi tìm kiếm theo từng nhóm index"""
+        provider, local_model = reqs[0].provider, reqs[0].local_model
+        try:
+            q = retriever.embed_queries([r.query for r in reqs], provider, local_model)
+        except Exception as exc:
+            self._fail(reqs, exc)
+            return
+        self._merge_trace(reqs)
+        vectors = {id(r): row for r, row in zip(reqs, q)}
+
+        # Tìm kiếm một lần cho mỗi nhóm (index_dir, laws, mode, expand, top_k): top_k ảnh hưởng tới số ứng viên
+        # hybrid/RRF, kết quả IVF/HNSW và phần lấy dư khi mở rộng về điều, nên không gộp các top_k khác nhau
+        by_index: Dict[Tuple[str, Tuple[str, ...], str, str, int], List[_Request]] = {}
+        for req in reqs:
+            key = (req.index_dir, tuple(req.laws or ()), req.mode, req.expand, req.top_k)
+            by_index.setdefault(key, []).append(req)
+
+        # Nhóm đầu tìm ngay trên luồng này, các nhóm khác (index khác, có thể phải tải nguội) chạy song song
+        groups = [
+            (group, np.ascontiguousarray(np.vstack([vectors[id(r)] for r in group]), dtype=np.float32))
+            for group in by_index.values()
+        ]
+        for group, matrix in groups[1:]:
+            self._dispatch(self._search, group, matrix)
+        self._traced(self._search, groups[0][0], groups[0][1])
+
+    def _search(self, reqs: List[_Request], q: np.ndarray) -> None:
+        first = reqs[0]
+        try:
+            rows = retriever.search_batch(
+                first.index_dir, q, first.top_k, first.laws or None, [r.query for r in reqs], first.mode, first.expand
+            )
+        except Exception as exc:
+            self._fail(reqs, exc)
+            return
+        self._merge_trace(reqs)
+        for r, results in zip(reqs, rows):
+            self._finish(r, results)
+
+    def stats(self) -> Dict[str, Any]:
+        """Thống kê kích thước lô và độ trễ (ms) trên các mẫu gần nhất"""
+        with self._stats_lock:
+            sizes = list(self._batch_sizes)
+            waits = list(self._wait_ms)
+            latencies = list(self._latency_ms)
+            batches, queries = self.batches, self.queries
+        return {
+            "enabled": self.enabled,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": batches,
+            "queries": queries,
+            "avg_batch_size": (queries / batches) if batches else 0.0,
+            "max_batch_size_seen": max(sizes) if sizes else 0,
+            "queue_wait_ms": {"p50": _percentile(waits, 50), "p95": _percentile(waits, 95)},
+            "latency_ms": {
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "p99": _percentile(latencies, 99),
+            },
+        }
+
+
+# Batcher dùng chung cho toàn tiến trình
+batcher = QueryBatcher()
@@ -0,0 +1,319 @@
+"""
+Module benchmark cho các bước của pipeline RAG
+Đo thời gian trích xuất PDF, tách điều, embedding, dựng index, độ trễ truy xuất và /ask end-to-end (LLM giả lập),
+so sánh backend ONNX Runtime với PyTorch (độ lệch vector, tốc độ)
+Kết quả ghi ra JSON để so sánh với baseline đã lưu
+"""
+
+import asyncio
+import os
+import platform
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import embedder, retriever, splitter
+
+# Bộ câu hỏi mặc định khi không truyền file câu hỏi
+DEFAULT_QUERIES = [
+    "Thời giờ làm thêm tối đa trong một năm là bao nhiêu?",
+    "Người lao động được nghỉ hằng năm bao nhiêu ngày?",
+    "Điều kiện đơn phương chấm dứt hợp đồng lao động",
+    "Trợ cấp thôi việc được tính như thế nào?",
+    "Quyền và nghĩa vụ của người sử dụng lao động",
+    "Thử việc tối đa bao nhiêu ngày?",
+    "Điều 35 quy định gì?",
+    "Nội dung thương lượng tập thể gồm những gì?",
+]
+# Số tài liệu tối đa dùng để đo tốc độ embedding
+BENCH_EMBED_SAMPLE = int(os.environ.get("BENCH_EMBED_SAMPLE", "256"))
+# Độ trễ (ms) của LLM giả lập trong bài đo /ask
+BENCH_STUB_LLM_MS = float(os.environ.get("BENCH_STUB_LLM_MS", "0"))
+# Chỉ số càng cao càng tốt; các chỉ số còn lại (thời gian, độ trễ) càng thấp càng tốt
+HIGHER_IS_BETTER = ("per_s", "qps", "recall", "cosine", "speedup")
+
+
+def latency_summary(samples_ms: List[float]) -> Dict[str, float]:
+    """Tóm tắt độ trễ (ms): mean, p50, p95, p99"""
+    if not samples_ms:
+        return {"mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    arr = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        "mean_ms": round(float(arr.mean()), 3),
+        "p50_ms": round(float(np.percentile(arr, 50)), 3),
+        "p95_ms": round(float(np.percentile(arr, 95)), 3),
+        "p99_ms": round(float(np.percentile(arr, 99)), 3),
+    }
+
+
+def _timed(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_split(pdf_path: str, workers: Optional[int] = None) -> Dict[str, Any]:
+    """Đo extract_text_from_pdf và split_articles trên một file PDF"""
+    text, extract_s = _timed(splitter.extract_text_from_pdf, pdf_path, workers)
+    articles, split_s = _timed(splitter.split_articles, text.splitlines())
+    pages = splitter.count_pdf_pages(pdf_path)
+    return {
+        "pdf": os.path.basename(pdf_path),
+        "pages": pages,
+        "articles": len(articles),
+        "extract_seconds": round(extract_s, 4),
+        "extract_pages_per_s": round(pages / extract_s, 2) if extract_s else 0.0,
+        "split_seconds": round(split_s, 4),
+    }
+
+
+def bench_embedding(texts: List[str], provider: str, local_model: str) -> Tuple[Dict[str, Any], Optional[np.ndarray]]:
+    """Đo tốc độ embedding (tài liệu/giây) cho một provider, trả về (kết quả, vectors)"""
+    if provider == "openai":
+        vectors, seconds = _timed(embedder.get_embeddings_openai, embedder.create_openai_client(), texts)
+    else:
+        embedder.get_local_model(local_model, provider)  # Tải model trước, không tính vào thời gian
+        vectors, seconds = _timed(embedder.get_embeddings_local, local_model, texts, provider)
+    chars = sum(len(t) for t in texts)
+    return {
+        "docs": len(texts),
+        "seconds": round(seconds, 4),
+        "docs_per_s": round(len(texts) / seconds, 2) if seconds else 0.0,
+        "chars_per_s": round(chars / seconds, 1) if seconds else 0.0,
+        "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+    }, vectors
+
+
+def _query_latency(queries: List[str], provider: str, local_model: str, repeats: int = 5) -> Dict[str, float]:
+    """Độ trễ encode từng câu hỏi một (như retriever.embed_query khi không trúng cache)"""
+    samples = []
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            embedder.get_embeddings_local(local_model, [query], provider)
+            samples.append((time.perf_counter() - start) * 1000.0)
+    return latency_summary(samples)
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def bench_onnx(texts: List[str], queries: List[str], local_model: str, k: int = 10) -> Dict[str, Any]:
+    """
+    So sánh backend ONNX Runtime (provider onnx, ONNX_QUANTIZATION) với PyTorch trên cùng model:
+    độ lệch vector (cosine, sai số tuyệt đối lớn nhất), độ trùng top-k láng giềng trong mẫu tài liệu,
+    tốc độ embedding hàng loạt và độ trễ encode một câu hỏi
+    """
+    torch_result, torch_vectors = bench_embedding(texts, "local", local_model)
+    onnx_result, onnx_vectors = bench_embedding(texts, "onnx", local_model)
+    torch_result["query"] = _query_latency(queries, "local", local_model)
+    onnx_result["query"] = _query_latency(queries, "onnx", local_model)
+
+    a, b = _normalize_rows(torch_vectors), _normalize_rows(onnx_vectors)
+    cosine = (a * b).sum(axis=1)
+    # Top-k láng giềng của từng tài liệu theo vector PyTorch và theo vector ONNX (bỏ chính nó)
+    k = max(1, min(k, len(texts) - 1))
+    sims_a, sims_b = a @ a.T, b @ b.T
+    np.fill_diagonal(sims_a, -np.inf)
+    np.fill_diagonal(sims_b, -np.inf)
+    top_a = np.argpartition(-sims_a, k - 1, axis=1)[:, :k]
+    top_b = np.argpartition(-sims_b, k - 1, axis=1)[:, :k]
+    overlap = np.mean([len(set(x) & set(y)) / k for x, y in zip(top_a.tolist(), top_b.tolist())])
+
+    torch_p50, onnx_p50 = torch_result["query"]["p50_ms"], onnx_result["query"]["p50_ms"]
+    return {
+        "model": embedder.model_id("onnx", local_model),
+        "torch": torch_result,
+        "onnx": onnx_result,
+        "drift": {
+            "cosine_mean": round(float(cosine.mean()), 6),
+            "cosine_min": round(float(cosine.min()), 6),
+            "max_abs_diff": round(float(np.abs(a - b).max()), 6),
+            f"recall_at_{k}": round(float(overlap), 4),
+        },
+        "embed_speedup": round(onnx_result["docs_per_s"] / torch_result["docs_per_s"], 3)
+        if torch_result["docs_per_s"] else 0.0,
+        "query_speedup": round(torch_p50 / onnx_p50, 3) if onnx_p50 else 0.0,
+    }
+
+
+def bench_index_build(vectors: np.ndarray, index_types: List[str], recall_k: int = 10) -> Dict[str, Any]:
+    """Đo thời gian dựng từng loại index, bộ nhớ và recall@k so với tìm kiếm chính xác"""
+    ids = list(range(len(vectors)))
+    out: Dict[str, Any] = {}
+    for index_type in index_types:
+        try:
+            index, seconds = _timed(embedder.build_faiss_index, vectors.copy(), ids, index_type)
+            out[index_type] = {
+                "build_seconds": round(seconds, 4),
+                "memory_bytes": embedder.index_memory_bytes(index),
+                "recall": round(embedder.evaluate_recall(index, vectors, ids, k=recall_k), 4),
+            }
+        except Exception as e:
+            out[index_type] = {"error": str(e)}
+    return out
+
+
+def _run_concurrent(fn: Callable[[str], Any], queries: List[str], iterations: int, concurrency: int) -> Dict[str, Any]:
+    """Gọi fn(query) iterations lần với tối đa concurrency luồng, đo độ trễ từng lần và QPS"""
+    jobs = [queries[i % len(queries)] for i in range(iterations)]
+
+    def one(query: str) -> float:
+        start = time.perf_counter()
+        fn(query)
+        return (time.perf_counter() - start) * 1000.0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        samples = list(pool.map(one, jobs))
+    wall = time.perf_counter() - start
+    result: Dict[str, Any] = latency_summary(samples)
+    result["qps"] = round(iterations / wall, 2) if wall else 0.0
+    return result
+
+
+def bench_retrieval(
+    index_dir: str,
+    queries: List[str],
+    provider: str,
+    local_model: str,
+    top_ks: List[int],
+    concurrencies: List[int],
+    iterations: int,
+    mode: str = retriever.RETRIEVAL_MODE,
+) -> Dict[str, Any]:
+    """
+    Đo độ trễ retrieve (embed câu hỏi + tìm kiếm) theo top_k và mức đồng thời
+    Tắt cache embedding câu hỏi trong lúc đo để mỗi lần gọi đều encode lại
+    """
+    cache_size = retriever.query_cache.max_size
+    retriever.query_cache.max_size = 0
+    retriever.query_cache.clear()
+    try:
+        retriever.retrieve(queries[0], index_dir, max(top_ks), provider, local_model, mode=mode)  # Khởi động
+        out: Dict[str, Any] = {}
+        for top_k in top_ks:
+            for concurrency in concurrencies:
+                out[f"top_k={top_k},concurrency={concurrency}"] = _run_concurrent(
+                    lambda q: retriever.retrieve(q, index_dir, top_k, provider, local_model, mode=mode),
+                    queries, iterations, concurrency,
+                )
+        return out
+    finally:
+        retriever.query_cache.max_size = cache_size
+
+
+def bench_ask(
+    index_dir: str,
+    queries: List[str],
+    provider: str,
+    local_model: str,
+    top_k: int,
+    concurrencies: List[int],
+    iterations: int,
+    mode: str = retriever.RETRIEVAL_MODE,
+    stub_llm_ms: float = BENCH_STUB_LLM_MS,
+) -> Dict[str, Any]:
+    """
+    Đo /ask end-to-end qua ASGI (không mở cổng mạng) với LLM giả lập trả lời sau stub_llm_ms
+    Cache câu trả lời và cache embedding câu hỏi bị tắt để mỗi request đều đi hết pipeline (so được với bench_retrieval)
+    """
+    import httpx
+
+    from . import api, generator
+
+    async def stub_answer(query: str, contexts: List[Any], model: str = "") -> str:
+        generator.build_messages(query, contexts, model)  # Vẫn tính chi phí đóng gói ngữ cảnh
+        if stub_llm_ms > 0:
+            await asyncio.sleep(stub_llm_ms / 1000.0)
+        return "stub"
+
+    async def run(concurrency: int) -> Dict[str, Any]:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+            async def one(i: int) -> float:
+                payload = {
+                    "query": queries[i % len(queries)],
+                    "index_dir": index_dir,
+                    "provider": provider,
+                    "local_model": local_model,
+                    "top_k": top_k,
+                    "mode": mode,
+                }
+                async with semaphore:
+                    start = time.perf_counter()
+                    resp = await client.post("/ask", json=payload)
+                    resp.raise_for_status()
+                    return (time.perf_counter() - start) * 1000.0
+
+            await one(0)  # Khởi động
+            start = time.perf_counter()
+            samples = await asyncio.gather(*(one(i) for i in range(iterations)))
+            wall = time.perf_counter() - start
+        result: Dict[str, Any] = latency_summary(list(samples))
+        result["qps"] = round(iterations / wall, 2) if wall else 0.0
+        return result
+
+    original = generator.generate_answer_async
+    cache_size = api.answer_cache.max_size
+    query_cache_size = retriever.query_cache.max_size
+    generator.generate_answer_async = stub_answer
+    api.answer_cache.max_size = 0
+    retriever.query_cache.max_size = 0
+    retriever.query_cache.clear()
+    try:
+        return {f"concurrency={c}": asyncio.run(run(c)) for c in concurrencies}
+    finally:
+        generator.generate_answer_async = original
+        api.answer_cache.max_size = cache_size
+        retriever.query_cache.max_size = query_cache_size
+
+
+def environment_info() -> Dict[str, Any]:
+    """Thông tin máy chạy benchmark (để so sánh baseline trên cùng cấu hình)"""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def flatten_metrics(data: Any, prefix: str = "") -> Dict[str, float]:
+    """Làm phẳng kết quả JSON thành {"đường.dẫn": giá trị số}"""
+    out: Dict[str, float] = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            out.update(flatten_metrics(value, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        out[prefix] = float(data)
+    return out
+
+
+def compare_with_baseline(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2
+) -> List[Dict[str, Any]]:
+    """
+    So sánh từng chỉ số với baseline, trả về danh sách chỉ số bị chậm/kém đi quá tolerance (tỉ lệ)
+    Bỏ qua thông tin môi trường và các chỉ số đếm (pages, articles, docs, dim, bytes)
+    """
+    current = flatten_metrics(results.get("stages", {}))
+    previous = flatten_metrics(baseline.get("stages", {}))
+    regressions: List[Dict[str, Any]] = []
+    for name, old in previous.items():
+        new = current.get(name)
+        leaf = name.rsplit(".", 1)[-1]
+        if new is None or old <= 0 or leaf in ("pages", "articles", "docs", "dim", "memory_bytes"):
+            continue
+        higher_better = any(tag in leaf for tag in HIGHER_IS_BETTER)
+        change = (new - old) / old
+        worse = change < -tolerance if higher_better else change > tolerance
+        if worse:
+            regressions.append({"metric": name, "baseline": old, "current": new, "change": round(change, 4)})
+    return regressions
@@ -0,0 +1,199 @@
+"""
+Module trả lời hàng loạt câu hỏi (bulk question answering)
+Embed cả lô câu hỏi thành ma trận, tìm kiếm FAISS một lần, sinh câu trả lời song song có giới hạn và trả kết quả theo thứ tự đầu vào
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from . import generator, retriever
+
+# Số câu hỏi được embed và tìm kiếm cùng lúc (giới hạn bộ nhớ của ma trận câu hỏi)
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "256"))
+
+Item = Dict[str, Any]
+
+
+def parse_query_line(line: str, position: int) -> Optional[Item]:
+    """Đọc một dòng JSONL: {"id": ..., "query": ...} hoặc chuỗi JSON; id mặc định là số thứ tự dòng"""
+    line = line.strip()
+    if not line:
+        return None
+    data = json.loads(line)
+    if isinstance(data, str):
+        data = {"query": data}
+    if not isinstance(data, dict) or not str(data.get("query", "")).strip():
+        raise ValueError(f"Dòng {position + 1}: cần trường 'query'")
+    return {"id": str(data.get("id", position)), "query": str(data["query"])}
+
+
+def read_queries_file(path: str) -> List[Item]:
+    """Đọc danh sách câu hỏi từ file JSONL"""
+    items: List[Item] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for position, line in enumerate(f):
+            item = parse_query_line(line, position)
+            if item is not None:
+                items.append(item)
+    return items
+
+
+def compact_results(output_path: str) -> Set[str]:
+    """
+    Chuẩn bị file kết quả để chạy tiếp sau lỗi: giữ bản ghi thành công mới nhất của mỗi ID,
+    bỏ bản ghi lỗi (sẽ chạy lại) và dòng ghi dở, ghi lại file (tmp + os.replace); trả về ID đã xong
+    """
+    if not os.path.isfile(output_path):
+        return set()
+    records: Dict[str, Item] = {}
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Dòng cuối có thể bị ghi dở khi tiến trình bị dừng
+            if isinstance(record, dict) and not record.get("error"):
+                records[str(record.get("id"))] = record
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records.values():
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, output_path)
+    return set(records)
+
+
+def _chunks(items: List[Item], size: int) -> Iterator[List[Item]]:
+    size = max(1, size)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def retrieve_chunk(
+    items: List[Item],
+    index_dir: str,
+    top_k: int,
+    provider: str,
+    local_model: str,
+    laws: Optional[List[str]] = None,
+    mode: str = retriever.RETRIEVAL_MODE,
+    expand: str = retriever.CLAUSE_EXPAND,
+) -> List[Tuple[List[Dict[str, str]], List[Dict[str, str]]]]:
+    """Embed các câu hỏi thành một ma trận, tìm kiếm một lần, trả về (contexts, results) theo từng câu hỏi"""
+    queries = [item["query"] for item in items]
+    q = None if mode == "lexical" else retriever.embed_queries(queries, provider, local_model)
+    rows = retriever.search_batch(index_dir, q, top_k, laws, queries, mode, expand)
+
+    out: List[Tuple[List[Dict[str, str]], List[Dict[str, str]]]] = []
+    for query, results in zip(queries, rows):
+        # Heuristic: Nếu query nhắc tới "Điều <số>", chèn trực tiếp nội dung các điều đó
+        articles = retriever.get_articles_in_query(index_dir, query, laws)
+        contexts = articles + results
+        out.append((contexts, results))
+    return out
+
+
+def make_record(item: Item, answer: str = "", results: Iterable[Dict[str, str]] = (), error: str = "") -> Dict[str, Any]:
+    """Tạo bản ghi kết quả (một dòng JSONL đầu ra)"""
+    record: Dict[str, Any] = {
+        "id": item["id"],
+        "query": item["query"],
+        "answer": answer,
+        "sources": [
+            {"rank": int(r.get("rank", 0)), "score": float(r.get("score", 0.0)), "id": r.get("id", ""),
+             "law": r.get("law", ""), "path": r.get("path", "")}
+            for r in results
+        ],
+    }
+    if error:
+        record["error"] = error
+    return record
+
+
+def answer_stream(
+    items: List[Item],
+    index_dir: str,
+    top_k: int,
+    provider: str,
+    local_model: str,
+    groq_model: str,
+    laws: Optional[List[str]] = None,
+    concurrency: int = 4,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    mode: str = retriever.RETRIEVAL_MODE,
+    expand: str = retriever.CLAUSE_EXPAND,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Trả lời hàng loạt (đồng bộ, dùng cho CLI): sinh bản ghi theo đúng thứ tự đầu vào
+    Lỗi của từng câu hỏi được ghi vào trường "error" thay vì dừng cả lô
+    """
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="bulk-llm") as pool:
+        for chunk in _chunks(items, chunk_size):
+            try:
+                retrieved = retrieve_chunk(chunk, index_dir, top_k, provider, local_model, laws, mode, expand)
+            except Exception as e:
+                for item in chunk:
+                    yield make_record(item, error=str(e))
+                continue
+            futures = [
+                pool.submit(generator.generate_answer, item["query"], contexts, groq_model)
+                for item, (contexts, _) in zip(chunk, retrieved)
+            ]
+            for item, (_, results), fut in zip(chunk, retrieved, futures):
+                try:
+                    yield make_record(item, fut.result() or "", results)
+                except Exception as e:
+                    yield make_record(item, results=results, error=str(e))
+
+
+async def answer_stream_async(
+    items: List[Item],
+    index_dir: str,
+    top_k: int,
+    provider: str,
+    local_model: str,
+    groq_model: str,
+    laws: Optional[List[str]] = None,
+    concurrency: int = 4,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    executor: Optional[ThreadPoolExecutor] = None,
+    mode: str = retriever.RETRIEVAL_MODE,
+    expand: str = retriever.CLAUSE_EXPAND,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Trả lời hàng loạt (async, dùng cho API): truy xuất chạy trong executor,
+    tối đa `concurrency` lời gọi LLM đồng thời, bản ghi trả về theo thứ tự đầu vào
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def generate(item: Item, contexts: List[Dict[str, str]], results: List[Dict[str, str]]) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                answer = await generator.generate_answer_async(item["query"], contexts, groq_model)
+                return make_record(item, answer or "", results)
+            except Exception as e:
+                return make_record(item, results=results, error=str(e))
+
+    for chunk in _chunks(items, chunk_size):
+        try:
+            retrieved = await loop.run_in_executor(
+                executor, retrieve_chunk, chunk, index_dir, top_k, provider, local_model, laws, mode, expand
+            )
+        except Exception as e:
+            for item in chunk:
+                yield make_record(item, error=str(e))
+            continue
+        tasks = [
+            asyncio.ensure_future(generate(item, contexts, results))
+            for item, (contexts, results) in zip(chunk, retrieved)
+        ]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            # Client ngắt kết nối giữa chừng: hủy các lời gọi LLM chưa xong
+            for task in tasks:
+                task.cancel()
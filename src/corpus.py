@@ -0,0 +1,129 @@
+"""
+Module lưu trữ nội dung điều luật dạng đóng gói (packed corpus)
+Toàn bộ văn bản nằm trong một file, truy cập qua mmap theo bảng offset
+"""
+
+import json
+import mmap
+import os
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+CORPUS_NAME = "corpus"
+# Corpus phụ chứa nội dung điều luật gốc khi index được chia nhỏ theo khoản/điểm
+PARENTS_NAME = "parents"
+# Metadata đóng gói (mỗi tài liệu một bản ghi JSON) để các worker đọc qua mmap thay vì mỗi tiến trình giữ một list dict
+METADATA_NAME = "metadata"
+CORPUS_FILE = CORPUS_NAME + ".bin"
+OFFSETS_FILE = CORPUS_NAME + "_offsets.npy"
+
+
+def _paths(index_dir: str, name: str) -> Tuple[str, str]:
+    """Đường dẫn file dữ liệu và file offset của corpus tên name"""
+    return os.path.join(index_dir, name + ".bin"), os.path.join(index_dir, name + "_offsets.npy")
+
+
+def _replace_atomic(path: str, data_writer) -> None:
+    """Ghi ra file tạm rồi os.replace, tránh làm hỏng mmap đang mở của file cũ"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        data_writer(f)
+    os.replace(tmp_path, path)
+
+
+def write_corpus(texts: List[str], index_dir: str, name: str = CORPUS_NAME) -> None:
+    """Ghi các văn bản (theo thứ tự metadata) vào <name>.bin kèm bảng offset"""
+    os.makedirs(index_dir, exist_ok=True)
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+    def _write_data(f) -> None:
+        for b in encoded:
+            f.write(b)
+
+    data_path, offsets_path = _paths(index_dir, name)
+    _replace_atomic(data_path, _write_data)
+    _replace_atomic(offsets_path, lambda f: np.save(f, offsets))
+
+
+def has_corpus(index_dir: str, name: str = CORPUS_NAME) -> bool:
+    """Kiểm tra index_dir có corpus đóng gói hay không (index cũ có thể không có)"""
+    return all(os.path.isfile(path) for path in _paths(index_dir, name))
+
+
+def remove_corpus(index_dir: str, name: str) -> None:
+    """Xóa corpus tên name nếu có (ví dụ corpus điều gốc khi dựng lại index theo điều)"""
+    for path in _paths(index_dir, name):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def save_array(path: str, array: np.ndarray) -> None:
+    """Ghi mảng .npy qua file tạm rồi os.replace (reader đang mmap file cũ không bị ảnh hưởng)"""
+    _replace_atomic(path, lambda f: np.save(f, array))
+
+
+def load_array(path: str) -> np.ndarray:
+    """Nạp mảng .npy qua mmap chỉ đọc: các tiến trình worker dùng chung một bản trong page cache của hệ điều hành"""
+    return np.load(path, mmap_mode="r")
+
+
+def write_records(records: List[Dict[str, Any]], index_dir: str, name: str = METADATA_NAME) -> None:
+    """Ghi các bản ghi (dict) thành corpus đóng gói, mỗi bản ghi một chuỗi JSON"""
+    write_corpus([json.dumps(r, ensure_ascii=False, separators=(",", ":")) for r in records], index_dir, name)
+
+
+class CorpusReader:
+    """Đọc văn bản từ <name>.bin qua mmap, cắt lát không sao chép theo offset"""
+
+    def __init__(self, index_dir: str, name: str = CORPUS_NAME) -> None:
+        data_path, offsets_path = _paths(index_dir, name)
+        self.offsets = load_array(offsets_path)
+        self._file = open(data_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap không hỗ trợ file rỗng
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._view = memoryview(self._mm) if self._mm is not None else memoryview(b"")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def view(self, i: int) -> memoryview:
+        """Trả về memoryview (zero-copy) tới bytes UTF-8 của văn bản thứ i"""
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self._view[start:end]
+
+    def get(self, i: int) -> str:
+        """Giải mã văn bản thứ i"""
+        return str(self.view(i), "utf-8")
+
+    def close(self) -> None:
+        self._view.release()
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
+
+
+class RecordReader:
+    """Danh sách bản ghi chỉ đọc trên corpus đóng gói: giải mã JSON khi truy cập, không giữ list dict trong bộ nhớ"""
+
+    def __init__(self, index_dir: str, name: str = METADATA_NAME) -> None:
+        self._reader = CorpusReader(index_dir, name)
+
+    def __len__(self) -> int:
+        return len(self._reader)
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self._reader.get(i % len(self)))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self) -> None:
+        self._reader.close()
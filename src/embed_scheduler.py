@@ -0,0 +1,194 @@
+"""
+Module điều phối gọi OpenAI embeddings song song
+Giới hạn số request/token mỗi phút, thử lại với exponential backoff + jitter, trả kết quả theo đúng thứ tự đầu vào
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from . import lazy
+
+openai = lazy.LazyModule("openai", "openai is not installed. Please install requirements.")
+
+# Số batch gửi đồng thời
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", "4"))
+# Giới hạn request và token mỗi phút (0 = không giới hạn)
+EMBED_RPM = int(os.environ.get("EMBED_RPM", "3000"))
+EMBED_TPM = int(os.environ.get("EMBED_TPM", "1000000"))
+# Số lần thử lại tối đa cho mỗi batch và thời gian chờ (giây) của backoff
+EMBED_MAX_RETRIES = int(os.environ.get("EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.environ.get("EMBED_BACKOFF_BASE", "1.0"))
+EMBED_BACKOFF_MAX = float(os.environ.get("EMBED_BACKOFF_MAX", "60.0"))
+# Chu kỳ (giây) ghi checkpoint embedding ra đĩa trong lúc chạy
+EMBED_CHECKPOINT_SECONDS = float(os.environ.get("EMBED_CHECKPOINT_SECONDS", "30"))
+# Ước lượng token để giới hạn TPM: ~3 ký tự mỗi token với tiếng Việt
+CHARS_PER_TOKEN = 3
+
+RETRYABLE_STATUS = (408, 409, 429)
+
+BatchCallback = Callable[[int, np.ndarray], None]
+
+
+class TokenBucket:
+    """Token bucket thread-safe: tối đa `rate_per_min` đơn vị mỗi phút, cho phép dồn tối đa một phút"""
+
+    def __init__(self, rate_per_min: float) -> None:
+        self.capacity = float(rate_per_min)
+        self.rate = float(rate_per_min) / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> None:
+        """Chờ tới khi đủ `amount` đơn vị rồi trừ đi; rate <= 0 nghĩa là không giới hạn"""
+        if self.rate <= 0:
+            return
+        amount = min(float(amount), self.capacity)  # Request lớn hơn cả bucket vẫn được đi khi bucket đầy
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_s = (amount - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+
+def estimate_tokens(texts: List[str]) -> int:
+    """Ước lượng số token của một batch để trừ vào giới hạn TPM"""
+    return sum(len(t) // CHARS_PER_TOKEN + 1 for t in texts)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Lỗi tạm thời (rate limit, timeout, lỗi server, mất kết nối) thì thử lại"""
+    status = getattr(exc, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS or status >= 500
+    # Lỗi kết nối của SDK chỉ có thể xuất hiện khi openai đã được import
+    if lazy.is_loaded(openai) and isinstance(exc, openai.APIConnectionError):
+        return True
+    return isinstance(exc, (TimeoutError, ConnectionError))
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    """Đọc header Retry-After (giây) từ response lỗi nếu có"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: Optional[float] = None, cap: Optional[float] = None) -> float:
+    """Exponential backoff với full jitter: ngẫu nhiên trong [0, min(cap, base * 2^attempt)]"""
+    base = EMBED_BACKOFF_BASE if base is None else base
+    cap = EMBED_BACKOFF_MAX if cap is None else cap
+    return random.uniform(0.0, min(cap, base * (2 ** attempt)))
+
+
+class EmbeddingScheduler:
+    """Gửi các batch embedding song song trong giới hạn RPM/TPM, thử lại lỗi tạm thời"""
+
+    def __init__(
+        self,
+        client: Any,
+        model: str,
+        batch_size: int,
+        concurrency: Optional[int] = None,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_retries: Optional[int] = None,
+    ) -> None:
+        # Giá trị None lấy theo cấu hình module (có thể được CLI ghi đè lúc chạy)
+        self.client = client
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, EMBED_CONCURRENCY if concurrency is None else concurrency)
+        self.max_retries = max(0, EMBED_MAX_RETRIES if max_retries is None else max_retries)
+        self.requests = TokenBucket(EMBED_RPM if rpm is None else rpm)
+        self.tokens = TokenBucket(EMBED_TPM if tpm is None else tpm)
+        self.retries = 0
+        self._retries_lock = threading.Lock()
+
+    def _embed_batch(self, batch: List[str]) -> np.ndarray:
+        """Gọi API cho một batch, chờ rate limit trước mỗi lần gửi và thử lại khi lỗi tạm thời"""
+        attempt = 0
+        while True:
+            self.requests.acquire(1)
+            self.tokens.acquire(estimate_tokens(batch))
+            try:
+                resp = self.client.embeddings.create(model=self.model, input=batch)
+                # API có thể trả data không theo thứ tự, sắp lại theo index
+                data = sorted(resp.data, key=lambda d: getattr(d, "index", 0))
+                return np.array([d.embedding for d in data], dtype=np.float32)
+            except Exception as exc:
+                if attempt >= self.max_retries or not is_retryable(exc):
+                    raise
+                delay = _retry_after(exc)
+                time.sleep(delay if delay is not None else backoff_delay(attempt))
+                attempt += 1
+                with self._retries_lock:
+                    self.retries += 1
+
+    def embed(self, texts: List[str], on_batch: Optional[BatchCallback] = None) -> np.ndarray:
+        """
+        Embed texts theo batch, tối đa `concurrency` batch cùng lúc; kết quả theo thứ tự đầu vào
+        on_batch(start, vectors) được gọi ở luồng gọi khi mỗi batch xong (dùng để lưu checkpoint)
+        """
+        starts = list(range(0, len(texts), self.batch_size))
+        results: Dict[int, np.ndarray] = {}
+        if len(starts) <= 1 or self.concurrency == 1:
+            for start in starts:
+                results[start] = self._embed_batch(texts[start : start + self.batch_size])
+                if on_batch is not None:
+                    on_batch(start, results[start])
+        else:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="openai-embed") as pool:
+                pending: Dict["Future[np.ndarray]", int] = {}
+                queue = iter(starts)
+                try:
+                    # Giữ tối đa 2 * concurrency batch trong hàng đợi để không giữ toàn bộ input ở dạng future
+                    for start in queue:
+                        pending[pool.submit(self._embed_batch, texts[start : start + self.batch_size])] = start
+                        if len(pending) >= 2 * self.concurrency:
+                            break
+                    error: Optional[BaseException] = None
+                    while pending:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            start = pending.pop(fut)
+                            if fut.cancelled():
+                                continue
+                            exc = fut.exception()
+                            if exc is not None:
+                                # Dừng gửi batch mới nhưng vẫn nhận các batch đang chạy để checkpoint giữ được chúng
+                                if error is None:
+                                    error = exc
+                                    for other in pending:
+                                        other.cancel()
+                                continue
+                            results[start] = fut.result()
+                            if on_batch is not None:
+                                on_batch(start, results[start])
+                            nxt = next(queue, None) if error is None else None
+                            if nxt is not None:
+                                pending[pool.submit(self._embed_batch, texts[nxt : nxt + self.batch_size])] = nxt
+                    if error is not None:
+                        raise error
+                except BaseException:
+                    for fut in pending:
+                        fut.cancel()
+                    raise
+        if not results:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack([results[start] for start in starts])
@@ -1,35 +1,60 @@
 """
 Module xử lý tạo embeddings và lưu trữ FAISS index
-Hỗ trợ cả OpenAI embeddings và local sentence-transformers
+Hỗ trợ OpenAI embeddings, local sentence-transformers (PyTorch) và cùng model đó export sang ONNX Runtime (onnx)
 """
 
 import os
 import json
 import glob
-from typing import List, Dict, Tuple
+import hashlib
+import platform
+import shutil
+import threading
+from typing import Any, List, Dict, Optional, Tuple
 
 import numpy as np
 
-try:
-    import faiss  # type: ignore
-except Exception as exc:
-    raise RuntimeError(
-        "faiss-cpu is required. Please install dependencies (pip install -r requirements.txt)."
-    ) from exc
+from . import corpus
+from . import embed_scheduler
+from . import index_cache
+from . import lazy
+from . import lexical
+from . import metrics
 
-try:
-    from openai import OpenAI  # type: ignore
-except Exception:
-    OpenAI = None  # type: ignore
-
-try:
-    from sentence_transformers import SentenceTransformer  # type: ignore
-except Exception:
-    SentenceTransformer = None  # type: ignore
+# Import trễ: chỉ tải faiss/openai/sentence-transformers (torch) khi thật sự dùng
+faiss = lazy.LazyModule("faiss", "faiss-cpu is required. Please install dependencies (pip install -r requirements.txt).")
+openai = lazy.LazyModule("openai", "openai is not installed. Please install requirements.")
+sentence_transformers = lazy.LazyModule(
+    "sentence_transformers", "sentence-transformers is not installed. Please install requirements."
+)
+onnxruntime = lazy.LazyModule(
+    "onnxruntime",
+    "onnxruntime is required for the onnx provider. Please install sentence-transformers>=3.2.0 and optimum[onnxruntime].",
+)
 
 # Cấu hình mặc định
 EMBED_MODEL = os.environ.get("EMBED_MODEL", "text-embedding-3-small")
 BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+# Địa chỉ API tương thích OpenAI (rỗng = mặc định của SDK), ví dụ server giả lập khi kiểm thử
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "")
+
+# Các provider embedding: OpenAI API, sentence-transformers chạy PyTorch (local) hoặc ONNX Runtime (onnx)
+PROVIDERS = ("openai", "local", "onnx")
+# Backend onnx: lượng tử hóa trọng số int8 động ("int8") hoặc giữ float32 ("none")
+ONNX_QUANTIZATION = os.environ.get("ONNX_QUANTIZATION", "int8")
+# Cấu hình lượng tử hóa theo tập lệnh CPU của máy chạy: arm64, avx2, avx512, avx512_vnni
+# Mặc định arm64 trên máy ARM (aarch64/arm64), avx2 trên x86-64
+ONNX_QUANT_CONFIG = os.environ.get(
+    "ONNX_QUANT_CONFIG", "arm64" if platform.machine().lower() in ("aarch64", "arm64") else "avx2"
+)
+# Thư mục lưu model đã export sang ONNX (mỗi model/kiểu lượng tử hóa một thư mục, export một lần)
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", os.path.join(os.path.expanduser("~"), ".cache", "rag_onnx"))
+# Số luồng ONNX Runtime cho mỗi model (0 = mặc định của ONNX Runtime, dùng mọi nhân)
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+
+# Pool các model local đã tải, giữ lại giữa các request theo tên model
+_MODEL_POOL: Dict[str, "sentence_transformers.SentenceTransformer"] = {}
+_MODEL_POOL_LOCK = threading.Lock()
 
 
 def read_documents(split_dir: str) -> List[Tuple[str, str]]:
@@ -45,23 +70,123 @@ def read_documents(split_dir: str) -> List[Tuple[str, str]]:
     return documents
 
 
-def get_embeddings_openai(client: "OpenAI", texts: List[str]) -> np.ndarray:
-    """Tạo embeddings bằng OpenAI API"""
-    embeddings: List[List[float]] = []
-    # Xử lý theo batch để tránh rate limit
-    for start in range(0, len(texts), BATCH_SIZE):
-        batch = texts[start : start + BATCH_SIZE]
-        resp = client.embeddings.create(model=EMBED_MODEL, input=batch)
-        batch_vectors = [d.embedding for d in resp.data]
-        embeddings.extend(batch_vectors)    
-    return np.array(embeddings, dtype=np.float32)
+def list_law_dirs(split_dir: str) -> List[str]:
+    """Liệt kê các thư mục con (mỗi luật một thư mục) có chứa file .txt đã tách"""
+    if not os.path.isdir(split_dir):
+        return []
+    laws = []
+    for name in sorted(os.listdir(split_dir)):
+        sub_dir = os.path.join(split_dir, name)
+        if os.path.isdir(sub_dir) and glob.glob(os.path.join(sub_dir, "*.txt")):
+            laws.append(name)
+    return laws
+
+
+def get_embeddings_openai(
+    client: "openai.OpenAI", texts: List[str], on_batch: Optional[embed_scheduler.BatchCallback] = None
+) -> np.ndarray:
+    """
+    Tạo embeddings bằng OpenAI API
+    Các batch được gửi song song trong giới hạn request/token mỗi phút, lỗi tạm thời (429, timeout, 5xx) được thử lại
+    """
+    scheduler = embed_scheduler.EmbeddingScheduler(client, EMBED_MODEL, BATCH_SIZE)
+    return scheduler.embed(texts, on_batch=on_batch)
+
+
+def create_openai_client(base_url: Optional[str] = None) -> "openai.OpenAI":
+    """
+    Tạo OpenAI client cho embedding; base_url (mặc định OPENAI_BASE_URL) cho phép trỏ tới server tương thích
+    Tắt retry của SDK vì scheduler tự thử lại theo giới hạn rate limit
+    """
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise EnvironmentError("OPENAI_API_KEY chưa được thiết lập trong biến môi trường")
+    return openai.OpenAI(api_key=api_key, base_url=base_url or OPENAI_BASE_URL or None, max_retries=0)
+
+
+def check_provider(provider: str) -> None:
+    """Báo lỗi nếu provider không được hỗ trợ"""
+    if provider not in PROVIDERS:
+        raise ValueError(f"provider phải là một trong: {', '.join(PROVIDERS)}")
+
 
+def model_id(provider: str, model_name: str) -> str:
+    """
+    Tên model ghi vào manifest và cache embedding; backend onnx kèm kiểu lượng tử hóa
+    để vector ONNX không lẫn với vector PyTorch của cùng model
+    """
+    if provider == "onnx":
+        suffix = f"qint8_{ONNX_QUANT_CONFIG}" if ONNX_QUANTIZATION == "int8" else "fp32"
+        return f"{model_name}#onnx-{suffix}"
+    return model_name
 
-def get_embeddings_local(model_name: str, texts: List[str]) -> np.ndarray:
-    """Tạo embeddings bằng sentence-transformers local model"""
-    if SentenceTransformer is None:
-        raise RuntimeError("sentence-transformers is not installed. Please install requirements.")
-    model = SentenceTransformer(model_name)
+
+def export_onnx_model(model_name: str) -> Tuple[str, str]:
+    """
+    Export model sentence-transformers sang ONNX (lượng tử hóa int8 động nếu ONNX_QUANTIZATION=int8) vào ONNX_MODEL_DIR
+    Chỉ export ở lần đầu; ghi vào thư mục tạm rồi đổi tên để các worker chạy song song không đọc phải bản dở
+    Trả về (thư mục model, đường dẫn file .onnx tương đối) để nạp bằng backend ONNX của sentence-transformers
+    """
+    if ONNX_QUANTIZATION not in ("int8", "none"):
+        raise ValueError("ONNX_QUANTIZATION phải là 'int8' hoặc 'none'")
+    target = os.path.join(ONNX_MODEL_DIR, model_id("onnx", model_name).replace("/", "__").replace("#", "-"))
+    file_name = f"onnx/model_qint8_{ONNX_QUANT_CONFIG}.onnx" if ONNX_QUANTIZATION == "int8" else "onnx/model.onnx"
+    if os.path.isfile(os.path.join(target, file_name)):
+        return target, file_name
+
+    tmp = f"{target}.tmp{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    try:
+        with metrics.stage("onnx_export"):
+            model = sentence_transformers.SentenceTransformer(model_name, backend="onnx")
+            model.save_pretrained(tmp)
+            if ONNX_QUANTIZATION == "int8":
+                sentence_transformers.export_dynamic_quantized_onnx_model(
+                    model, ONNX_QUANT_CONFIG, tmp, file_suffix=f"qint8_{ONNX_QUANT_CONFIG}"
+                )
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            if not os.path.isfile(os.path.join(target, file_name)):  # Worker khác đã export xong thì dùng bản đó
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return target, file_name
+
+
+def _load_model(model_name: str, provider: str) -> "sentence_transformers.SentenceTransformer":
+    if provider != "onnx":
+        return sentence_transformers.SentenceTransformer(model_name)
+    if not hasattr(lazy.load(sentence_transformers), "export_dynamic_quantized_onnx_model"):
+        raise RuntimeError("The onnx provider requires sentence-transformers>=3.2.0 and optimum[onnxruntime].")
+    lazy.load(onnxruntime)  # Báo thiếu optimum/onnxruntime trước khi export
+    path, file_name = export_onnx_model(model_name)
+    model_kwargs: Dict[str, Any] = {"file_name": file_name, "provider": "CPUExecutionProvider"}
+    if ONNX_THREADS > 0:
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = ONNX_THREADS
+        model_kwargs["session_options"] = options
+    return sentence_transformers.SentenceTransformer(path, backend="onnx", model_kwargs=model_kwargs)
+
+
+def get_local_model(model_name: str, provider: str = "local") -> "sentence_transformers.SentenceTransformer":
+    """Lấy model sentence-transformers (PyTorch, hoặc ONNX Runtime khi provider="onnx") từ pool, chỉ tải ở lần đầu"""
+    key = model_name if provider == "local" else model_id(provider, model_name)
+    model = _MODEL_POOL.get(key)
+    if model is not None:
+        return model
+    with _MODEL_POOL_LOCK:
+        model = _MODEL_POOL.get(key)
+        if model is None:
+            with metrics.stage("model_load"):
+                model = _load_model(model_name, provider)
+            _MODEL_POOL[key] = model
+    return model
+
+
+def get_embeddings_local(model_name: str, texts: List[str], provider: str = "local") -> np.ndarray:
+    """Tạo embeddings bằng sentence-transformers local model (backend PyTorch hoặc ONNX Runtime)"""
+    model = get_local_model(model_name, provider)
     vectors = model.encode(
         texts,
         batch_size=max(1, BATCH_SIZE // 4),  # Giảm batch size cho local model
@@ -71,25 +196,418 @@ def get_embeddings_local(model_name: str, texts: List[str]) -> np.ndarray:
     return vectors.astype(np.float32)
 
 
-def build_faiss_index(vectors: np.ndarray) -> "faiss.Index":
-    """Xây dựng FAISS index với cosine similarity (Inner Product)"""
+# Các loại FAISS index hỗ trợ: chính xác (flat) và xấp xỉ (IVF-flat, HNSW, IVF-PQ)
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq", "fp16", "sq8", "binary"]
+# Loại index nén vector (fp16, int8 scalar quantization, mã nhị phân + chấm điểm lại)
+COMPRESSED_INDEX_TYPES = ("fp16", "sq8", "binary")
+# Tham số chỉ dùng lúc truy vấn, được retriever áp dụng khi tải index
+SEARCH_PARAMS = ("nprobe", "ef_search", "rescore")
+# Vector đầy đủ (float16, đọc qua mmap) để chấm điểm lại danh sách ứng viên của index nhị phân
+RESCORE_VECTORS_FILE = "rescore_vectors.npy"
+# ID vector và ngưỡng nhị phân hóa từng chiều của index nhị phân
+BINARY_META_FILE = "binary_meta.npz"
+
+
+def default_index_params(
+    index_type: str, n: int, dim: int, overrides: Optional[Dict[str, Any]] = None
+) -> Dict[str, int]:
+    """
+    Tham số mặc định cho từng loại index, ghi đè bởi overrides (bỏ qua giá trị None)
+    nlist/pq_m/pq_nbits/hnsw_m/ef_construction dùng khi dựng; nprobe/ef_search dùng khi truy vấn
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type phải là một trong: {', '.join(INDEX_TYPES)}")
+    overrides = {k: int(v) for k, v in (overrides or {}).items() if v is not None}
+    params: Dict[str, int] = {}
+    if index_type in ("ivf", "ivfpq"):
+        nlist = overrides.get("nlist") or max(1, min(n, int(4 * np.sqrt(max(n, 1)))))
+        params["nlist"] = nlist
+        params["nprobe"] = min(nlist, overrides.get("nprobe") or 16)
+    if index_type == "ivfpq":
+        pq_m = overrides.get("pq_m") or next(m for m in (dim // 8, dim // 4, dim // 2, dim, 1) if m and dim % m == 0)
+        if dim % pq_m != 0:
+            raise ValueError(f"pq_m ({pq_m}) phải là ước của số chiều vector ({dim})")
+        params["pq_m"] = pq_m
+        # Huấn luyện PQ cần ít nhất 2^nbits vector
+        params["pq_nbits"] = overrides.get("pq_nbits") or max(1, min(8, int(np.log2(max(n, 2)))))
+    if index_type == "hnsw":
+        params["hnsw_m"] = overrides.get("hnsw_m") or 32
+        params["ef_construction"] = overrides.get("ef_construction") or 200
+        params["ef_search"] = overrides.get("ef_search") or 64
+    if index_type == "binary":
+        # Lấy top_k * rescore ứng viên theo khoảng cách Hamming rồi tính lại điểm cosine chính xác
+        params["rescore"] = overrides.get("rescore") or 20
+    return params
+
+
+def apply_search_params(index: "faiss.Index", params: Optional[Dict[str, Any]]) -> None:
+    """Áp dụng tham số truy vấn (nprobe cho IVF, efSearch cho HNSW) lên index đã tải"""
+    if not params:
+        return
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if "nprobe" in params and hasattr(base, "nprobe"):
+        base.nprobe = int(params["nprobe"])
+    if "ef_search" in params and hasattr(base, "hnsw"):
+        base.hnsw.efSearch = int(params["ef_search"])
+    if "rescore" in params and isinstance(index, BinaryRescoreIndex):
+        index.rescore = max(1, int(params["rescore"]))
+
+
+class BinaryRescoreIndex:
+    """
+    Index mã nhị phân: mỗi vector giữ 1 bit/chiều (lớn hơn trung vị của chiều đó), tìm ứng viên bằng khoảng cách Hamming,
+    sau đó chấm điểm lại bằng inner product trên vector float16 đọc qua mmap (chỉ trang chứa ứng viên được nạp)
+    Giao diện search(q, k) -> (D, I) giống FAISS, I là ID vector (vid) hoặc vị trí
+    """
+
+    def __init__(
+        self, codes: "faiss.IndexBinary", vectors: np.ndarray, ids: np.ndarray, thresholds: np.ndarray, rescore: int = 20
+    ) -> None:
+        self.codes = codes
+        self.vectors = vectors
+        self.ids = ids
+        self.thresholds = thresholds
+        self.rescore = rescore
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.codes.ntotal)
+
+    def binarize(self, vectors: np.ndarray) -> np.ndarray:
+        """Mã hóa mỗi chiều thành 1 bit (so với ngưỡng của chiều đó), đóng gói 8 bit/byte"""
+        return np.packbits(np.asarray(vectors) > self.thresholds, axis=1)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, ids: Optional[List[int]] = None, rescore: int = 20) -> "BinaryRescoreIndex":
+        # Ngưỡng theo trung vị từng chiều: embedding thường không đối xứng quanh 0, so dấu sẽ làm nhiều bit giống nhau
+        thresholds = np.median(vectors, axis=0).astype(np.float32) if len(vectors) else np.zeros(vectors.shape[1], np.float32)
+        id_arr = np.asarray(ids if ids is not None else np.arange(len(vectors)), dtype=np.int64)
+        index = cls(faiss.IndexBinaryFlat(((vectors.shape[1] + 7) // 8) * 8), vectors.astype(np.float16), id_arr,
+                    thresholds, rescore)
+        index.codes.add(index.binarize(vectors))
+        return index
+
+    def search(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        n = self.ntotal
+        D = np.full((len(q), k), -np.inf, dtype=np.float32)
+        I = np.full((len(q), k), -1, dtype=np.int64)
+        if n == 0:
+            return D, I
+        shortlist = min(n, max(k, k * self.rescore))
+        _, candidates = self.codes.search(self.binarize(q), shortlist)
+        for row, (query, cand) in enumerate(zip(q, candidates)):
+            cand = cand[cand >= 0]
+            order = np.sort(cand)  # Đọc mmap theo thứ tự tăng dần để truy cập đĩa tuần tự
+            scores = np.asarray(self.vectors[order], dtype=np.float32) @ query
+            best = np.argsort(-scores, kind="stable")[:k]
+            D[row, : len(best)] = scores[best]
+            I[row, : len(best)] = self.ids[order[best]]
+        return D, I
+
+    def save(self, index_dir: str) -> None:
+        """Ghi vector chấm điểm lại, ID và ngưỡng trước, mã nhị phân (index.faiss) sau cùng"""
+        path = os.path.join(index_dir, RESCORE_VECTORS_FILE)
+        np.save(path + ".tmp.npy", np.asarray(self.vectors))
+        os.replace(path + ".tmp.npy", path)
+        path = os.path.join(index_dir, BINARY_META_FILE)
+        np.savez(path + ".tmp.npz", ids=self.ids, thresholds=self.thresholds)
+        os.replace(path + ".tmp.npz", path)
+        path = os.path.join(index_dir, "index.faiss")
+        faiss.write_index_binary(self.codes, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, index_dir: str, io_flags: int = 0) -> "BinaryRescoreIndex":
+        codes = faiss.read_index_binary(os.path.join(index_dir, "index.faiss"), io_flags)
+        vectors = np.load(os.path.join(index_dir, RESCORE_VECTORS_FILE), mmap_mode="r")
+        with np.load(os.path.join(index_dir, BINARY_META_FILE)) as meta:
+            ids, thresholds = meta["ids"], meta["thresholds"]
+        return cls(codes, vectors, ids, thresholds)
+
+
+def _mmap_flags() -> int:
+    # MMAP_IFC ánh xạ cả mảng mã vector (flat, SQ, HNSW, IVF) thay vì sao chép; faiss cũ chỉ có IO_FLAG_MMAP
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+def read_index(index_dir: str, manifest: Optional[Dict[str, Any]] = None, mmap: bool = False) -> Any:
+    """
+    Đọc index.faiss theo loại ghi trong manifest (index nhị phân cần thêm vector chấm điểm lại)
+    mmap=True đọc chỉ đọc qua mmap để các tiến trình dùng chung page cache (không dùng khi cần cập nhật index);
+    loại index/phiên bản faiss không hỗ trợ thì đọc bình thường
+    """
+    binary = (manifest or {}).get("index", {}).get("type") == "binary"
+    if mmap:
+        try:
+            if binary:
+                return BinaryRescoreIndex.load(index_dir, _mmap_flags())
+            return faiss.read_index(os.path.join(index_dir, "index.faiss"), _mmap_flags())
+        except RuntimeError:
+            pass
+    if binary:
+        return BinaryRescoreIndex.load(index_dir)
+    return faiss.read_index(os.path.join(index_dir, "index.faiss"))
+
+
+def write_index(index: Any, index_dir: str) -> None:
+    """
+    Ghi index ra index.faiss (và các file đi kèm với index nhị phân)
+    Ghi file tạm rồi os.replace: tiến trình đang mmap file cũ vẫn đọc được tới khi tải lại
+    """
+    if isinstance(index, BinaryRescoreIndex):
+        index.save(index_dir)
+        return
+    path = os.path.join(index_dir, "index.faiss")
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    for name in (RESCORE_VECTORS_FILE, BINARY_META_FILE):
+        if os.path.isfile(os.path.join(index_dir, name)):
+            os.remove(os.path.join(index_dir, name))
+
+
+def index_memory_bytes(index: Any) -> int:
+    """Bộ nhớ thường trú ước tính của index (vector chấm điểm lại của index nhị phân nằm trên đĩa, không tính)"""
+    if isinstance(index, BinaryRescoreIndex):
+        return int(index.codes.ntotal * index.codes.code_size + index.ids.nbytes)
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def build_faiss_index(
+    vectors: np.ndarray,
+    ids: Optional[List[int]] = None,
+    index_type: str = "flat",
+    params: Optional[Dict[str, Any]] = None,
+) -> "faiss.Index":
+    """
+    Xây dựng FAISS index với cosine similarity (Inner Product)
+    index_type: flat (chính xác), ivf, hnsw, ivfpq (xấp xỉ, tham số lấy từ params),
+    fp16/sq8 (vector nén 2 byte/1 byte mỗi chiều), binary (1 bit mỗi chiều + chấm điểm lại)
+    Nếu có ids, index hỗ trợ xóa/thêm tài liệu theo ID (IVF dùng ID gốc, flat/HNSW/SQ bọc IndexIDMap2)
+    """
     # Chuẩn hóa L2 để sử dụng inner product cho cosine similarity
     faiss.normalize_L2(vectors)
-    dim = vectors.shape[1]
-    index = faiss.IndexFlatIP(dim)  # Inner Product = cosine similarity khi đã normalize
-    index.add(vectors)
+    n, dim = vectors.shape
+    params = default_index_params(index_type, n, dim, params)
+    metric = faiss.METRIC_INNER_PRODUCT  # Inner Product = cosine similarity khi đã normalize
+
+    if index_type == "binary":
+        return BinaryRescoreIndex.build(vectors, ids, params["rescore"])
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif index_type in ("fp16", "sq8"):
+        qtype = faiss.ScalarQuantizer.QT_fp16 if index_type == "fp16" else faiss.ScalarQuantizer.QT_8bit
+        index = faiss.IndexScalarQuantizer(dim, qtype, metric)
+        index.train(vectors)  # SQ8 học khoảng giá trị từng chiều
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"], metric)
+        index.hnsw.efConstruction = params["ef_construction"]
+    else:
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dim, params["nlist"], metric)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, params["nlist"], params["pq_m"], params["pq_nbits"], metric)
+        index.train(vectors)
+    apply_search_params(index, params)
+
+    if ids is None:
+        index.add(vectors)
+        return index
+    if index_type not in ("ivf", "ivfpq"):
+        index = faiss.IndexIDMap2(index)
+    index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
     return index
 
 
-def save_index(index: "faiss.Index", metadata: List[Dict[str, str]], index_dir: str) -> None:
-    """Lưu FAISS index và metadata vào thư mục"""
+def evaluate_recall(index: "faiss.Index", vectors: np.ndarray, ids: List[int], k: int = 10, n_queries: int = 200) -> float:
+    """
+    Đo recall@k của index so với tìm kiếm chính xác (flat) trên cùng tập vector
+    Truy vấn là một mẫu ngẫu nhiên các vector tài liệu (đã chuẩn hóa L2)
+    """
+    data = np.ascontiguousarray(vectors, dtype=np.float32).copy()
+    faiss.normalize_L2(data)
+    k = max(1, min(k, len(data)))
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(data), size=min(n_queries, len(data)), replace=False)
+    queries = data[sample]
+
+    # Kết quả chính xác bằng inner product trên toàn bộ vector
+    sims = queries @ data.T
+    exact_pos = np.argsort(-sims, axis=1)[:, :k]
+    id_arr = np.asarray(ids, dtype=np.int64)
+    _, approx = index.search(queries, k)
+
+    hits = 0
+    for row_exact, row_approx in zip(exact_pos, approx):
+        hits += len(set(id_arr[row_exact].tolist()) & set(row_approx.tolist()))
+    return hits / float(k * len(queries))
+
+
+def content_hash(text: str) -> str:
+    """Băm nội dung tài liệu (SHA-256) để phát hiện tài liệu mới hoặc đã sửa"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def doc_vector_id(doc_id: str) -> int:
+    """ID vector ổn định (int64 dương) cho một tài liệu, dùng để xóa/thêm trong index theo ID"""
+    digest = hashlib.sha1(doc_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+
+class EmbeddingCache:
+    """
+    Cache embeddings lưu trên đĩa, khóa theo (model, hash nội dung)
+    Mỗi model một file .npz trong thư mục cache
+    """
+
+    def __init__(self, cache_dir: str, model_name: str) -> None:
+        safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_name)
+        self.path = os.path.join(cache_dir, f"{safe_name}.npz")
+        self.model_name = model_name
+        self._vectors: Dict[str, np.ndarray] = {}
+        if os.path.isfile(self.path):
+            with np.load(self.path) as data:
+                for h, vec in zip(data["hashes"], data["vectors"]):
+                    self._vectors[str(h)] = vec
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._vectors
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        return self._vectors.get(key)
+
+    def put(self, key: str, vec: np.ndarray) -> None:
+        self._vectors[key] = np.asarray(vec, dtype=np.float32)
+
+    def matrix(self, keys: List[str]) -> np.ndarray:
+        """Ghép embeddings theo thứ tự keys thành ma trận float32 (bản sao, có thể sửa)"""
+        return np.stack([self._vectors[k] for k in keys]).astype(np.float32)
+
+    def prune(self, keep: List[str]) -> None:
+        """Chỉ giữ lại embeddings của các nội dung còn dùng"""
+        keep_set = set(keep)
+        self._vectors = {k: v for k, v in self._vectors.items() if k in keep_set}
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        hashes = list(self._vectors.keys())
+        vectors = np.stack([self._vectors[h] for h in hashes]) if hashes else np.zeros((0, 0), dtype=np.float32)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, hashes=np.array(hashes, dtype=str), vectors=vectors)
+        os.replace(tmp_path, self.path)
+
+
+def load_existing_index(index_dir: str) -> Optional[Tuple["faiss.Index", List[Dict[str, Any]], Dict[str, Any]]]:
+    """Tải index, metadata và manifest đã lưu (nếu có) để cập nhật tăng dần"""
+    paths = [os.path.join(index_dir, name) for name in ("index.faiss", "metadata.json", index_cache.MANIFEST_FILE)]
+    if not all(os.path.isfile(p) for p in paths):
+        return None
+    with open(paths[1], "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    with open(paths[2], "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    return read_index(index_dir, manifest), metadata, manifest
+
+
+def can_update_index(index: "faiss.Index", old_manifest: Dict[str, Any], manifest: Dict[str, Any]) -> bool:
+    """
+    Index cũ chỉ được cập nhật tăng dần khi cùng provider/model/số chiều/cấu hình index
+    và loại index hỗ trợ xóa theo ID (flat/SQ bọc IndexIDMap2, IVF); HNSW và binary luôn dựng lại
+    """
+    same_model = all(old_manifest.get(k) == manifest.get(k) for k in ("provider", "model", "dim"))
+    old_index, new_index = old_manifest.get("index", {"type": "flat"}), manifest.get("index", {"type": "flat"})
+
+    def build_params(cfg: Dict[str, Any]) -> Dict[str, Any]:
+        # nprobe/efSearch chỉ ảnh hưởng lúc truy vấn, đổi không cần dựng lại
+        return {k: v for k, v in cfg.get("params", {}).items() if k not in SEARCH_PARAMS}
+
+    same_index = old_index.get("type") == new_index.get("type") and build_params(old_index) == build_params(new_index)
+    if not (same_model and same_index):
+        return False
+    if isinstance(index, faiss.IndexIDMap2):
+        return isinstance(faiss.downcast_index(index.index), (faiss.IndexFlat, faiss.IndexScalarQuantizer))
+    return isinstance(index, faiss.IndexIVF)
+
+
+def update_faiss_index(
+    index: "faiss.Index",
+    old_metadata: List[Dict[str, Any]],
+    metadata: List[Dict[str, Any]],
+    vectors: np.ndarray,
+) -> Dict[str, int]:
+    """
+    Cập nhật index đã có theo ID: xóa tài liệu bị xóa/đã sửa, thêm tài liệu mới/đã sửa
+    vectors cùng thứ tự với metadata mới; trả về số lượng reused/added/removed
+    """
+    old_hashes = {int(item["vid"]): item.get("hash", "") for item in old_metadata if "vid" in item}
+    new_hashes = {int(item["vid"]): item.get("hash", "") for item in metadata}
+
+    removed = [vid for vid, h in old_hashes.items() if new_hashes.get(vid) != h]
+    added_pos = [pos for pos, item in enumerate(metadata) if old_hashes.get(int(item["vid"])) != item.get("hash", "")]
+
+    if removed:
+        index.remove_ids(np.array(removed, dtype=np.int64))
+    if added_pos:
+        new_vectors = np.ascontiguousarray(vectors[added_pos], dtype=np.float32)
+        faiss.normalize_L2(new_vectors)
+        ids = np.array([int(metadata[pos]["vid"]) for pos in added_pos], dtype=np.int64)
+        index.add_with_ids(new_vectors, ids)
+    return {
+        "reused": len(metadata) - len(added_pos),
+        "added": len(added_pos),
+        "removed": len(removed),
+    }
+
+
+def save_index(
+    index: "faiss.Index",
+    metadata: List[Dict[str, str]],
+    index_dir: str,
+    texts: Optional[List[str]] = None,
+    manifest: Optional[Dict[str, Any]] = None,
+    parents: Optional[List[str]] = None,
+) -> None:
+    """
+    Lưu FAISS index và metadata vào thư mục
+    Nếu có texts (cùng thứ tự với metadata), ghi thêm corpus đóng gói để truy xuất không cần đọc file lẻ
+    và chỉ mục BM25 cho tìm kiếm từ vựng
+    parents: nội dung điều luật gốc khi metadata là các khoản/điểm (trường "parent" là vị trí trong parents)
+    """
     os.makedirs(index_dir, exist_ok=True)
+    # Ghi corpus và bảng số điều trước metadata để metadata mới luôn đi kèm dữ liệu mới
+    if texts is not None:
+        corpus.write_corpus(texts, index_dir)
+        lexical.save_bm25(texts, index_dir)
+        if parents is not None:
+            corpus.write_corpus(parents, index_dir, corpus.PARENTS_NAME)
+        else:
+            corpus.remove_corpus(index_dir, corpus.PARENTS_NAME)
+    with open(os.path.join(index_dir, index_cache.ARTICLES_FILE), "w", encoding="utf-8") as f:
+        json.dump(index_cache.build_article_map(metadata), f, ensure_ascii=False)
+    # Bản metadata đóng gói và bảng vid -> vị trí để server nạp qua mmap (metadata.json vẫn dùng khi cập nhật index)
+    corpus.write_records(metadata, index_dir, corpus.METADATA_NAME)
+    id_map = index_cache.build_id_map(metadata)
+    id_map_path = os.path.join(index_dir, index_cache.ID_MAP_FILE)
+    if id_map is not None:
+        corpus.save_array(id_map_path, id_map)
+    elif os.path.isfile(id_map_path):
+        os.remove(id_map_path)
     # Lưu index
-    faiss.write_index(index, os.path.join(index_dir, "index.faiss"))
+    write_index(index, index_dir)
+    # Lưu manifest (provider, model, số chiều...) để lần embed sau biết có thể cập nhật tăng dần
+    if manifest is not None:
+        with open(os.path.join(index_dir, index_cache.MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
     # Lưu metadata
     with open(os.path.join(index_dir, "metadata.json"), "w", encoding="utf-8") as f:
         json.dump(metadata, f, ensure_ascii=False, indent=2)
 
 
-
-
+def save_shards_manifest(index_dir: str, shards: List[Dict[str, Any]]) -> None:
+    """Ghi shards.json liệt kê các shard (luật) trong index_dir"""
+    os.makedirs(index_dir, exist_ok=True)
+    path = os.path.join(index_dir, index_cache.SHARDS_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"shards": shards}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
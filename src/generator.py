@@ -3,40 +3,229 @@ Module tạo sinh câu trả lời sử dụng Groq LLM
 Kết hợp ngữ cảnh được truy xuất với câu hỏi để tạo câu trả lời
 """
 
+import asyncio
+import hashlib
+import math
 import os
-from typing import List
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 
 from dotenv import load_dotenv
 
-try:
-    from groq import Groq  # type: ignore
-except Exception as exc:
-    raise RuntimeError(
-        "groq SDK is required. Please install dependencies (pip install -r requirements.txt)."
-    ) from exc
+from . import lazy, metrics
 
+# Import trễ: groq chỉ cần khi gọi LLM, tiktoken (tùy chọn) khi ước lượng token lần đầu
+groq = lazy.LazyModule("groq", "groq SDK is required. Please install dependencies (pip install -r requirements.txt).")
+tiktoken = lazy.LazyModule("tiktoken", "tiktoken is not installed.")
 
-def format_context(chunks: List[str], max_chars: int = 20000) -> str:
-    """Ghép các đoạn văn bản thành ngữ cảnh, giới hạn độ dài"""
-    joined = "\n\n".join(chunks)
-    return joined[:max_chars]
+# Số lời gọi LLM đồng thời tối đa trên mỗi tiến trình (tránh vượt rate limit của Groq)
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "8"))
 
+# Client dùng chung (giữ kết nối HTTP keep-alive giữa các request)
+_client: Optional["groq.Groq"] = None
+_async_client: Optional["groq.AsyncGroq"] = None
+_client_lock = threading.Lock()
+_llm_semaphore: Optional[asyncio.Semaphore] = None
 
-def generate_answer(query: str, contexts: List[str], model: str = "llama-3.3-70b-versatile") -> str:
-    """
-    Tạo câu trả lời dựa trên câu hỏi và ngữ cảnh được truy xuất
-    Sử dụng Groq LLM với prompt được thiết kế cho pháp luật Việt Nam
-    """
-    load_dotenv()
+
+def _api_key() -> str:
     api_key = os.environ.get("GROQ_API_KEY")
+    if not api_key:
+        load_dotenv()
+        api_key = os.environ.get("GROQ_API_KEY")
     if not api_key:
         raise EnvironmentError("GROQ_API_KEY chưa được thiết lập trong biến môi trường")
+    return api_key
+
+
+def get_client() -> "groq.Groq":
+    """Lấy Groq client dùng chung (tạo một lần)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = groq.Groq(api_key=_api_key())
+        return _client
+
+
+def get_async_client() -> "groq.AsyncGroq":
+    """Lấy AsyncGroq client dùng chung, giữ kết nối keep-alive cho luồng async"""
+    global _async_client
+    with _client_lock:
+        if _async_client is None:
+            _async_client = groq.AsyncGroq(api_key=_api_key())
+        return _async_client
+
+
+async def aclose_clients() -> None:
+    """Đóng các client dùng chung (gọi khi tắt ứng dụng)"""
+    global _client, _async_client, _llm_semaphore
+    with _client_lock:
+        client, async_client = _client, _async_client
+        _client, _async_client, _llm_semaphore = None, None, None
+    if async_client is not None:
+        await async_client.close()
+    if client is not None:
+        client.close()
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(max(1, LLM_CONCURRENCY))
+    return _llm_semaphore
+
+
+# Số token tối đa cho câu trả lời của LLM
+MAX_ANSWER_TOKENS = 800
+# Ngân sách token cho phần ngữ cảnh (giảm để tiết kiệm chi phí/độ trễ), không vượt quá cửa sổ ngữ cảnh của model
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "6000"))
+# Cửa sổ ngữ cảnh (token) của các model Groq thường dùng; model khác dùng DEFAULT_CONTEXT_WINDOW
+MODEL_CONTEXT_WINDOWS = {
+    "llama-3.3-70b-versatile": 131072,
+    "llama-3.1-8b-instant": 131072,
+    "gemma2-9b-it": 8192,
+    "mixtral-8x7b-32768": 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Token dành cho system prompt, câu hỏi và phần hướng dẫn ngoài ngữ cảnh
+PROMPT_RESERVE_TOKENS = 512
+# Ước lượng khi không có tiktoken: văn bản tiếng Việt có dấu trung bình ~3 ký tự mỗi token
+CHARS_PER_TOKEN = 3.0
+# Phần còn lại của ngân sách phải đủ lớn mới cắt bớt một điều luật để chèn vào
+MIN_PARTIAL_TOKENS = 200
+
+Chunk = Union[str, Dict[str, Any]]
+
+_encoding = None
+_encoding_checked = False
+
+
+def _get_encoding():
+    """Tokenizer tiktoken (import ở lần gọi đầu), None nếu chưa cài"""
+    global _encoding, _encoding_checked
+    if not _encoding_checked:
+        if lazy.is_available(tiktoken):
+            _encoding = lazy.load(tiktoken).get_encoding("cl100k_base")
+        _encoding_checked = True
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token của văn bản bằng tokenizer cục bộ (tiktoken nếu có, ngược lại theo số ký tự)"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def context_budget(model: Optional[str] = None) -> int:
+    """Ngân sách token cho ngữ cảnh của model: min(CONTEXT_TOKEN_BUDGET, cửa sổ - câu trả lời - prompt)"""
+    window = MODEL_CONTEXT_WINDOWS.get(model or "", DEFAULT_CONTEXT_WINDOW)
+    return max(0, min(CONTEXT_TOKEN_BUDGET, window - MAX_ANSWER_TOKENS - PROMPT_RESERVE_TOKENS))
+
+
+def _chunk_key(chunk: Dict[str, Any]) -> str:
+    """Khóa khử trùng lặp: (luật, ID điều luật), đoạn không có ID dùng hash nội dung"""
+    if chunk.get("id"):
+        return f"{chunk.get('law', '')}/{chunk['id']}"
+    return hashlib.sha1(str(chunk.get("text", "")).encode("utf-8")).hexdigest()
+
 
-    client = Groq(api_key=api_key)
+def _chunk_title(chunk: Dict[str, Any]) -> str:
+    """Nhãn nguồn của điều luật trong ngữ cảnh, ví dụ "luat_lao_dong/điều_67" hoặc "điều_67 khoản 2" """
+    doc_id, _, fragment = str(chunk.get("id", "")).partition("#")
+    source = os.path.splitext(doc_id)[0]
+    law = str(chunk.get("law", ""))
+    if law and not source.startswith(law + "/"):
+        source = f"{law}/{source}" if source else law
+    if fragment:
+        source = f"{source} {fragment.replace('_', ' ')}"
+    return source
+
+
+def _truncate_lines(text: str, max_tokens: int) -> str:
+    """
+    Cắt văn bản theo ranh giới dòng (khoản/điểm) để vừa max_tokens
+    Nếu dòng đầu tiên đã vượt ngân sách (văn bản không xuống dòng) thì cắt theo token/ký tự
+    """
+    kept: List[str] = []
+    used = 0
+    for line in text.splitlines():
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+    if kept:
+        return "\n".join(kept)
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text)[: max(0, max_tokens)]).strip()
+    return text[: int(max(0, max_tokens) * CHARS_PER_TOKEN)].strip()
+
+
+def format_context(chunks: List[Chunk], max_tokens: Optional[int] = None, model: Optional[str] = None) -> str:
+    """
+    Ghép các điều luật thành ngữ cảnh trong ngân sách token
+    Chunk là chuỗi hoặc dict (id, law, score, text); điều nhắc trực tiếp (không có score) được ưu tiên,
+    sau đó theo score giảm dần. Bỏ điều trùng ID và khoản/điểm đã nằm trong điều đầy đủ (dù xếp trước hay sau),
+    mỗi điều có nhãn [n] để trích dẫn, điều không vừa ngân sách được cắt theo dòng thay vì cắt giữa chừng
+    """
+    budget = context_budget(model) if max_tokens is None else max_tokens
+    items = [{"text": c} if isinstance(c, str) else c for c in chunks]
+    # Điều nhắc trực tiếp ("Điều N") đứng trước, kết quả tìm kiếm theo score giảm dần (sort ổn định)
+    ranked = sorted(
+        enumerate(items),
+        key=lambda p: (0, -float("inf")) if p[1].get("score") in (None, "") else (1, -float(p[1]["score"])),
+    )
+
+    selected: List[List[Any]] = []  # [khóa, nhãn nguồn, nội dung, số token]
+    used = 0
+    for _, chunk in ranked:
+        text = str(chunk.get("text", "")).strip()
+        key = _chunk_key(chunk)
+        keys = {entry[0] for entry in selected}
+        # Khoản/điểm ("<điều>#<nhãn>") của điều đã có nguyên văn trong ngữ cảnh thì bỏ qua
+        parent_key = key.partition("#")[0]
+        if not text or key in keys or parent_key in keys:
+            continue
+        # Điều đầy đủ thay cho các khoản của nó đã chọn trước đó (giữ vị trí của khoản xếp hạng cao nhất)
+        children = [i for i, entry in enumerate(selected) if entry[0].partition("#")[0] == key and "#" in entry[0]]
+        freed = sum(selected[i][3] for i in children)
+        title = _chunk_title(chunk)
+        header = f"[{len(selected) + 1}] {title}" if title else f"[{len(selected) + 1}]"
+        cost = estimate_tokens(header) + estimate_tokens(text) + 2
+        remaining = budget - used + freed
+        if cost > remaining:
+            if remaining - estimate_tokens(header) < MIN_PARTIAL_TOKENS:
+                continue  # Điều nhỏ hơn phía sau vẫn có thể vừa
+            text = _truncate_lines(text, remaining - estimate_tokens(header) - 2)
+            if not text:
+                continue
+            cost = estimate_tokens(header) + estimate_tokens(text) + 2
+        entry = [key, title, text, cost]
+        if children:
+            selected[children[0]] = entry
+            for i in reversed(children[1:]):
+                del selected[i]
+        else:
+            selected.append(entry)
+        used += cost - freed
+
+    parts = []
+    for n, (_, title, text, _) in enumerate(selected, 1):
+        header = f"[{n}] {title}" if title else f"[{n}]"
+        parts.append(f"{header}\n{text}")
+    return "\n\n".join(parts)
+
+
+def build_messages(query: str, contexts: List[Chunk], model: Optional[str] = None) -> List[Dict[str, str]]:
+    """Tạo danh sách message (system + user) gửi cho LLM"""
+    # Chuẩn bị ngữ cảnh trong ngân sách token của model
+    with metrics.stage("context_packing"):
+        context_block = format_context(contexts, model=model)
 
-    # Chuẩn bị ngữ cảnh
-    context_block = format_context(contexts)
-    
     # Thiết kế prompt phù hợp với pháp luật
     system_prompt = (
         "Bạn là trợ lý trả lời câu hỏi dựa trên ngữ cảnh pháp luật Việt Nam. "
@@ -44,19 +233,85 @@ def generate_answer(query: str, contexts: List[str], model: str = "llama-3.3-70b
     )
     user_prompt = (
         f"Ngữ cảnh:\n{context_block}\n\nCâu hỏi: {query}\n"
-        "Yêu cầu: Trả lời ngắn gọn, kèm trích dẫn điều luật (nếu có)."
+        "Yêu cầu: Trả lời ngắn gọn, kèm trích dẫn điều luật (nếu có) theo nhãn nguồn [n]."
     )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def generate_answer(query: str, contexts: List[Chunk], model: str = "llama-3.3-70b-versatile") -> str:
+    """
+    Tạo câu trả lời dựa trên câu hỏi và ngữ cảnh được truy xuất
+    Sử dụng Groq LLM với prompt được thiết kế cho pháp luật Việt Nam
+    """
+    client = get_client()
+    messages = build_messages(query, contexts, model)
 
     # Gọi Groq API
-    resp = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.2,  # Thấp để có câu trả lời ổn định
-        max_tokens=800,
-    )
+    with metrics.stage("llm"):
+        resp = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.2,  # Thấp để có câu trả lời ổn định
+            max_tokens=MAX_ANSWER_TOKENS,
+        )
     return resp.choices[0].message.content or ""
 
 
+async def generate_answer_async(query: str, contexts: List[Chunk], model: str = "llama-3.3-70b-versatile") -> str:
+    """
+    Phiên bản async của generate_answer: dùng AsyncGroq client dùng chung
+    Số lời gọi đồng thời bị giới hạn bởi LLM_CONCURRENCY
+    """
+    client = get_async_client()
+    messages = build_messages(query, contexts, model)
+    with metrics.stage("llm_wait"):
+        await _get_semaphore().acquire()
+    try:
+        with metrics.stage("llm"):
+            resp = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.2,  # Thấp để có câu trả lời ổn định
+                max_tokens=MAX_ANSWER_TOKENS,
+            )
+    finally:
+        _get_semaphore().release()
+    return resp.choices[0].message.content or ""
+
+
+async def stream_answer_async(
+    query: str, contexts: List[Chunk], model: str = "llama-3.3-70b-versatile"
+) -> AsyncIterator[str]:
+    """
+    Sinh câu trả lời dạng streaming: trả về từng đoạn token ngay khi LLM gửi về
+    Giữ chỗ trong semaphore LLM cho tới khi stream kết thúc; đo riêng thời gian tới token đầu tiên (llm_first_token)
+    """
+    client = get_async_client()
+    messages = build_messages(query, contexts, model)
+    with metrics.stage("llm_wait"):
+        await _get_semaphore().acquire()
+    try:
+        with metrics.stage("llm"):
+            start = time.perf_counter()
+            first = True
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.2,  # Thấp để có câu trả lời ổn định
+                max_tokens=MAX_ANSWER_TOKENS,
+                stream=True,
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first:
+                        metrics.record("llm_first_token", time.perf_counter() - start, start)
+                        first = False
+                    yield delta
+    finally:
+        _get_semaphore().release()
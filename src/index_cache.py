@@ -0,0 +1,316 @@
+"""
+Module cache FAISS index và metadata trong bộ nhớ tiến trình
+Giữ index đã tải theo từng index_dir, tự tải lại khi file thay đổi
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from . import corpus
+from . import lexical
+from . import metrics
+from . import splitter
+
+INDEX_FILE = "index.faiss"
+METADATA_FILE = "metadata.json"
+ARTICLES_FILE = "articles.json"
+MANIFEST_FILE = "manifest.json"
+SHARDS_FILE = "shards.json"
+# Bảng vid -> vị trí trong metadata (mảng 2 x N sắp theo vid) cho index dựng với ID, nạp qua mmap
+ID_MAP_FILE = "id_map.npy"
+
+# Giới hạn bộ nhớ (bytes) cho toàn bộ index đang cache, vượt quá sẽ loại bỏ theo LRU
+CACHE_MAX_BYTES = int(os.environ.get("INDEX_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Khoảng thời gian (giây) giữa hai lần kiểm tra mtime của file index
+CHECK_INTERVAL = float(os.environ.get("INDEX_CACHE_CHECK_INTERVAL", "1.0"))
+
+Signature = Tuple[Tuple[int, int], ...]
+
+
+def index_signature(index_dir: str) -> Signature:
+    """Tạo chữ ký (mtime, size) của các file index để phát hiện thay đổi"""
+    parts = []
+    for name in (INDEX_FILE, METADATA_FILE):
+        st = os.stat(os.path.join(index_dir, name))
+        parts.append((st.st_mtime_ns, st.st_size))
+    return tuple(parts)
+
+
+def build_article_map(metadata: List[Dict[str, str]]) -> Dict[str, int]:
+    """Tạo bảng tra cứu chính xác: số điều -> vị trí tài liệu trong metadata (khoản đầu tiên nếu chia theo khoản)"""
+    article_map: Dict[str, int] = {}
+    for pos, item in enumerate(metadata):
+        number = splitter.article_number_from_filename(str(item.get("parent_id", item.get("id", ""))))
+        if number and number not in article_map:
+            article_map[number] = pos
+    return article_map
+
+
+def build_id_map(metadata: Sequence[Dict[str, Any]]) -> Optional[np.ndarray]:
+    """Mảng [vids đã sắp xếp, vị trí tương ứng] để đổi nhãn FAISS về vị trí bằng tìm kiếm nhị phân"""
+    if not len(metadata) or "vid" not in metadata[0]:
+        return None
+    vids = np.fromiter((int(item["vid"]) for item in metadata), dtype=np.int64, count=len(metadata))
+    order = np.argsort(vids, kind="stable")
+    return np.stack([vids[order], order.astype(np.int64)])
+
+
+def load_id_map(index_dir: str, metadata: Sequence[Dict[str, Any]]) -> Optional[np.ndarray]:
+    """Nạp bảng vid -> vị trí qua mmap; index cũ chưa có file thì dựng lại từ metadata"""
+    path = os.path.join(index_dir, ID_MAP_FILE)
+    if os.path.isfile(path):
+        id_map = corpus.load_array(path)
+        if id_map.shape == (2, len(metadata)):
+            return id_map
+    return build_id_map(metadata)
+
+
+def load_metadata(index_dir: str) -> Sequence[Dict[str, Any]]:
+    """
+    Metadata của index: bản đóng gói đọc qua mmap (các worker dùng chung, không giữ list dict) nếu có,
+    ngược lại đọc metadata.json (index cũ)
+    """
+    if corpus.has_corpus(index_dir, corpus.METADATA_NAME):
+        return corpus.RecordReader(index_dir, corpus.METADATA_NAME)
+    with open(os.path.join(index_dir, METADATA_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_article_map(index_dir: str, metadata: Sequence[Dict[str, str]]) -> Dict[str, int]:
+    """Tải bảng số điều -> vị trí trong metadata; index cũ chưa có file thì dựng lại từ metadata"""
+    try:
+        with open(os.path.join(index_dir, ARTICLES_FILE), "r", encoding="utf-8") as f:
+            article_map = {str(k): int(v) for k, v in json.load(f).items()}
+        if all(0 <= pos < len(metadata) for pos in article_map.values()):
+            return article_map
+    except (OSError, ValueError):
+        pass
+    return build_article_map(metadata)
+
+
+class LoadedIndex:
+    """Một index đã tải vào bộ nhớ cùng metadata và chữ ký phiên bản"""
+
+    def __init__(self, index_dir: str, index: Any, metadata: Sequence[Dict[str, str]], signature: Signature) -> None:
+        self.index_dir = index_dir
+        self.index = index
+        self.metadata = metadata
+        self.signature = signature
+        self.nbytes = sum(size for _, size in signature)
+        self.checked_at = time.monotonic()
+        # Corpus đóng gói (mmap); index cũ không có thì đọc theo path trong metadata
+        self.corpus = corpus.CorpusReader(index_dir) if corpus.has_corpus(index_dir) else None
+        if self.corpus is not None and len(self.corpus) != len(metadata):
+            self.corpus = None
+        self.article_map = load_article_map(index_dir, metadata)
+        # Index chia theo khoản/điểm: nội dung điều gốc để mở rộng kết quả về cả điều
+        self.parents = None
+        if metadata and "parent" in metadata[0] and corpus.has_corpus(index_dir, corpus.PARENTS_NAME):
+            self.parents = corpus.CorpusReader(index_dir, corpus.PARENTS_NAME)
+        # Chỉ mục BM25 cho tìm kiếm từ vựng; index cũ chưa có thì chỉ tìm được bằng vector
+        self.bm25 = lexical.BM25Index(index_dir) if lexical.has_bm25(index_dir) else None
+        if self.bm25 is not None and self.bm25.n_docs != len(metadata):
+            self.bm25 = None
+        # Index dựng với ID (IndexIDMap2) trả về vid khi search, cần ánh xạ về vị trí trong metadata
+        self.id_map = load_id_map(index_dir, metadata)
+
+    def position(self, label: int) -> int:
+        """Đổi nhãn trả về từ index.search thành vị trí trong metadata (-1 nếu không hợp lệ)"""
+        if self.id_map is not None:
+            vids = self.id_map[0]
+            i = int(np.searchsorted(vids, label))
+            return int(self.id_map[1, i]) if i < len(vids) and vids[i] == label else -1
+        return int(label) if 0 <= label < len(self.metadata) else -1
+
+    def get_text(self, pos: int) -> str:
+        """Lấy nội dung văn bản thứ pos trong metadata"""
+        if self.corpus is not None:
+            return self.corpus.get(pos)
+        try:
+            with open(self.metadata[pos].get("path", ""), "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except Exception:
+            return ""
+
+    def get_parent(self, pos: int) -> Tuple[str, str]:
+        """Lấy (ID, nội dung) của điều luật chứa tài liệu thứ pos; index chia theo điều trả về chính nó"""
+        item = self.metadata[pos]
+        if self.parents is not None and "parent" in item:
+            return str(item.get("parent_id", "")), self.parents.get(int(item["parent"]))
+        return str(item.get("id", "")), self.get_text(pos)
+
+    @property
+    def version(self) -> str:
+        """Chuỗi phiên bản của index, thay đổi mỗi khi file index được ghi lại"""
+        return "-".join(f"{mtime}.{size}" for mtime, size in self.signature)
+
+
+class IndexRegistry:
+    """
+    Registry giữ các index đã tải theo index_dir (LRU, thread-safe)
+    Tự tải lại khi mtime/size của file thay đổi và loại bỏ khi vượt giới hạn bộ nhớ
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, check_interval: float = CHECK_INTERVAL) -> None:
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._entries: "OrderedDict[str, LoadedIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        # Thư mục của phiên bản index đã thay thế (reload): vẫn tải được cho request đang chạy nhưng không cache lại
+        self._retired: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def _load_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            lock = self._load_locks.get(key)
+            if lock is None:
+                lock = self._load_locks[key] = threading.Lock()
+            return lock
+
+    def _lookup(self, key: str) -> Optional[LoadedIndex]:
+        """Lấy entry còn hợp lệ từ cache, None nếu chưa có hoặc đã cũ"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            now = time.monotonic()
+            if now - entry.checked_at < self.check_interval:
+                self._entries.move_to_end(key)
+                return entry
+        # Kiểm tra file ngoài lock để không chặn các request khác
+        try:
+            current = index_signature(key)
+        except OSError:
+            current = None
+        with self._lock:
+            if current is not None and current == entry.signature:
+                entry.checked_at = time.monotonic()
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                return entry
+        return None
+
+    def get(self, index_dir: str) -> LoadedIndex:
+        """Trả về index đã tải cho index_dir, tải (lại) từ đĩa nếu cần"""
+        key = os.path.abspath(index_dir)
+        entry = self._lookup(key)
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry
+
+        with self._load_lock(key):
+            # Một request khác có thể đã tải xong trong lúc chờ lock
+            entry = self._lookup(key)
+            if entry is not None:
+                with self._lock:
+                    self.hits += 1
+                return entry
+
+            from .retriever import load_index
+
+            with metrics.stage("index_load"):
+                signature = index_signature(key)
+                index, metadata = load_index(key)
+                # Nếu file bị ghi lại trong lúc đang đọc, chữ ký mới sẽ khiến lần sau tải lại
+                entry = LoadedIndex(key, index, metadata, signature)
+            with self._lock:
+                self.misses += 1
+                if key in self._retired:
+                    return entry
+                if key in self._entries:
+                    self.reloads += 1
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                self._evict_locked(keep=key)
+            return entry
+
+    def _evict_locked(self, keep: str) -> None:
+        """Loại bỏ các index ít dùng nhất cho tới khi nằm trong giới hạn bộ nhớ"""
+        total = sum(e.nbytes for e in self._entries.values())
+        for key in list(self._entries.keys()):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._entries.pop(key).nbytes
+            self.evictions += 1
+
+    def invalidate(self, index_dir: Optional[str] = None) -> None:
+        """Xóa một (hoặc tất cả) index khỏi cache"""
+        with self._lock:
+            if index_dir is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(index_dir), None)
+
+    def retire(self, index_dirs: Sequence[str]) -> None:
+        """Bỏ các index của phiên bản cũ khỏi cache và không cache lại khi request đang chạy còn đọc tới"""
+        with self._lock:
+            for index_dir in index_dirs:
+                key = os.path.abspath(index_dir)
+                self._retired.add(key)
+                self._entries.pop(key, None)
+
+    def restore(self, index_dirs: Sequence[str]) -> None:
+        """Cho phép cache lại các index (ví dụ khi rollback về phiên bản đã thay thế)"""
+        with self._lock:
+            for index_dir in index_dirs:
+                self._retired.discard(os.path.abspath(index_dir))
+
+    def stats(self) -> Dict[str, Any]:
+        """Thống kê trạng thái cache"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e.nbytes for e in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+            }
+
+
+_shards_cache: Dict[str, Tuple[int, List[Dict[str, Any]]]] = {}
+_shards_lock = threading.Lock()
+
+
+def load_shards(index_dir: str) -> List[Dict[str, Any]]:
+    """
+    Đọc danh sách shard (mỗi luật một index con) từ shards.json, cache theo mtime
+    Trả về [] nếu index_dir là index đơn (không chia shard)
+    """
+    path = os.path.join(os.path.abspath(index_dir), SHARDS_FILE)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return []
+    with _shards_lock:
+        cached = _shards_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(path, "r", encoding="utf-8") as f:
+        shards = json.load(f).get("shards", [])
+    with _shards_lock:
+        _shards_cache[path] = (mtime, shards)
+    return shards
+
+
+# Registry dùng chung cho toàn tiến trình
+registry = IndexRegistry()
+
+
+def get_index(index_dir: str) -> LoadedIndex:
+    """Lấy index đã cache từ registry dùng chung"""
+    return registry.get(index_dir)
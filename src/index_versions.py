@@ -0,0 +1,244 @@
+"""
+Module quản lý phiên bản index: mỗi lần embed ghi vào index_dir/versions/<phiên bản>,
+xong mới công bố bằng cách thay file con trỏ index_dir/CURRENT một cách nguyên tử (os.replace)
+Tiến trình phục vụ ghim phiên bản đang dùng và chỉ chuyển sang bản mới sau khi đã tải xong (reload),
+các phiên bản cũ được giữ lại để rollback
+"""
+
+import atexit
+import os
+import shutil
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from . import index_cache
+
+VERSIONS_DIR = "versions"
+CURRENT_FILE = "CURRENT"
+# Lease của các tiến trình đang phục vụ: versions/.pins/<host>-<pid> chứa phiên bản đã ghim, prune không xóa các bản này
+PINS_DIR = ".pins"
+# Số phiên bản giữ lại (tính cả phiên bản hiện tại) để rollback, phiên bản cũ hơn bị xóa sau mỗi lần embed
+KEEP_VERSIONS = int(os.environ.get("INDEX_KEEP_VERSIONS", "3"))
+
+# Phiên bản đang phục vụ theo index_dir ("" = index cũ ghi trực tiếp vào index_dir)
+_pinned: Dict[str, str] = {}
+_pinned_lock = threading.Lock()
+
+
+def version_dir(index_dir: str, version: str) -> str:
+    """Thư mục chứa một phiên bản; phiên bản rỗng là chính index_dir (bố cục cũ)"""
+    return os.path.join(index_dir, VERSIONS_DIR, version) if version else index_dir
+
+
+def read_current(index_dir: str) -> str:
+    """Phiên bản đã công bố (nội dung file CURRENT), "" nếu index_dir chưa dùng phiên bản"""
+    try:
+        with open(os.path.join(index_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def is_complete(path: str) -> bool:
+    """Thư mục có index đầy đủ (index đơn hoặc danh sách shard)"""
+    return any(
+        os.path.isfile(os.path.join(path, name))
+        for name in (index_cache.METADATA_FILE, index_cache.SHARDS_FILE)
+    )
+
+
+def list_versions(index_dir: str) -> List[str]:
+    """Các phiên bản đã dựng xong, cũ trước mới sau (tên phiên bản sắp xếp theo thời gian tạo)"""
+    root = os.path.join(index_dir, VERSIONS_DIR)
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if is_complete(os.path.join(root, name)))
+
+
+def create_version(index_dir: str) -> Tuple[str, str]:
+    """
+    Tạo thư mục cho phiên bản mới (chưa công bố), trả về (tên phiên bản, thư mục)
+    Tên luôn lớn hơn mọi phiên bản đã có (kể cả bản đã xóa khi còn là bản công bố) để thứ tự phiên bản đúng thứ tự dựng
+    """
+    root = os.path.join(index_dir, VERSIONS_DIR)
+    os.makedirs(root, exist_ok=True)
+    latest = max([name for name in os.listdir(root) if name != PINS_DIR] + [read_current(index_dir)])
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    for attempt in range(1000):
+        version = f"{stamp}-{attempt:03d}"
+        if version <= latest:
+            continue
+        path = os.path.join(root, version)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            continue
+        return version, path
+    raise RuntimeError(f"Cannot allocate a new index version in {root}")
+
+
+def publish(index_dir: str, version: str) -> None:
+    """Công bố phiên bản: ghi CURRENT.tmp rồi os.replace, người đọc chỉ thấy con trỏ cũ hoặc mới"""
+    if not is_complete(version_dir(index_dir, version)):
+        raise ValueError(f"Phiên bản index chưa hoàn chỉnh hoặc không tồn tại: {version}")
+    path = os.path.join(index_dir, CURRENT_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def previous_version(index_dir: str, version: Optional[str] = None) -> str:
+    """Phiên bản liền trước version (mặc định: phiên bản đã công bố) để rollback"""
+    current = version if version is not None else read_current(index_dir)
+    older = [name for name in list_versions(index_dir) if name < current]
+    if not older:
+        raise ValueError(f"Không có phiên bản cũ hơn {current or '(chưa có)'} để rollback trong {index_dir}")
+    return older[-1]
+
+
+def rollback(index_dir: str, version: Optional[str] = None) -> str:
+    """Công bố lại một phiên bản cũ (mặc định: bản liền trước bản hiện tại), trả về phiên bản đã công bố"""
+    target = version or previous_version(index_dir)
+    if target not in list_versions(index_dir):
+        raise ValueError(f"Không tìm thấy phiên bản index: {target}")
+    publish(index_dir, target)
+    return target
+
+
+def _lease_path(index_dir: str) -> str:
+    return os.path.join(index_dir, VERSIONS_DIR, PINS_DIR, f"{socket.gethostname()}-{os.getpid()}")
+
+
+def _write_lease(index_dir: str, version: str) -> None:
+    """Ghi (hoặc xóa khi version rỗng) lease của tiến trình này; thư mục chỉ đọc thì bỏ qua"""
+    path = _lease_path(index_dir)
+    try:
+        if not version:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(version + "\n")
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def live_pins(index_dir: str) -> Set[str]:
+    """
+    Các phiên bản đang được tiến trình nào đó phục vụ (theo lease); lease của tiến trình đã dừng
+    trên cùng máy bị xóa, lease của máy khác luôn được tôn trọng
+    """
+    root = os.path.join(index_dir, VERSIONS_DIR, PINS_DIR)
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return set()
+    host = socket.gethostname()
+    versions: Set[str] = set()
+    for name in names:
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(root, name)
+        lease_host, _, pid = name.rpartition("-")
+        if lease_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                versions.add(f.read().strip())
+        except OSError:
+            continue
+    return versions
+
+
+def prune(index_dir: str, keep: int = KEEP_VERSIONS) -> List[str]:
+    """
+    Xóa các phiên bản cũ, giữ keep bản mới nhất, bản đang công bố và các bản còn được tiến trình khác ghim
+    Chỉ xóa bản cũ hơn bản đang công bố để không đụng tới bản đang được tiến trình khác dựng
+    """
+    current = read_current(index_dir)
+    versions = list_versions(index_dir)
+    kept = set(versions[-max(1, keep):]) | {current} | live_pins(index_dir)
+    removed = [name for name in versions if name not in kept and name < current]
+    for name in removed:
+        shutil.rmtree(version_dir(index_dir, name), ignore_errors=True)
+    return removed
+
+
+def active_version(index_dir: str) -> str:
+    """
+    Phiên bản tiến trình này đang phục vụ cho index_dir: lần đầu ghim theo CURRENT,
+    sau đó chỉ đổi khi gọi pin (reload/rollback) để không chuyển phiên bản giữa chừng
+    """
+    key = os.path.abspath(index_dir)
+    with _pinned_lock:
+        version = _pinned.get(key)
+    if version is not None:
+        return version
+    version = read_current(key)
+    with _pinned_lock:
+        if key in _pinned:
+            return _pinned[key]
+        _pinned[key] = version
+        _write_lease(key, version)
+    return version
+
+
+def active_dir(index_dir: str) -> str:
+    """Thư mục index (phiên bản đang phục vụ) thay cho index_dir khi đọc"""
+    return version_dir(index_dir, active_version(index_dir))
+
+
+def pin(index_dir: str, version: str) -> Optional[str]:
+    """Chuyển tiến trình sang phiên bản version, trả về phiên bản trước đó (None nếu chưa ghim)"""
+    key = os.path.abspath(index_dir)
+    with _pinned_lock:
+        previous = _pinned.get(key)
+        _pinned[key] = version
+        _write_lease(key, version)  # Ghi trong lock để lease luôn khớp với phiên bản ghim mới nhất
+    return previous
+
+
+def pinned() -> Dict[str, str]:
+    """Các index_dir đã ghim và phiên bản đang phục vụ"""
+    with _pinned_lock:
+        return dict(_pinned)
+
+
+def describe(index_dir: str) -> Dict[str, Any]:
+    """Trạng thái phiên bản của index_dir: đã công bố, đang phục vụ và danh sách phiên bản"""
+    return {
+        "index_dir": index_dir,
+        "current": read_current(index_dir),
+        "active": pinned().get(os.path.abspath(index_dir)),
+        "versions": list_versions(index_dir),
+    }
+
+
+@atexit.register
+def _release_leases() -> None:
+    for index_dir in pinned():
+        _write_lease(index_dir, "")
@@ -0,0 +1,65 @@
+"""
+Module import trễ cho các thư viện nặng (faiss, openai, sentence-transformers/torch, groq, tiktoken, pdfplumber)
+Thư viện chỉ được import khi code thực sự dùng tới, để lệnh CLI và API khởi động nhanh
+"""
+
+import importlib
+import importlib.util
+import threading
+from types import ModuleType
+from typing import Any, Optional
+
+_import_lock = threading.RLock()
+
+
+class LazyModule:
+    """
+    Đại diện cho một module chưa import: truy cập thuộc tính đầu tiên mới import thật
+    Thiếu thư viện thì báo RuntimeError với hướng dẫn cài đặt (giống khi import trực tiếp)
+    """
+
+    def __init__(self, name: str, missing_message: str) -> None:
+        self.__dict__["_lazy_name"] = name
+        self.__dict__["_lazy_message"] = missing_message
+        self.__dict__["_lazy_module"] = None
+
+    def _lazy_load(self) -> ModuleType:
+        module: Optional[ModuleType] = self.__dict__["_lazy_module"]
+        if module is not None:
+            return module
+        with _import_lock:
+            module = self.__dict__["_lazy_module"]
+            if module is None:
+                try:
+                    module = importlib.import_module(self.__dict__["_lazy_name"])
+                except Exception as exc:
+                    raise RuntimeError(self.__dict__["_lazy_message"]) from exc
+                self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._lazy_load(), attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module {self.__dict__['_lazy_name']!r} ({state})>"
+
+
+def load(module: LazyModule) -> ModuleType:
+    """Import ngay (ví dụ khi warm-up), trả về module thật"""
+    return module._lazy_load()
+
+
+def is_loaded(module: LazyModule) -> bool:
+    """True nếu module đã được import (không kích hoạt import)"""
+    return module.__dict__["_lazy_module"] is not None
+
+
+def is_available(module: LazyModule) -> bool:
+    """True nếu thư viện đã cài (chỉ tìm module, không import)"""
+    if is_loaded(module):
+        return True
+    try:
+        return importlib.util.find_spec(module.__dict__["_lazy_name"]) is not None
+    except (ImportError, ValueError):
+        return False
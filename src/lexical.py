@@ -0,0 +1,170 @@
+"""
+Module chỉ mục từ vựng BM25 (sparse inverted index) cho tiếng Việt
+Bổ trợ cho tìm kiếm vector với các thuật ngữ pháp lý cần khớp chính xác ("thời giờ làm thêm", "trợ cấp thôi việc")
+"""
+
+import os
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import corpus
+
+# Định dạng cũ: một file npz, nạp toàn bộ vào bộ nhớ từng tiến trình
+BM25_FILE = "bm25.npz"
+# Định dạng mmap: các mảng bm25_<tên>.npy và danh sách từ đã sắp xếp (corpus đóng gói "bm25_terms")
+BM25_PREFIX = "bm25_"
+BM25_TERMS = "bm25_terms"
+BM25_ARRAYS = ("indptr", "doc_idx", "tf", "doc_len", "idf", "weights", "params")
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_REGEX = re.compile(r"\w+", re.UNICODE)
+# Hư từ rất phổ biến, không mang nghĩa phân biệt khi tìm kiếm
+STOPWORDS = frozenset(
+    "và của là các có được cho theo trong với này những một về khi thì mà để tại do hoặc từ đến như nếu".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tách từ tiếng Việt: chuẩn hóa Unicode NFC, chữ thường, tách âm tiết
+    Thêm bigram âm tiết liền kề (ví dụ "làm_thêm") vì từ tiếng Việt thường gồm nhiều âm tiết
+    """
+    syllables = TOKEN_REGEX.findall(unicodedata.normalize("NFC", text or "").lower())
+    tokens = [s for s in syllables if s not in STOPWORDS]
+    for left, right in zip(syllables, syllables[1:]):
+        if left not in STOPWORDS and right not in STOPWORDS:
+            tokens.append(f"{left}_{right}")
+    return tokens
+
+
+def _array_path(index_dir: str, name: str) -> str:
+    return os.path.join(index_dir, f"{BM25_PREFIX}{name}.npy")
+
+
+def bm25_weights(
+    indptr: np.ndarray, doc_idx: np.ndarray, tf: np.ndarray, doc_len: np.ndarray, k1: float = BM25_K1, b: float = BM25_B
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Tính idf theo từ và phần tf đã chuẩn hóa theo độ dài tài liệu cho mọi posting"""
+    n_docs = len(doc_len)
+    avgdl = float(doc_len.mean()) if n_docs else 0.0
+    df = np.diff(indptr).astype(np.float32)
+    idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+    norm = k1 * (1.0 - b + b * doc_len[doc_idx] / max(avgdl, 1e-9))
+    weights = (tf * (k1 + 1.0) / (tf + norm)).astype(np.float32)
+    return idf, weights
+
+
+def save_bm25(texts: List[str], index_dir: str) -> None:
+    """
+    Dựng inverted index BM25 cho texts (cùng thứ tự metadata) và lưu dạng mảng CSR .npy để nạp qua mmap
+    idf và trọng số posting được tính sẵn, nên khi tải không cần cấp phát bộ nhớ riêng cho từng tiến trình
+    """
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    doc_len = np.zeros(len(texts), dtype=np.float32)
+    for doc, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        doc_len[doc] = sum(counts.values())
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((doc, tf))
+
+    # Thứ tự code point của str trùng thứ tự byte UTF-8, nên tra cứu nhị phân trên corpus đóng gói được
+    terms = sorted(postings)
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(postings[t]) for t in terms])
+    doc_idx = np.empty(int(indptr[-1]), dtype=np.int32)
+    tf = np.empty(int(indptr[-1]), dtype=np.float32)
+    for i, term in enumerate(terms):
+        start, end = indptr[i], indptr[i + 1]
+        doc_idx[start:end] = [d for d, _ in postings[term]]
+        tf[start:end] = [c for _, c in postings[term]]
+    idf, weights = bm25_weights(indptr, doc_idx, tf, doc_len)
+
+    os.makedirs(index_dir, exist_ok=True)
+    arrays = {
+        "indptr": indptr, "doc_idx": doc_idx, "tf": tf, "doc_len": doc_len, "idf": idf, "weights": weights,
+        "params": np.array([BM25_K1, BM25_B], dtype=np.float64),
+    }
+    corpus.write_corpus(terms, index_dir, BM25_TERMS)
+    for name in BM25_ARRAYS:
+        corpus.save_array(_array_path(index_dir, name), arrays[name])
+    legacy = os.path.join(index_dir, BM25_FILE)
+    if os.path.isfile(legacy):
+        os.remove(legacy)
+
+
+def _has_mmap_format(index_dir: str) -> bool:
+    return corpus.has_corpus(index_dir, BM25_TERMS) and all(
+        os.path.isfile(_array_path(index_dir, name)) for name in BM25_ARRAYS
+    )
+
+
+def has_bm25(index_dir: str) -> bool:
+    return _has_mmap_format(index_dir) or os.path.isfile(os.path.join(index_dir, BM25_FILE))
+
+
+class _SortedTerms:
+    """Tra cứu từ -> chỉ số bằng tìm kiếm nhị phân trên danh sách từ đã sắp xếp (corpus đóng gói, mmap)"""
+
+    def __init__(self, reader: corpus.CorpusReader) -> None:
+        self._reader = reader
+
+    def __len__(self) -> int:
+        return len(self._reader)
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self._reader.view(i))
+
+    def get(self, term: str) -> Optional[int]:
+        key = term.encode("utf-8")
+        i = bisect_left(self, key)
+        return i if i < len(self) and self[i] == key else None
+
+
+class BM25Index:
+    """Inverted index BM25 đã tải, tìm kiếm bằng cộng dồn điểm trên posting list của các từ trong câu hỏi"""
+
+    def __init__(self, index_dir: str, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        if _has_mmap_format(index_dir):
+            # Định dạng mmap: các worker dùng chung mảng trong page cache, chỉ tính lại khi k1/b khác lúc lưu
+            arrays = {name: corpus.load_array(_array_path(index_dir, name)) for name in BM25_ARRAYS}
+            self.vocab: Any = _SortedTerms(corpus.CorpusReader(index_dir, BM25_TERMS))
+            self.indptr = arrays["indptr"]
+            self.doc_idx = arrays["doc_idx"]
+            self.n_docs = len(arrays["doc_len"])
+            if tuple(arrays["params"]) == (k1, b):
+                self.idf, self.weights = arrays["idf"], arrays["weights"]
+            else:
+                self.idf, self.weights = bm25_weights(
+                    self.indptr, self.doc_idx, arrays["tf"], arrays["doc_len"], k1, b
+                )
+            return
+        with np.load(os.path.join(index_dir, BM25_FILE)) as data:
+            terms = data["terms"]
+            self.indptr = data["indptr"]
+            self.doc_idx = data["doc_idx"]
+            tf = data["tf"]
+            doc_len = data["doc_len"]
+        self.vocab = {str(t): i for i, t in enumerate(terms)}
+        self.n_docs = len(doc_len)
+        self.idf, self.weights = bm25_weights(self.indptr, self.doc_idx, tf, doc_len, k1, b)
+
+    def search(self, query: str, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Trả về (scores, positions) của top_k tài liệu có điểm BM25 > 0, giảm dần"""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term, qtf in Counter(tokenize(query)).items():
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            start, end = self.indptr[t], self.indptr[t + 1]
+            scores[self.doc_idx[start:end]] += qtf * self.idf[t] * self.weights[start:end]
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return scores[order], order
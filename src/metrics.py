@@ -0,0 +1,230 @@
+"""
+Module đo thời gian từng bước của pipeline (tra cứu điều, tải index, tải model, embed, tìm kiếm, đọc văn bản, LLM)
+Ghi vào histogram dạng Prometheus cho endpoint /metrics và vào trace của request hiện tại (header Server-Timing, debug)
+Khi tắt (METRICS_ENABLED=0) và request không bật debug, mỗi điểm đo chỉ còn một phép kiểm tra cờ
+"""
+
+import contextvars
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+# Bật/tắt histogram và header Server-Timing (debug trace theo request vẫn dùng được khi tắt)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+# Ngưỡng bucket (giây) của histogram, từ 0.5ms tới 30s
+HISTOGRAM_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+    """Histogram Prometheus theo một hoặc nhiều nhãn, thread-safe (đếm tích lũy theo bucket khi xuất)"""
+
+    def __init__(self, name: str, help_text: str, label: Union[str, Tuple[str, ...]],
+                 buckets: Tuple[float, ...] = HISTOGRAM_BUCKETS) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = (label,) if isinstance(label, str) else tuple(label)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # giá trị nhãn -> [đếm theo bucket..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: Union[str, Tuple[str, ...]], seconds: float) -> None:
+        key = (value,) if isinstance(value, str) else tuple(value)
+        slot = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            series[slot] += 1
+            series[-1] += seconds
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def _snapshot_key(self, key: Tuple[str, ...]) -> str:
+        # Nhãn đầu giữ nguyên giá trị, các nhãn sau nối dạng ",tên=giá trị", ví dụ "/ask,status=error"
+        return key[0] + "".join(f",{name}={value}" for name, value in zip(self.labels[1:], key[1:]))
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Tóm tắt theo nhãn: count, sum (giây), mean_ms"""
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        out: Dict[str, Dict[str, float]] = {}
+        for key, series in sorted(items):
+            count = sum(series[:-1])
+            out[self._snapshot_key(key)] = {
+                "count": int(count),
+                "sum_seconds": round(series[-1], 6),
+                "mean_ms": round(series[-1] * 1000.0 / count, 3) if count else 0.0,
+            }
+        return out
+
+    def render(self) -> List[str]:
+        """Các dòng định dạng text exposition của Prometheus"""
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(items):
+            label = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.labels, key))
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {cumulative:g}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative:g}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative:g}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+stage_seconds = Histogram("rag_stage_duration_seconds", "Thời gian từng bước của pipeline RAG", "stage")
+request_seconds = Histogram(
+    "rag_request_duration_seconds", "Thời gian xử lý request theo endpoint và kết quả", ("endpoint", "status")
+)
+
+
+class Trace:
+    """Các bước đã đo trong một request: (tên, bắt đầu tính từ đầu request, thời gian) theo giây"""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, start: Optional[float] = None) -> None:
+        offset = (time.perf_counter() - seconds if start is None else start) - self.started
+        with self._lock:
+            self.spans.append((name, offset, seconds))
+
+    def merge(self, other: "Trace") -> None:
+        """Chép các bước của trace khác (ví dụ của một lô trong batcher) sang trace này"""
+        with other._lock:
+            spans = list(other.spans)
+        shift = other.started - self.started
+        with self._lock:
+            self.spans.extend((name, offset + shift, seconds) for name, offset, seconds in spans)
+
+    def totals(self) -> Dict[str, float]:
+        """Tổng thời gian (ms) theo bước, giữ thứ tự xuất hiện đầu tiên"""
+        out: Dict[str, float] = {}
+        with self._lock:
+            for name, _, seconds in self.spans:
+                out[name] = out.get(name, 0.0) + seconds * 1000.0
+        return out
+
+    def server_timing(self) -> str:
+        """Giá trị header Server-Timing, ví dụ "embed;dur=12.3, vector_search;dur=1.1, total;dur=20.4" """
+        parts = [f"{name};dur={ms:.2f}" for name, ms in self.totals().items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000.0:.2f}")
+        return ", ".join(parts)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = [
+                {"stage": name, "start_ms": round(offset * 1000.0, 3), "duration_ms": round(seconds * 1000.0, 3)}
+                for name, offset, seconds in self.spans
+            ]
+        return {
+            "total_ms": round((time.perf_counter() - self.started) * 1000.0, 3),
+            "stages_ms": {name: round(ms, 3) for name, ms in self.totals().items()},
+            "spans": spans,
+        }
+
+
+_current_trace: "contextvars.ContextVar[Optional[Trace]]" = contextvars.ContextVar("rag_trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def record(name: str, seconds: float, start: Optional[float] = None) -> None:
+    """Ghi một bước đã đo vào histogram (nếu bật) và trace của request hiện tại (nếu có)"""
+    if METRICS_ENABLED:
+        stage_seconds.observe(name, seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds, start)
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> "_Stage":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        record(self.name, time.perf_counter() - self.start, self.start)
+
+
+def stage(name: str):
+    """Context manager đo một bước: `with metrics.stage("embed"): ...`; không làm gì khi không có nơi ghi"""
+    if not METRICS_ENABLED and _current_trace.get() is None:
+        return _NOOP
+    return _Stage(name)
+
+
+def start_trace(force: bool = False) -> Tuple[Optional[Trace], Optional[contextvars.Token]]:
+    """
+    Tạo trace cho request hiện tại (khi bật metrics hoặc force=True cho debug), trả về (trace, token)
+    Gọi end_trace(token) khi request xong
+    """
+    if not METRICS_ENABLED and not force:
+        return None, None
+    trace = Trace()
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token: Optional[contextvars.Token]) -> None:
+    if token is not None:
+        _current_trace.reset(token)
+
+
+def use_trace(trace: Optional[Trace]) -> contextvars.Token:
+    """Đặt trace hiện tại trên luồng đang chạy (ví dụ luồng batcher xử lý một lô)"""
+    return _current_trace.set(trace)
+
+
+def bind(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Gắn context hiện tại (trace của request) vào fn trước khi gửi sang executor/thread pool
+    run_in_executor và ThreadPoolExecutor.submit không tự chép contextvars
+    """
+    if _current_trace.get() is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def observe_request(endpoint: str, started: float, status: str = "ok") -> None:
+    """
+    Ghi tổng thời gian request (tính từ started = time.perf_counter() lúc nhận request) theo endpoint
+    và kết quả: "ok", "error" hoặc "cancelled" (client ngắt kết nối giữa chừng)
+    """
+    if METRICS_ENABLED:
+        request_seconds.observe((endpoint, status), time.perf_counter() - started)
+
+
+def render() -> str:
+    """Toàn bộ metrics ở định dạng text exposition của Prometheus"""
+    lines = stage_seconds.render() + request_seconds.render()
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> Dict[str, Any]:
+    return {"enabled": METRICS_ENABLED, "stages": stage_seconds.snapshot(), "requests": request_seconds.snapshot()}
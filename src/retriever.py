@@ -5,105 +5,542 @@ Tìm kiếm các tài liệu liên quan đến câu hỏi của người dùng
 
 import os
 import json
-from typing import List, Dict, Tuple, Optional
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Dict, Tuple, Optional
 
 import numpy as np
 
-try:
-    import faiss  # type: ignore
-except Exception as exc:
-    raise RuntimeError(
-        "faiss-cpu is required. Please install dependencies (pip install -r requirements.txt)."
-    ) from exc
-
 from . import embedder
+from . import index_cache
+from . import index_versions
+from . import lazy
+from . import metrics
+from .embedder import faiss
+
+
+# Đọc index qua mmap chỉ đọc: nhiều worker uvicorn dùng chung một bản index/metadata trong page cache
+INDEX_MMAP = os.environ.get("INDEX_MMAP", "1").lower() not in ("0", "false", "no")
 
 
 def load_index(index_dir: str):
-    """Tải FAISS index và metadata từ thư mục"""
-    index = faiss.read_index(os.path.join(index_dir, "index.faiss"))
-    with open(os.path.join(index_dir, "metadata.json"), "r", encoding="utf-8") as f:
-        metadata: List[Dict[str, str]] = json.load(f)
+    """Tải FAISS index và metadata từ thư mục (đọc trực tiếp từ đĩa, không qua cache)"""
+    manifest: Dict[str, Any] = {}
+    manifest_path = os.path.join(index_dir, index_cache.MANIFEST_FILE)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    index = embedder.read_index(index_dir, manifest, mmap=INDEX_MMAP)
+    metadata = index_cache.load_metadata(index_dir) if INDEX_MMAP else _read_metadata_json(index_dir)
+    # Áp dụng tham số truy vấn (nprobe, efSearch, rescore) đã lưu cùng index
+    embedder.apply_search_params(index, manifest.get("index", {}).get("params"))
     return index, metadata
 
 
+def _read_metadata_json(index_dir: str) -> List[Dict[str, str]]:
+    with open(os.path.join(index_dir, index_cache.METADATA_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Số lượng embedding câu hỏi tối đa giữ trong cache LRU
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "1024"))
+
+
+def normalize_query(query: str) -> str:
+    """Chuẩn hóa câu hỏi (Unicode NFC, chữ thường, gộp khoảng trắng) để làm khóa cache"""
+    text = unicodedata.normalize("NFC", query or "")
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """Cache LRU có giới hạn: câu hỏi đã chuẩn hóa -> vector đã chuẩn hóa L2"""
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._items: "OrderedDict[Tuple[str, str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[np.ndarray]:
+        with self._lock:
+            vec = self._items.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, key: Tuple[str, str, str], vec: np.ndarray) -> None:
+        if self.max_size <= 0:
+            return
+        vec.setflags(write=False)  # Vector được chia sẻ giữa các request, không cho sửa
+        with self._lock:
+            self._items[key] = vec
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+query_cache = QueryEmbeddingCache()
+
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+
+def _get_openai_client():
+    """OpenAI client dùng chung cho embedding câu hỏi"""
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = embedder.create_openai_client()
+        return _openai_client
+
+
+def embed_queries(queries: List[str], provider: str, local_model: str) -> np.ndarray:
+    """
+    Tạo embedding cho nhiều câu hỏi trong một lần gọi encoder (có cache theo câu hỏi đã chuẩn hóa)
+    Trả về ma trận (len(queries), dim) đã chuẩn hóa L2
+    """
+    embedder.check_provider(provider)
+    model_name = embedder.EMBED_MODEL if provider == "openai" else local_model
+    keys = [(provider, model_name, normalize_query(q)) for q in queries]
+    vectors: List[Optional[np.ndarray]] = [query_cache.get(key) for key in keys]
+
+    # Chỉ encode các câu hỏi chưa có trong cache, câu trùng nhau encode một lần
+    missing: Dict[Tuple[str, str, str], int] = {}
+    for i, (key, vec) in enumerate(zip(keys, vectors)):
+        if vec is None:
+            missing.setdefault(key, i)
+    if missing:
+        texts = [queries[i] for i in missing.values()]
+        if provider == "openai":
+            client = _get_openai_client()
+            with metrics.stage("embed"):
+                vecs = embedder.get_embeddings_openai(client, texts)
+        else:
+            embedder.get_local_model(local_model, provider)  # Tải model (lần đầu) được đo riêng
+            with metrics.stage("embed"):
+                vecs = embedder.get_embeddings_local(local_model, texts, provider)
+        # Chuẩn hóa L2 để khớp với index đã được normalize
+        faiss.normalize_L2(vecs)
+        computed = {key: vec.reshape(1, -1).copy() for key, vec in zip(missing.keys(), vecs)}
+        for key, row in computed.items():
+            query_cache.put(key, row)
+        vectors = [computed[key] if vec is None else vec for key, vec in zip(keys, vectors)]
+    return np.vstack(vectors).astype(np.float32, copy=False)
+
+
 def embed_query(query: str, provider: str, local_model: str) -> np.ndarray:
-    """Tạo embedding cho câu hỏi của người dùng"""
-    if provider == "openai":
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise EnvironmentError("OPENAI_API_KEY chưa được thiết lập trong biến môi trường")
-        client = embedder.OpenAI(api_key=api_key)
-        vecs = embedder.get_embeddings_openai(client, [query])
-    elif provider == "local":
-        vecs = embedder.get_embeddings_local(local_model, [query])
-    else:
-        raise ValueError("provider phải là 'openai' hoặc 'local'")
-    # Chuẩn hóa L2 để khớp với index đã được normalize
-    faiss.normalize_L2(vecs)
-    return vecs
+    """Tạo embedding cho câu hỏi của người dùng (có cache theo câu hỏi đã chuẩn hóa)"""
+    return embed_queries([query], provider, local_model)
+
+
+# Số luồng tìm kiếm song song trên các shard (FAISS nhả GIL khi search)
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", "4"))
+_search_pool: Optional[ThreadPoolExecutor] = None
+_search_pool_lock = threading.Lock()
+
+
+def _get_search_pool() -> ThreadPoolExecutor:
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=max(1, SEARCH_WORKERS), thread_name_prefix="faiss-search")
+        return _search_pool
 
 
-def retrieve(query: str, index_dir: str, top_k: int, provider: str, local_model: str) -> List[Dict[str, str]]:
+def resolve_shards(index_dir: str, laws: Optional[List[str]] = None) -> List[Tuple[str, str]]:
     """
-    Tìm kiếm top_k tài liệu liên quan nhất đến câu hỏi
-    Trả về danh sách các tài liệu với điểm số similarity
+    Xác định các shard cần tìm kiếm: danh sách (mã luật, thư mục index)
+    Index đơn (không có shards.json) trả về một shard với mã luật rỗng
+    Index có phiên bản được đọc từ phiên bản tiến trình đang phục vụ (index_versions)
+    """
+    root = index_versions.active_dir(index_dir)
+    shards = index_cache.load_shards(root)
+    if not shards:
+        return [("", root)]
+    available = {str(s["law"]): os.path.join(root, str(s.get("dir", s["law"]))) for s in shards}
+    if not laws:
+        return list(available.items())
+    unknown = [law for law in laws if law not in available]
+    if unknown:
+        raise ValueError(f"Không tìm thấy luật: {', '.join(unknown)}. Các luật hiện có: {', '.join(available)}")
+    return [(law, available[law]) for law in dict.fromkeys(laws)]
+
+
+def index_version(index_dir: str, laws: Optional[List[str]] = None) -> str:
+    """Phiên bản hiện tại của (các shard) index, thay đổi mỗi khi index được dựng lại"""
+    return ";".join(
+        f"{law}:{index_cache.get_index(shard_dir).version}" for law, shard_dir in resolve_shards(index_dir, laws)
+    )
+
+
+def reload_index(index_dir: str) -> Dict[str, Any]:
+    """
+    Chuyển sang phiên bản index vừa công bố (CURRENT) không gián đoạn: tải mọi shard của bản mới trước,
+    xong mới đổi phiên bản phục vụ; request đang chạy vẫn dùng bản cũ đã tải, bản cũ được bỏ khỏi cache sau đó
+    Phiên bản được ghi lease (index_versions) để lệnh embed ở tiến trình khác không xóa bản đang phục vụ
     """
-    index, metadata = load_index(index_dir)
-    q = embed_query(query, provider, local_model)
-    
+    current = index_versions.read_current(index_dir)
+    active = index_versions.active_version(index_dir)
+    if current == active:
+        return {"index_dir": index_dir, "version": active, "previous": active, "changed": False}
+    start = time.perf_counter()
+    new_root = index_versions.version_dir(index_dir, current)
+    shards = index_cache.load_shards(new_root)
+    new_dirs = [os.path.join(new_root, str(s.get("dir", s["law"]))) for s in shards] or [new_root]
+    index_cache.registry.restore(new_dirs)
+    for shard_dir in new_dirs:
+        index_cache.get_index(shard_dir)
+    old_dirs = [shard_dir for _, shard_dir in resolve_shards(index_dir)]
+    index_versions.pin(index_dir, current)
+    # Request đang chạy còn giữ thư mục bản cũ vẫn đọc được, nhưng không nạp bản cũ trở lại cache
+    index_cache.registry.retire(old_dirs)
+    return {
+        "index_dir": index_dir,
+        "version": current,
+        "previous": active,
+        "changed": True,
+        "load_seconds": round(time.perf_counter() - start, 4),
+    }
+
+
+Hit = Tuple[float, str, Dict[str, Any], str]
+
+# Chế độ truy xuất: "vector" (FAISS), "lexical" (BM25) hoặc "hybrid" (gộp hai danh sách bằng Reciprocal Rank Fusion)
+# Mặc định vector (điểm là cosine similarity); lexical/hybrid phải bật rõ ràng vì điểm và thứ hạng khác
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "vector")
+# Hằng số k của RRF: điểm = sum 1 / (k + hạng)
+RRF_K = int(os.environ.get("RRF_K", "60"))
+# Số ứng viên lấy từ mỗi danh sách trước khi gộp, tính theo bội số của top_k
+HYBRID_CANDIDATES_FACTOR = int(os.environ.get("HYBRID_CANDIDATES_FACTOR", "4"))
+# Với index chia theo khoản/điểm: trả về đúng khoản khớp ("clause") hoặc mở rộng thành cả điều chứa nó ("article")
+EXPAND_MODES = ("clause", "article")
+CLAUSE_EXPAND = os.environ.get("CLAUSE_EXPAND", "clause")
+
+
+def _search_shard(law: str, shard_dir: str, q: np.ndarray, top_k: int) -> List[List[Hit]]:
+    """Tìm kiếm một lần cho mọi dòng của q trong một shard, trả về list hits (score, law, metadata_item, text) theo dòng"""
+    loaded = index_cache.get_index(shard_dir)
+    index, metadata = loaded.index, loaded.metadata
+
     # Tìm kiếm trong FAISS index
-    D, I = index.search(q, top_k)  # D = distances, I = indices
-    
-    results: List[Dict[str, str]] = []
-    for rank, (idx, score) in enumerate(zip(I[0], D[0])):
-        # Kiểm tra index hợp lệ
-        if idx < 0 or idx >= len(metadata):
+    with metrics.stage("vector_search"):
+        D, I = index.search(q, top_k)  # D = distances, I = indices
+
+    rows: List[List[Hit]] = []
+    with metrics.stage("read_text"):
+        for labels, scores in zip(I, D):
+            hits: List[Hit] = []
+            for label, score in zip(labels, scores):
+                # Kiểm tra index hợp lệ (label là vị trí, hoặc vid với index dựng theo ID)
+                idx = loaded.position(int(label)) if label >= 0 else -1
+                if idx < 0:
+                    continue
+                # Đọc nội dung từ corpus đóng gói (mmap), không mở file lẻ
+                hits.append((float(score), law, metadata[idx], loaded.get_text(idx)))
+            rows.append(hits)
+    return rows
+
+
+def _lexical_shard(law: str, shard_dir: str, queries: List[str], top_k: int, required: bool = True) -> List[List[Hit]]:
+    """Tìm kiếm BM25 cho từng câu hỏi trong một shard, cùng định dạng hits với _search_shard"""
+    loaded = index_cache.get_index(shard_dir)
+    if loaded.bm25 is None:
+        if required:
+            raise ValueError(f"Index {shard_dir} chưa có chỉ mục BM25, hãy chạy lại lệnh embed")
+        return [[] for _ in queries]
+    with metrics.stage("lexical_search"):
+        ranked = [loaded.bm25.search(query, top_k) for query in queries]
+    with metrics.stage("read_text"):
+        return [
+            [(float(score), law, loaded.metadata[pos], loaded.get_text(pos)) for score, pos in zip(scores, positions)]
+            for scores, positions in ranked
+        ]
+
+
+def _search_shards(
+    shards: List[Tuple[str, str]], fn, arg, n_rows: int, top_k: int, *extra, by_rank: bool = False
+) -> List[List[Hit]]:
+    """
+    Chạy fn trên mọi shard (song song nếu nhiều shard) rồi gộp top_k cho từng câu hỏi
+    Gộp theo điểm (cosine so sánh được giữa các shard), hoặc theo hạng bằng RRF khi by_rank=True:
+    điểm BM25 của mỗi shard dùng idf riêng nên không so sánh trực tiếp được
+    """
+    if len(shards) == 1:
+        return fn(shards[0][0], shards[0][1], arg, top_k, *extra)
+    pool = _get_search_pool()
+    futures = [pool.submit(metrics.bind(fn), law, shard_dir, arg, top_k, *extra) for law, shard_dir in shards]
+    shard_rows = [fut.result() for fut in futures]
+    per_row: List[List[Hit]] = []
+    for row in range(n_rows):
+        if by_rank:
+            per_row.append(fuse_rrf([rows[row] for rows in shard_rows], top_k))
             continue
-            
-        item = metadata[idx]
-        path = item.get("path", "")
-        text = ""
-        
-        # Đọc nội dung file
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                text = f.read().strip()
-        except Exception:
-            text = ""
-            
+        hits = [hit for rows in shard_rows for hit in rows[row]]
+        hits.sort(key=lambda h: h[0], reverse=True)
+        per_row.append(hits[:top_k])
+    return per_row
+
+
+def fuse_rrf(ranked_lists: List[List[Hit]], top_k: int, k: int = RRF_K) -> List[Hit]:
+    """Gộp nhiều danh sách đã xếp hạng bằng Reciprocal Rank Fusion, điểm trả về là điểm RRF"""
+    fused: Dict[Tuple[str, str], List[Any]] = {}
+    for hits in ranked_lists:
+        for rank, (_, law, item, text) in enumerate(hits):
+            key = (law, str(item.get("id", "")))
+            entry = fused.setdefault(key, [0.0, law, item, text])
+            entry[0] += 1.0 / (k + rank + 1)
+    merged = sorted(fused.values(), key=lambda e: e[0], reverse=True)
+    return [(float(score), law, item, text) for score, law, item, text in merged[:top_k]]
+
+
+def expand_to_articles(hits: List[Hit], shard_dirs: Dict[str, str]) -> List[Hit]:
+    """Thay mỗi khoản/điểm bằng điều luật chứa nó, mỗi điều giữ một lần với điểm cao nhất"""
+    expanded: List[Hit] = []
+    seen = set()
+    for score, law, item, text in hits:
+        loaded = index_cache.get_index(shard_dirs[law])
+        if loaded.parents is None or "parent" not in item:
+            expanded.append((score, law, item, text))
+            continue
+        parent_id = str(item.get("parent_id", ""))
+        if (law, parent_id) in seen:
+            continue
+        seen.add((law, parent_id))
+        parent_text = loaded.parents.get(int(item["parent"]))
+        expanded.append((score, law, {"id": parent_id, "path": item.get("path", "")}, parent_text))
+    return expanded
+
+
+def search_batch(
+    index_dir: str,
+    q: Optional[np.ndarray],
+    top_k: int,
+    laws: Optional[List[str]] = None,
+    queries: Optional[List[str]] = None,
+    mode: str = "vector",
+    expand: str = CLAUSE_EXPAND,
+) -> List[List[Dict[str, str]]]:
+    """
+    Tìm top_k cho nhiều câu hỏi: vector dùng một lời gọi index.search trên mỗi shard, lexical dùng BM25
+    Với index chia shard theo luật, các shard được tìm song song rồi gộp top_k theo từng câu hỏi
+    Chế độ hybrid lấy nhiều ứng viên từ cả hai phía rồi gộp bằng RRF (shard chưa có BM25 chỉ dùng vector)
+    expand="article" mở rộng kết quả khoản/điểm thành cả điều luật (bỏ các khoản trùng điều)
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"mode phải là một trong {', '.join(RETRIEVAL_MODES)}")
+    if expand not in EXPAND_MODES:
+        raise ValueError(f"expand phải là một trong {', '.join(EXPAND_MODES)}")
+    if mode != "vector" and queries is None:
+        raise ValueError("Cần nội dung câu hỏi (queries) cho chế độ lexical/hybrid")
+    shards = resolve_shards(index_dir, laws)
+    n_rows = len(queries) if q is None else len(q)
+
+    depth = max(top_k, top_k * HYBRID_CANDIDATES_FACTOR)
+    # Lấy dư ứng viên khi mở rộng về điều, vì nhiều khoản có thể thuộc cùng một điều
+    k = depth if expand == "article" else top_k
+    if mode == "vector":
+        per_row = _search_shards(shards, _search_shard, q, n_rows, k)
+    elif mode == "lexical":
+        per_row = _search_shards(shards, _lexical_shard, queries, n_rows, k, by_rank=True)
+    else:
+        vector_rows = _search_shards(shards, _search_shard, q, n_rows, depth)
+        lexical_rows = _search_shards(shards, _lexical_shard, queries, n_rows, depth, False, by_rank=True)
+        with metrics.stage("fusion"):
+            per_row = [fuse_rrf([v, l], k) for v, l in zip(vector_rows, lexical_rows)]
+    if expand == "article":
+        shard_dirs = dict(shards)
+        with metrics.stage("expand"):
+            per_row = [expand_to_articles(hits, shard_dirs)[:top_k] for hits in per_row]
+    return [format_results(hits) for hits in per_row]
+
+
+def format_results(hits: List[Hit]) -> List[Dict[str, str]]:
+    """Chuyển hits thành danh sách kết quả (rank, score, id, law, path, text)"""
+    results: List[Dict[str, str]] = []
+    for rank, (score, law, item, text) in enumerate(hits):
         results.append({
             "rank": str(rank + 1),
-            "score": f"{float(score):.4f}",
-            "id": item.get("id", str(idx)),
-            "path": path,
+            "score": f"{score:.4f}",
+            "id": item.get("id", ""),
+            "law": law,
+            "path": item.get("path", ""),
             "text": text,
         })
     return results
 
 
-def try_get_article_by_number(index_dir: str, article_number: str) -> Optional[str]:
+def retrieve(
+    query: str,
+    index_dir: str,
+    top_k: int,
+    provider: str,
+    local_model: str,
+    laws: Optional[List[str]] = None,
+    mode: str = RETRIEVAL_MODE,
+    expand: str = CLAUSE_EXPAND,
+) -> List[Dict[str, str]]:
     """
-    Tìm và đọc trực tiếp nội dung file điều_<số>.txt từ metadata
-    Đây là heuristic để cải thiện độ chính xác khi hỏi về điều luật cụ thể
+    Tìm kiếm top_k tài liệu liên quan nhất đến câu hỏi
+    Với index chia shard theo luật, chỉ tìm trên các luật được chọn (song song) rồi gộp top_k
+    Trả về danh sách các tài liệu với điểm số (similarity, BM25 hoặc RRF tùy mode)
+    """
+    resolve_shards(index_dir, laws)  # Báo lỗi luật không tồn tại trước khi embed
+    # Chế độ lexical không cần embed câu hỏi
+    q = None if mode == "lexical" else embed_query(query, provider, local_model)
+    return search_batch(index_dir, q, top_k, laws, [query], mode, expand)[0]
+
+
+# Câu hỏi chạy thử khi warm-up (khởi động kernel encoder và đường tìm kiếm)
+WARMUP_QUERY = "Thời giờ làm việc bình thường"
+
+
+def warm_up(
+    index_dir: str, provider: str, local_model: str, laws: Optional[List[str]] = None, mode: str = RETRIEVAL_MODE
+) -> Dict[str, float]:
+    """
+    Tải trước faiss, index (mọi shard) và model embedding rồi chạy thử một truy vấn,
+    để request đầu tiên không phải chịu chi phí khởi động. Trả về thời gian (giây) từng bước
+    Provider openai chỉ tạo client, không gọi API
+    """
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    lazy.load(faiss)
+    timings["import"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _, shard_dir in resolve_shards(index_dir, laws):
+        index_cache.get_index(shard_dir)
+    timings["index_load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if provider == "openai":
+        _get_openai_client()
+    else:
+        embedder.get_local_model(local_model, provider)
+    timings["model_load"] = time.perf_counter() - start
+
+    if provider != "openai" or mode == "lexical":
+        start = time.perf_counter()
+        retrieve(WARMUP_QUERY, index_dir, 1, provider, local_model, laws, mode)
+        timings["first_query"] = time.perf_counter() - start
+    return timings
+
+
+# Cụm "Điều <số>" kèm danh sách/khoảng số phía sau, ví dụ "Điều 1, 2 và 5" hoặc "Điều 10 đến Điều 12"
+ARTICLE_MENTION_REGEX = re.compile(
+    r"\bđiều\s+(\d+(?:\s*(?:,|-|–|đến|tới|và|hoặc)\s*(?:điều\s+)?\d+)*)",
+    re.IGNORECASE | re.UNICODE,
+)
+ARTICLE_TOKEN_REGEX = re.compile(r"(\d+)|(-|–|đến|tới)", re.IGNORECASE | re.UNICODE)
+# Giới hạn số điều lấy trực tiếp để tránh "Điều 1 đến 400" làm phình ngữ cảnh
+MAX_DIRECT_ARTICLES = int(os.environ.get("MAX_DIRECT_ARTICLES", "10"))
+
+
+def extract_article_numbers(query: str, limit: int = MAX_DIRECT_ARTICLES) -> List[str]:
+    """
+    Tìm tất cả số điều được nhắc tới trong câu hỏi (giữ thứ tự, bỏ trùng)
+    Hỗ trợ nhiều lần nhắc, liệt kê ("Điều 1, 2 và 5") và khoảng ("Điều 10-12", "Điều 10 đến Điều 12")
+    """
+    numbers: List[str] = []
+    text = unicodedata.normalize("NFC", query or "")
+    for m in ARTICLE_MENTION_REGEX.finditer(text):
+        prev: Optional[int] = None
+        in_range = False
+        for tok in ARTICLE_TOKEN_REGEX.finditer(m.group(1)):
+            if tok.group(2):
+                in_range = prev is not None
+                continue
+            value = int(tok.group(1))
+            if in_range and prev is not None and prev < value:
+                candidates = range(prev + 1, min(value, prev + limit) + 1)
+            else:
+                candidates = range(value, value + 1)
+            for n in candidates:
+                if str(n) not in numbers:
+                    numbers.append(str(n))
+            prev, in_range = value, False
+            if len(numbers) >= limit:
+                return numbers[:limit]
+    return numbers
+
+
+def get_articles_by_numbers(
+    index_dir: str, article_numbers: List[str], laws: Optional[List[str]] = None
+) -> List[Dict[str, str]]:
+    """
+    Lấy trực tiếp các điều luật theo số qua bảng tra cứu đã dựng sẵn (O(1) mỗi điều)
+    Với index chia shard, tra cứu trong từng luật được chọn
     """
     try:
-        with open(os.path.join(index_dir, "metadata.json"), "r", encoding="utf-8") as f:
-            metadata: List[Dict[str, str]] = json.load(f)
+        shards = resolve_shards(index_dir, laws)
     except Exception:
-        return None
-
-    # Tìm file điều luật theo số
-    target_name = f"điều_{article_number}.txt".lower()
-    for item in metadata:
-        file_id = str(item.get("id", "")).lower()
-        path = item.get("path", "")
-        if target_name == file_id or target_name in file_id:
-            try:
-                with open(path, "r", encoding="utf-8") as fp:
-                    return fp.read().strip()
-            except Exception:
-                return None
-    return None
+        return []
+
+    articles: List[Dict[str, str]] = []
+    for law, shard_dir in shards:
+        try:
+            loaded = index_cache.get_index(shard_dir)
+        except Exception:
+            continue
+        for number in article_numbers:
+            pos = loaded.article_map.get(str(int(number)))
+            if pos is None:
+                continue
+            # Index chia theo khoản: trả về cả điều luật gốc
+            article_id, text = loaded.get_parent(pos)
+            if not text:
+                continue
+            item = loaded.metadata[pos]
+            articles.append({
+                "number": str(int(number)),
+                "id": article_id or str(pos),
+                "law": law,
+                "path": item.get("path", ""),
+                "text": text,
+            })
+    return articles
 
 
+def get_articles_in_query(index_dir: str, query: str, laws: Optional[List[str]] = None) -> List[Dict[str, str]]:
+    """Lấy nội dung các điều luật được nhắc tới bằng số trong câu hỏi"""
+    with metrics.stage("article_lookup"):
+        numbers = extract_article_numbers(query)
+        if not numbers:
+            return []
+        return get_articles_by_numbers(index_dir, numbers, laws)
+
+
+def try_get_article_by_number(index_dir: str, article_number: str) -> Optional[str]:
+    """
+    Đọc trực tiếp nội dung điều luật theo số (khớp chính xác, "1" không khớp "10")
+    Đây là heuristic để cải thiện độ chính xác khi hỏi về điều luật cụ thể
+    """
+    articles = get_articles_by_numbers(index_dir, [article_number])
+    return articles[0]["text"] if articles else None
@@ -4,38 +4,112 @@ Module xử lý tách PDF thành các file điều luật riêng biệt
 
 import os
 import re
-from typing import List, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
 
-try:
-    import pdfplumber  # type: ignore
-except Exception:  # pragma: no cover
-    pdfplumber = None  # type: ignore
+from . import lazy
 
+# Import trễ: chỉ lệnh tách PDF cần pdfplumber (API và truy xuất chỉ dùng phần regex của module này)
+pdfplumber = lazy.LazyModule(
+    "pdfplumber", "pdfplumber is required to read PDFs. Please install dependencies (pip install -r requirements.txt)."
+)
 
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """Trích xuất text từ file PDF"""
-    if pdfplumber is None:
-        raise RuntimeError(
-            "pdfplumber is required to read PDFs. Please install dependencies (pip install -r requirements.txt)."
-        )
+# Số trang mỗi tác vụ gửi cho process pool khi trích xuất PDF
+PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", "8"))
+
+
+def _require_pdfplumber() -> None:
+    lazy.load(pdfplumber)
+
+
+def count_pdf_pages(pdf_path: str) -> int:
+    """Đếm số trang của file PDF"""
+    _require_pdfplumber()
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
 
-    text_parts: List[str] = []
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """Trích xuất text của các trang [start, end), chạy trong tiến trình con"""
+    texts: List[str] = []
     with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
+        for page in pdf.pages[start:end]:
             # Trích xuất text với tolerance cho việc căn chỉnh
-            page_text = page.extract_text(x_tolerance=1, y_tolerance=1) or ""
-            text_parts.append(page_text)
-    return "\n".join(text_parts)
+            texts.append(page.extract_text(x_tolerance=1, y_tolerance=1) or "")
+            page.close()  # Giải phóng cache đối tượng của trang đã xử lý
+    return texts
+
+
+def iter_page_texts(
+    pdf_path: str, workers: Optional[int] = None, pages_per_task: int = PAGES_PER_TASK
+) -> Iterator[str]:
+    """
+    Trích xuất text từng trang PDF theo đúng thứ tự trang
+    Các khoảng trang được xử lý song song trong process pool, số tác vụ đang chờ có giới hạn để bộ nhớ không tăng theo kích thước PDF
+    """
+    _require_pdfplumber()
+    workers = workers or os.cpu_count() or 1
+    total = count_pdf_pages(pdf_path)
+    step = max(1, pages_per_task)
+    ranges = [(start, min(start + step, total)) for start in range(0, total, step)]
+
+    if workers <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            yield from _extract_page_range(pdf_path, start, end)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        remaining = iter(ranges)
+        pending = deque()
+        for start, end in remaining:
+            pending.append(pool.submit(_extract_page_range, pdf_path, start, end))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            texts = pending.popleft().result()
+            nxt = next(remaining, None)
+            if nxt is not None:
+                pending.append(pool.submit(_extract_page_range, pdf_path, *nxt))
+            yield from texts
+
+
+def iter_text_lines(page_texts: Iterable[str]) -> Iterator[str]:
+    """
+    Tách text các trang thành dòng theo dạng streaming
+    Kết quả giống hệt "\n".join(page_texts).splitlines() nhưng chỉ giữ dòng dở dang trong bộ nhớ
+    """
+    pending = ""
+    started = False
+    for page_text in page_texts:
+        pending = pending + "\n" + page_text if started else page_text
+        started = True
+        parts = pending.splitlines(keepends=True)
+        pending = ""
+        if not parts:
+            continue
+        last = parts[-1]
+        # Giữ lại dòng cuối nếu chưa kết thúc, hoặc kết thúc bằng "\r" (có thể ghép "\r\n" với trang sau)
+        if last.splitlines()[0] == last or last.endswith("\r"):
+            pending = parts.pop()
+        for part in parts:
+            yield part.splitlines()[0]
+    yield from pending.splitlines()
+
+
+def extract_text_from_pdf(pdf_path: str, workers: Optional[int] = None) -> str:
+    """Trích xuất text từ file PDF"""
+    return "\n".join(iter_page_texts(pdf_path, workers=workers))
+
 
 # Regex để tìm tiêu đề điều luật: "Điều [số]"
 ARTICLE_HEADING_REGEX = re.compile(r"^\s*Điều\s+(\d+)\b", re.UNICODE)
 
-def split_articles(lines: List[str]) -> List[Tuple[str, List[str]]]:
+def iter_articles(lines: Iterable[str]) -> Iterator[Tuple[str, List[str]]]:
     """
-    Tách các dòng text thành các điều luật dựa trên regex pattern
-    Trả về list các tuple (id_điều_luật, [các_dòng_text])
+    Tách các dòng text thành các điều luật dựa trên regex pattern (dạng generator)
+    Sinh ra từng tuple (id_điều_luật, [các_dòng_text]) ngay khi gặp tiêu đề điều tiếp theo
     """
-    articles: List[Tuple[str, List[str]]] = []
     current_id: str = ""
     current_lines: List[str] = []
 
@@ -45,8 +119,8 @@ def split_articles(lines: List[str]) -> List[Tuple[str, List[str]]]:
         if m:
             # Tìm thấy tiêu đề điều luật mới
             if current_id:
-                # Lưu điều luật trước đó
-                articles.append((current_id, current_lines))
+                # Trả về điều luật trước đó
+                yield current_id, current_lines
             number = m.group(1)
             current_id = f"Điều {number}"
             current_lines = [line]
@@ -58,11 +132,76 @@ def split_articles(lines: List[str]) -> List[Tuple[str, List[str]]]:
                 # Bỏ qua dòng trước khi tìm thấy điều luật đầu tiên
                 continue
 
-    # Lưu điều luật cuối cùng
+    # Trả về điều luật cuối cùng
     if current_id:
-        articles.append((current_id, current_lines))
+        yield current_id, current_lines
 
-    return articles
+
+def split_articles(lines: Iterable[str]) -> List[Tuple[str, List[str]]]:
+    """
+    Tách các dòng text thành các điều luật dựa trên regex pattern
+    Trả về list các tuple (id_điều_luật, [các_dòng_text])
+    """
+    return list(iter_articles(lines))
+
+
+# Dòng mở đầu khoản ("1. ...") và điểm ("a) ...") trong một điều luật
+CLAUSE_REGEX = re.compile(r"^\s*(\d+)\.\s+\S", re.UNICODE)
+POINT_REGEX = re.compile(r"^\s*([a-zđ])\)\s+\S", re.UNICODE)
+# Khoản dài hơn ngưỡng này (ký tự) được tách tiếp thành các điểm
+CLAUSE_MAX_CHARS = int(os.environ.get("CLAUSE_MAX_CHARS", "1500"))
+# Phần mở đầu (tiêu đề + câu dẫn) ngắn hơn ngưỡng này được lặp lại ở đầu mỗi khoản làm ngữ cảnh
+CLAUSE_PREFIX_MAX_CHARS = 400
+
+
+def _group_lines(lines: List[str], regex: "re.Pattern[str]", sequential: bool) -> Tuple[List[str], List[Tuple[str, List[str]]]]:
+    """Chia các dòng thành (phần dẫn, [(nhãn, các dòng)]) theo dòng mở đầu khớp regex"""
+    lead: List[str] = []
+    groups: List[Tuple[str, List[str]]] = []
+    for line in lines:
+        m = regex.match(line)
+        # Khoản phải đánh số liên tiếp để không nhầm dòng bị ngắt bắt đầu bằng số (ví dụ "2019. ...")
+        if m and (not sequential or m.group(1) == str(len(groups) + 1)):
+            groups.append((m.group(1), [line]))
+        elif groups:
+            groups[-1][1].append(line)
+        else:
+            lead.append(line)
+    return lead, groups
+
+
+def split_clauses(text: str, max_chars: int = CLAUSE_MAX_CHARS) -> List[Tuple[str, str]]:
+    """
+    Tách một điều luật thành các khoản, khoản dài có điểm thì tách tiếp thành các điểm
+    Trả về list (nhãn, nội dung), nhãn dạng "khoản_2" hoặc "khoản_2_điểm_a"; điều không có khoản trả về [("", text)]
+    Mỗi đoạn được thêm tiêu đề điều (và câu dẫn nếu ngắn) ở đầu để tự đủ nghĩa khi embed
+    """
+    lines = text.strip().splitlines()
+    intro, clauses = _group_lines(lines[1:], CLAUSE_REGEX, sequential=True)
+    if not clauses:
+        return [("", text.strip())]
+
+    heading = lines[0]
+    intro_text = "\n".join(intro).strip()
+    chunks: List[Tuple[str, str]] = []
+    if intro_text and len(heading) + len(intro_text) > CLAUSE_PREFIX_MAX_CHARS:
+        chunks.append(("mở_đầu", f"{heading}\n{intro_text}"))
+        prefix = heading
+    else:
+        prefix = "\n".join([heading] + intro).strip()
+
+    for number, clause_lines in clauses:
+        label = f"khoản_{number}"
+        clause_text = "\n".join(clause_lines).strip()
+        lead, points = _group_lines(clause_lines, POINT_REGEX, sequential=False)
+        if len(clause_text) <= max_chars or not points:
+            chunks.append((label, f"{prefix}\n{clause_text}"))
+            continue
+        lead_text = "\n".join(lead).strip()
+        for letter, point_lines in points:
+            point_text = "\n".join(point_lines).strip()
+            chunks.append((f"{label}_điểm_{letter}", f"{prefix}\n{lead_text}\n{point_text}"))
+    return chunks
 
 
 def sanitize_filename(name: str) -> str:
@@ -71,13 +210,38 @@ def sanitize_filename(name: str) -> str:
     return sanitized.strip("_")
 
 
-def write_articles(articles: List[Tuple[str, List[str]]], output_dir: str) -> None:
-    """Ghi các điều luật vào file .txt riêng biệt"""
+# Tên file do write_articles tạo ra cho một điều luật, ví dụ "điều_12.txt"
+ARTICLE_FILENAME_REGEX = re.compile(r"^điều_(\d+)\.txt$", re.UNICODE)
+
+
+def article_number_from_filename(filename: str) -> str:
+    """Lấy số điều từ tên file điều luật (khớp chính xác), trả về "" nếu không phải file điều luật"""
+    m = ARTICLE_FILENAME_REGEX.match(os.path.basename(filename).lower())
+    return str(int(m.group(1))) if m else ""
+
+
+def law_id_from_path(pdf_path: str) -> str:
+    """Tạo mã luật (dùng làm tên shard và tiền tố ID điều luật) từ tên file PDF"""
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return sanitize_filename(stem.lower())
+
+
+def list_pdfs(pdf_dir: str) -> List[str]:
+    """Liệt kê các file PDF trong thư mục (sắp xếp theo tên)"""
+    names = sorted(n for n in os.listdir(pdf_dir) if n.lower().endswith(".pdf"))
+    return [os.path.join(pdf_dir, n) for n in names]
+
+
+def write_articles(articles: Iterable[Tuple[str, List[str]]], output_dir: str) -> int:
+    """Ghi các điều luật (list hoặc generator) vào file .txt riêng biệt, trả về số điều đã ghi"""
     os.makedirs(output_dir, exist_ok=True)
+    count = 0
     for article_id, article_lines in articles:
+        count += 1
         # Tạo tên file an toàn
         filename = sanitize_filename(article_id.lower()) + ".txt"
         out_path = os.path.join(output_dir, filename)
         # Ghi nội dung điều luật
         with open(out_path, "w", encoding="utf-8") as f:
             f.write("\n".join(article_lines).strip() + "\n")
+    return count
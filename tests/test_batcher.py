@@ -0,0 +1,70 @@
+"""
+Kiểm thử QueryBatcher: lô của provider hoặc index chậm không chặn request đồng thời của provider/index khác
+embed_queries và search_batch được thay bằng hàm giả, không cần model hay index thật
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from src import batcher as batcher_module
+from src import retriever
+
+TIMEOUT = 5.0
+
+
+@pytest.fixture
+def slow_calls(monkeypatch):
+    """Provider "slow" và index "cold" bị chặn tới khi release được set; các trường hợp khác trả ngay"""
+    release = threading.Event()
+
+    def embed_queries(queries, provider, local_model):
+        if provider == "slow":
+            assert release.wait(TIMEOUT)
+        return np.ones((len(queries), 4), dtype=np.float32)
+
+    def search_batch(index_dir, q, top_k, laws, queries, mode, expand):
+        if index_dir == "cold":
+            assert release.wait(TIMEOUT)
+        return [[{"id": f"{index_dir}:{query}"}] for query in queries]
+
+    monkeypatch.setattr(retriever, "embed_queries", embed_queries)
+    monkeypatch.setattr(retriever, "search_batch", search_batch)
+    yield release
+    release.set()
+
+
+@pytest.fixture
+def batcher():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield batcher_module.QueryBatcher(max_batch=8, max_wait_ms=50, executor=executor)
+    executor.shutdown(wait=False)
+
+
+@pytest.mark.parametrize(
+    "slow, fast",
+    [
+        (("idx", "slow"), ("idx", "local")),
+        (("cold", "local"), ("warm", "local")),
+    ],
+    ids=["provider", "index_dir"],
+)
+def test_slow_group_does_not_block_others(slow_calls, batcher, slow, fast):
+    slow_future = batcher.submit("a", slow[0], 3, slow[1], "m", mode="vector")
+    fast_future = batcher.submit("b", fast[0], 3, fast[1], "m", mode="vector")
+
+    assert fast_future.result(timeout=TIMEOUT) == [{"id": f"{fast[0]}:b"}]
+    assert not slow_future.done()
+    slow_calls.set()
+    assert slow_future.result(timeout=TIMEOUT) == [{"id": f"{slow[0]}:a"}]
+
+
+def test_lexical_skips_queue(slow_calls, batcher, monkeypatch):
+    monkeypatch.setattr(retriever, "retrieve", lambda query, index_dir, *args: [{"id": f"bm25:{query}"}])
+    slow_future = batcher.submit("a", "idx", 3, "slow", "m", mode="vector")
+    lexical_future = batcher.submit("b", "idx", 3, "slow", "m", mode="lexical")
+
+    assert lexical_future.result(timeout=TIMEOUT) == [{"id": "bm25:b"}]
+    assert not slow_future.done()
@@ -0,0 +1,104 @@
+"""
+Kiểm thử EmbeddingScheduler với server embeddings giả lập tương thích OpenAI (chạy cục bộ, không cần API key)
+Server trả 429 kèm Retry-After cho lần gửi đầu của một số batch và xáo trộn thứ tự data trong response
+"""
+
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+openai = pytest.importorskip("openai")
+
+from src import embed_scheduler  # noqa: E402
+
+
+class FakeEmbeddingsServer:
+    """Server /v1/embeddings giả lập: vector của "t<i>" là [i, len(batch)], batch có i chia hết cho fail_every bị 429 lần đầu"""
+
+    def __init__(self, fail_every: int = 3) -> None:
+        self.fail_every = fail_every
+        self.rate_limited = 0
+        self._seen = set()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                texts = body["input"]
+                first = int(texts[0][1:])
+                with server._lock:
+                    fail = first % server.fail_every == 0 and texts[0] not in server._seen
+                    server._seen.add(texts[0])
+                    if fail:
+                        server.rate_limited += 1
+                if fail:
+                    self._send(429, {"error": {"message": "rate limited", "type": "rate_limit"}}, {"retry-after": "0.01"})
+                    return
+                data = [
+                    {"object": "embedding", "index": i, "embedding": [float(t[1:]), float(len(texts))]}
+                    for i, t in enumerate(texts)
+                ]
+                random.shuffle(data)
+                usage = {"prompt_tokens": len(texts), "total_tokens": len(texts)}
+                self._send(200, {"object": "list", "data": data, "model": body["model"], "usage": usage})
+
+            def _send(self, status, payload, headers=None):
+                out = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(out)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self) -> "FakeEmbeddingsServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_retries_rate_limits_and_keeps_order(concurrency):
+    texts = [f"t{i}" for i in range(53)]
+    batch_size = 5
+    with FakeEmbeddingsServer() as server:
+        client = openai.OpenAI(api_key="test", base_url=server.url, max_retries=0)
+        scheduler = embed_scheduler.EmbeddingScheduler(
+            client, "fake-model", batch_size, concurrency=concurrency, rpm=0, tpm=0, max_retries=3
+        )
+        calls = []
+        vectors = scheduler.embed(texts, on_batch=lambda start, vecs: calls.append((start, vecs[:, 0].tolist())))
+
+    assert server.rate_limited > 0
+    assert scheduler.retries == server.rate_limited
+    # Kết quả theo đúng thứ tự đầu vào dù server xáo trộn data và các batch xong không theo thứ tự
+    np.testing.assert_array_equal(vectors[:, 0], np.arange(len(texts), dtype=np.float32))
+    # on_batch được gọi đúng một lần cho mỗi batch, với vector của đúng batch đó
+    starts = list(range(0, len(texts), batch_size))
+    assert sorted(start for start, _ in calls) == starts
+    for start, firsts in calls:
+        assert firsts == [float(i) for i in range(start, min(start + batch_size, len(texts)))]
+
+
+def test_gives_up_after_max_retries():
+    with FakeEmbeddingsServer(fail_every=1) as server:
+        client = openai.OpenAI(api_key="test", base_url=server.url, max_retries=0)
+        scheduler = embed_scheduler.EmbeddingScheduler(client, "fake-model", 4, concurrency=1, rpm=0, tpm=0, max_retries=0)
+        with pytest.raises(openai.RateLimitError):
+            scheduler.embed(["t0", "t1"])